@@ -8,128 +8,143 @@
 # ------------------------------------------------------------------------------
 """
 import os
-from pathlib import Path
-
-import biotite.structure.io as strucio
-from openpyxl import Workbook
-from openpyxl.styles import Alignment
-from tqdm import tqdm
+from contextlib import ExitStack
 
 from qprotein.feature import hydrophobic, hbond, salt_bridge, disulfide_bond
-from qprotein.utilities import logger
+from qprotein.feature import protonation as protonation_module
+from qprotein.feature.context import StructureContext
+from qprotein.utilities import export, logger, result_store, structure_source
 
 logger = logger.setup_log(name=__name__)
 
-def calc_interactions(structure_dir):
-    interactions = {}
-    pdb_files = list(Path(structure_dir).glob("*.pdb"))
-    for structure_path in tqdm(pdb_files, desc='Computing interactions for monomers'):
-        _interaction = {}
-        file_name = structure_path.stem
-        structure = strucio.load_structure(structure_path)
-        hydrophobic_ret = hydrophobic.run(structure)
-        _interaction['hydrophobic'] = hydrophobic_ret
-        hbond_ret = hbond.run(structure_path, 'pairs')
-        _interaction['hbond'] = hbond_ret
-        salt_bridge_ret = salt_bridge.run(structure, 'pairs')
-        _interaction['salt_bridge'] = salt_bridge_ret
-        disulfide_bond_ret = disulfide_bond.run(structure, 'pairs')
-        _interaction['disulfide_bond'] = disulfide_bond_ret
-        interactions[file_name] = _interaction
-    return interactions
-
-
-def save2xlsx(data_dict, xlsx_file):
-    workbook = Workbook()
-    if 'Sheet' in workbook.sheetnames:
-        del workbook['Sheet']
-    sheets = []
-    sheet_names = ["hydrophobic", "hbond", "salt_bridge", "disulfide_bond"]
-    for name in sheet_names:
-        sheets.append(workbook.create_sheet(name))
-
-    for protein_name, interaction in data_dict.items():
-        for interact_name, value in interaction.items():
-            if interact_name == "hydrophobic":
-                sheet = workbook["hydrophobic"]
-                max_row = sheet.max_row
-                if max_row == 1:
-                    sheet.cell(row=1, column=1, value='protein names')
-                    sheet.column_dimensions['A'].width = len('protein names') * 2
-                    sheet.cell(row=1, column=2, value='cluster name')
-                    sheet.column_dimensions['B'].width = len('cluster name') * 2
-                    sheet.cell(row=1, column=3, value='area(A^2)')
-                    sheet.column_dimensions['C'].width = len('area(A^2)') * 2
-                    sheet.cell(row=1, column=4, value='residues')
-                    sheet.column_dimensions['D'].width = len('residues') * 2
-                for i, (cluster_idx, info) in enumerate(value.items()):
-                    start_row = max_row + 1
-                    end_row = start_row + len(value) - 1
-                    merge_range = f'A{start_row}:A{end_row}'  # column A
-                    sheet.merge_cells(merge_range)
-                    cell = sheet[merge_range.split(':')[0]]
-                    cell.value = protein_name
-                    sheet.cell(row=start_row + i, column=2, value=cluster_idx)
-                    sheet.cell(row=start_row + i, column=3, value=info[0])
-                    sheet.cell(row=start_row + i, column=4, value='+'.join([str(_) for _ in info[1]]))
-            else:
-                sheet = workbook[interact_name]
-                max_column = sheet.max_column
-                if max_column == 1:
-                    start_column = max_column
-                else:
-                    start_column = max_column + 1
-                end_column = start_column + 1
-                sheet.cell(row=1, column=start_column, value=protein_name)
-                sheet.merge_cells(start_row=1, start_column=start_column, end_row=1, end_column=end_column)
-                for i, pair in enumerate(value):
-                    sheet.cell(row=i + 2, column=start_column, value=pair[0][1])
-                    sheet.cell(row=i + 2, column=end_column, value=pair[1][1])
-
-    for sh in sheets:
-        for row in sh.iter_rows():
-            for cell in row:
-                if cell.value is not None:
-                    cell.alignment = Alignment(horizontal="center", vertical="center")
-
-    workbook.save(xlsx_file)
-    workbook.close()
-    logger.info('Results saved to directory: {}'.format(xlsx_file))
-
-
-def generate_pml_file(data_dict, pdb_dir, pml_dir):
-    for name, four_interaction in data_dict.items():
-        output_pml = os.path.join(pml_dir, f"{name}.pml")
-        pdb_path = os.path.join(pdb_dir, name + '.pdb')
-        with open(output_pml, 'w') as pml_file:
-            pml_file.write(f"load {pdb_path}, {name}\n")
-            pml_file.write("remove solvent\n")
-            pml_file.write(f"color white, {name}\n")
-
-            # pymol scripts for each hydrophobic cluster
-            if four_interaction['hydrophobic']:
-                for i, (cluster_name, cluster_info) in enumerate(four_interaction['hydrophobic'].items()):
-                    select_str = f"select {cluster_name}, res { '+'.join(map(str, cluster_info[1])) }"
-                    pml_file.write(select_str + '\n')
-                    pml_file.write(f"show spheres, {cluster_name}\n")
-                    pml_file.write(f"color {color_iter(i)}, {cluster_name}\n")
-
-            point_interaction = ['salt_bridge', 'disulfide_bond']
-            for point_i in point_interaction:
-                if four_interaction[point_i]:
-                    res_list = []
-                    for pair in four_interaction[point_i]:
-                        distance_str = f'distance dist_{point_i}'
-                        for res in pair:
-                            distance_str += f", id {str(res[0])}"
-                            res_list.append(str(res[1]))
-                        pml_file.write(distance_str + '\n')
-                    sele_str = f"select {point_i}, res {'+'.join(res_list)}"
-                    pml_file.write(sele_str + '\n')
-                    pml_file.write(f'show sticks, {point_i}\n')
-                    pml_file.write(f'color atomic, {point_i}\n')
-            pml_file.write(f'remove hydrogen\n')
-    logger.info('Visualization pml files saved to {}'.format(pml_dir))
+def _structure_interactions(structure_path, protonation="cli"):
+    # one unreadable or unprotonatable structure must not abort the whole export
+    try:
+        return _interactions_of(structure_path, protonation)
+    except Exception as e:
+        logger.error(f"Interactions of {structure_source.stem(structure_path)} failed, skipping: {e}")
+        return None
+
+
+def _interactions_of(structure_path, protonation):
+    _interaction = {}
+    context = StructureContext.load(structure_path)
+    hydrophobic_ret = hydrophobic.run(context)
+    _interaction['hydrophobic'] = hydrophobic_ret
+    hbond_ret = hbond.run(context, 'pairs', backend=protonation)
+    _interaction['hbond'] = hbond_ret
+    salt_bridge_ret = salt_bridge.run(context, 'pairs')
+    _interaction['salt_bridge'] = salt_bridge_ret
+    disulfide_bond_ret = disulfide_bond.run(context, 'pairs')
+    _interaction['disulfide_bond'] = disulfide_bond_ret
+    return _interaction
+
+
+def interaction_params(protonation="cli"):
+    """Everything the interactions depend on, see `result_store.map_stored`."""
+    params = {"protonation": protonation}
+    params.update(result_store.package_versions("biotite", *([] if protonation == "builtin" else ["pdb2pqr"])))
+    params.update(result_store.function_defaults(salt_bridge.run, disulfide_bond.run,
+                                                 hydrophobic.detect_hydrophobic_cluster, hbond.hbond))
+    if protonation == "builtin":
+        params["protonation_geometry"] = protonation_module.builtin_params()
+    else:
+        params["pdb2pqr_options"] = protonation_module.pdb2pqr_options()
+    return params
+
+
+def calc_interactions(structure_dir, protonation="cli", workers=1, store=None, on_result=None):
+    """
+    Interactions of every structure, as {name: interaction}; interaction is
+    None for structures that failed, which are logged and not stored. With
+    `on_result`, it is called as on_result(name, interaction) as soon as a
+    structure is done and nothing is kept or returned.
+    """
+    pdb_files = structure_source.list_structures(structure_dir)
+    names = [structure_source.stem(structure_path) for structure_path in pdb_files]
+    callback = (lambda index, interaction: on_result(names[index], interaction)) if on_result is not None else None
+    results = result_store.map_stored(store, "visual", interaction_params(protonation),
+                                      _structure_interactions, pdb_files, workers=workers, on_result=callback,
+                                      desc='Computing interactions for monomers', protonation=protonation)
+    if on_result is None:
+        return dict(zip(names, results))
+
+
+INTERACTION_SHEETS = {
+    "hydrophobic": ['protein names', 'cluster name', 'area(A^2)', 'residues'],
+    "hbond": ['protein names', 'residue 1', 'residue 2'],
+    "salt_bridge": ['protein names', 'residue 1', 'residue 2'],
+    "disulfide_bond": ['protein names', 'residue 1', 'residue 2'],
+}
+
+
+PAIR_COLUMNS = [("protein_name", "string"), ("atom_1", "int32"), ("res_id_1", "int32"),
+                ("atom_2", "int32"), ("res_id_2", "int32")]
+PARQUET_TABLES = {
+    "hydrophobic_cluster": [("protein_name", "string"), ("cluster", "string"), ("cluster_area", "float64"),
+                            ("res_id", "int32"), ("res_area", "float64")],
+    "hbond": PAIR_COLUMNS,
+    "salt_bridge": PAIR_COLUMNS,
+    "disulfide_bond": PAIR_COLUMNS,
+}
+
+
+def parquet_rows(protein_name, interaction):
+    """
+    Rows of one protein for `PARQUET_TABLES`, as (table, row): one row per
+    cluster member residue and per interacting atom pair.
+    """
+    for cluster_idx, info in interaction['hydrophobic'].items():
+        for res_id, res_area in zip(info[1], info[2]):
+            yield "hydrophobic_cluster", [protein_name, cluster_idx, float(info[0]), int(res_id), float(res_area)]
+    for name in ("hbond", "salt_bridge", "disulfide_bond"):
+        for (atom_1, res_id_1), (atom_2, res_id_2) in interaction[name]:
+            yield name, [protein_name, int(atom_1), int(res_id_1), int(atom_2), int(res_id_2)]
+
+
+def xlsx_rows(protein_name, interaction):
+    """
+    Rows of one protein for `INTERACTION_SHEETS`, as (sheet, row): one row
+    per hydrophobic cluster or interacting residue pair.
+    """
+    for cluster_idx, info in interaction['hydrophobic'].items():
+        yield "hydrophobic", [protein_name, cluster_idx, info[0], '+'.join([str(_) for _ in info[1]])]
+    for name in ("hbond", "salt_bridge", "disulfide_bond"):
+        for pair in interaction[name]:
+            yield name, [protein_name, pair[0][1], pair[1][1]]
+
+
+def write_pml_file(name, four_interaction, pdb_dir, pml_dir):
+    output_pml = os.path.join(pml_dir, f"{name}.pml")
+    pdb_path = os.path.join(pdb_dir, name + '.pdb')
+    with open(output_pml, 'w') as pml_file:
+        pml_file.write(f"load {pdb_path}, {name}\n")
+        pml_file.write("remove solvent\n")
+        pml_file.write(f"color white, {name}\n")
+
+        # pymol scripts for each hydrophobic cluster
+        if four_interaction['hydrophobic']:
+            for i, (cluster_name, cluster_info) in enumerate(four_interaction['hydrophobic'].items()):
+                select_str = f"select {cluster_name}, res { '+'.join(map(str, cluster_info[1])) }"
+                pml_file.write(select_str + '\n')
+                pml_file.write(f"show spheres, {cluster_name}\n")
+                pml_file.write(f"color {color_iter(i)}, {cluster_name}\n")
+
+        point_interaction = ['salt_bridge', 'disulfide_bond']
+        for point_i in point_interaction:
+            if four_interaction[point_i]:
+                res_list = []
+                for pair in four_interaction[point_i]:
+                    distance_str = f'distance dist_{point_i}'
+                    for res in pair:
+                        distance_str += f", id {str(res[0])}"
+                        res_list.append(str(res[1]))
+                    pml_file.write(distance_str + '\n')
+                sele_str = f"select {point_i}, res {'+'.join(res_list)}"
+                pml_file.write(sele_str + '\n')
+                pml_file.write(f'show sticks, {point_i}\n')
+                pml_file.write(f'color atomic, {point_i}\n')
+        pml_file.write(f'remove hydrogen\n')
 
 
 def color_iter(idx):
@@ -138,12 +153,35 @@ def color_iter(idx):
     return colors[idx % len(colors)]
 
 
-def run(work_dir, pdb_dir, pml=False):
-    data_dict = calc_interactions(pdb_dir)
-    xlsx_file = os.path.join(work_dir, "visual.xlsx")
-    save2xlsx(data_dict, xlsx_file)
+def run(work_dir, pdb_dir, pml=False, protonation="cli", workers=1, store=None, output_format="default"):
+    """
+    Interactions of every structure, written to `visual.xlsx` (or Parquet
+    tables) and optional PyMOL scripts as soon as each structure is done,
+    so memory stays flat for any number of structures.
+    """
+    pml_dir = os.path.join(work_dir, "pml")
+    with ExitStack() as stack:
+        if output_format == "parquet":
+            sink = stack.enter_context(export.ParquetSink(work_dir, "visual", PARQUET_TABLES))
+            rows_of = parquet_rows
+        else:
+            sink = stack.enter_context(export.XlsxSink(os.path.join(work_dir, "visual.xlsx"), INTERACTION_SHEETS))
+            rows_of = xlsx_rows
+        if pml:
+            if not os.path.exists(pml_dir):
+                os.mkdir(pml_dir)
+            # PyMOL loads plain files: structures of archives are written next to the scripts
+            structure_dir = stack.enter_context(
+                structure_source.materialized_dir(pdb_dir, out_dir=os.path.join(pml_dir, "structures")))
+
+        def write(name, interaction):
+            if interaction is None:
+                return
+            for table, row in rows_of(name, interaction):
+                sink.write(table, row)
+            if pml:
+                write_pml_file(name, interaction, structure_dir, pml_dir)
+
+        calc_interactions(pdb_dir, protonation=protonation, workers=workers, store=store, on_result=write)
     if pml:
-        pml_dir = os.path.join(work_dir, "pml")
-        if not os.path.exists(pml_dir):
-            os.mkdir(pml_dir)
-        generate_pml_file(data_dict, pdb_dir, pml_dir)
+        logger.info('Visualization pml files saved to {}'.format(pml_dir))
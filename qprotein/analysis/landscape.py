@@ -18,11 +18,27 @@ from weblogo import LogoData, LogoOptions, LogoFormat, eps_formatter, read_seq_d
 from weblogo.color import Color
 
 from qprotein.evolutionary_analysis import function_landscape
-from qprotein.utilities import logger
+from qprotein.utilities import export, logger
 
 logger = logger.setup_log(name=__name__)
 
 
+PARQUET_TABLES = {
+    "landscape": [("position", "int32"), ("aa", "string"),
+                  ("positive_label_ratio", "float64"), ("conservation", "float64")],
+}
+
+
+def save_parquet(df_landscape, work_dir):
+    """Landscape cells in long format, one row per observed residue at a position."""
+    with export.ParquetSink(work_dir, "landscape", PARQUET_TABLES) as sink:
+        for pos in df_landscape.columns:
+            for aa, values in df_landscape[pos].items():
+                if values is not None:
+                    sink.write("landscape", [int(pos), aa, float(values[0]), float(values[1])])
+    return sink.files
+
+
 def plot_landscape(df, input_pos_list, template_name, svg_path):
     fig, ax = plt.subplots(figsize=(18, 14))
     df = df[input_pos_list]
@@ -213,7 +229,8 @@ def plot_weblogo(align_seq_df, input_pos_list, eps_path):
 
 
 def run(work_dir, label_file, pdb_dir, template_name, input_pos_list,
-        label_pos_threshold, config_file):
+        label_pos_threshold, config_file, output_format="default", store=None):
+    """store: result_store.ResultStore keeping the template alignments between runs"""
     #### CONFIGURATION PARSER ####
     config = configparser.ConfigParser()
     config.read(config_file)
@@ -225,13 +242,19 @@ def run(work_dir, label_file, pdb_dir, template_name, input_pos_list,
     figure_dir = os.path.join(work_dir, 'landscape_figures')
     if not os.path.exists(figure_dir):
         os.makedirs(figure_dir)
-    svg_path = os.path.join(figure_dir, 'landscape_' + template_name.rstrip('.pdb') + '.svg')
-    eps_path = os.path.join(figure_dir, 'weblogo_' + template_name.rstrip('.pdb') + '.eps')
-
-    df_landscape, aligned_seq_df = function_landscape.run(work_dir, label_file, pdb_dir, template_name, output_xlsx, label_pos_threshold, usalign_bin)
-    logger.info("Function landscape results successfully saved to {}".format(output_xlsx))
-
-    plot_landscape(df_landscape, input_pos_list, template_name.rstrip('.pdb'), svg_path)
+    svg_path = os.path.join(figure_dir, 'landscape_' + template_name.removesuffix('.pdb') + '.svg')
+    eps_path = os.path.join(figure_dir, 'weblogo_' + template_name.removesuffix('.pdb') + '.eps')
+
+    if output_format == "parquet":
+        df_landscape, aligned_seq_df = function_landscape.run(work_dir, label_file, pdb_dir, template_name, None, label_pos_threshold, usalign_bin,
+                                                                       store=store)
+        save_parquet(df_landscape, work_dir)
+    else:
+        df_landscape, aligned_seq_df = function_landscape.run(work_dir, label_file, pdb_dir, template_name, output_xlsx, label_pos_threshold, usalign_bin,
+                                                                       store=store)
+        logger.info("Function landscape results successfully saved to {}".format(output_xlsx))
+
+    plot_landscape(df_landscape, input_pos_list, template_name.removesuffix('.pdb'), svg_path)
     logger.info("Landscape plot in vector format (svg) successfully saved to {}".format(svg_path))
 
     plot_weblogo(aligned_seq_df, input_pos_list, eps_path)
@@ -7,12 +7,10 @@
 # Description: analyze hydrophobic distribution in different local regions
 # ------------------------------------------------------------------------------
 """
-from pathlib import Path
 import csv
-import biotite.structure.io as strucio
 from biotite.structure import CellList
 import numpy as np
-from qprotein.utilities import align_map, logger
+from qprotein.utilities import align_map, logger, structure_source
 
 
 logger = logger.setup_log(name=__name__)
@@ -148,15 +146,31 @@ def save_aa_feature(aa_csv_path, data):
 			                 str(region["overall"]["charge"]), str(region["overall"]["polar"]), str(region["overall"]["hydrophobic"])])
 	logger.info(f"Local amino acid feature saved: {aa_csv_path}")
 
+PARQUET_TABLES = {
+	"local_hydrophobic": [("protein_name", "string"), ("active", "float64"), ("distant", "float64")],
+	"local_aa": [("protein_name", "string"), ("region", "string"), ("charge", "float64"),
+	             ("polar", "float64"), ("hydrophobic", "float64")],
+}
+
+
+def write_parquet_rows(sink, name, hydrophobic_region, aa_region):
+	sink.write("local_hydrophobic", [name, float(hydrophobic_region[0]), float(hydrophobic_region[1])])
+	for region in ("active", "distant", "overall"):
+		fractions = aa_region[region]
+		sink.write("local_aa", [name, region, float(fractions["charge"]), float(fractions["polar"]),
+		                        float(fractions["hydrophobic"])])
+
+
 def run(template_name, alignment_fasta, template_active_architecture, clusters, pdb_list,
-        hydrophobic_csv_path, aa_csv_path, active_edge_dist, intermediate_edge_dist):
+        hydrophobic_csv_path, aa_csv_path, active_edge_dist, intermediate_edge_dist, sink=None):
+	"""sink: ParquetSink of `PARQUET_TABLES`, written per structure instead of the csv files"""
 	map_dict = align_map.run(alignment_fasta)
 	aligned_active_architecture = [map_dict[template_name][int(i)] for i in template_active_architecture]
 	hydrophobic_region_dict = {}
 	aa_region_dict = {}
 	for structure_path in pdb_list:
-		structure_name = Path(structure_path).stem
-		structure = strucio.load_structure(structure_path)
+		structure_name = structure_source.stem(structure_path)
+		structure = structure_source.load(structure_path)
 		res_map = map_dict.get(structure_name)
 		if res_map:
 			reversed_res_map = {v:k for k, v in res_map.items()}
@@ -169,9 +183,13 @@ def run(template_name, alignment_fasta, template_active_architecture, clusters,
 			aa_dict["active"] = aa_ret[0]
 			aa_dict["distant"] = aa_ret[1]
 			aa_dict["overall"] = aa_ret[2]
-			aa_region_dict[structure_name] = aa_dict
-	save_hydrophobic_feature(hydrophobic_csv_path, hydrophobic_region_dict)
-	save_aa_feature(aa_csv_path, aa_region_dict)
+			if sink is not None:
+				write_parquet_rows(sink, structure_name, hydrophobic_region_dict.pop(structure_name), aa_dict)
+			else:
+				aa_region_dict[structure_name] = aa_dict
+	if sink is None:
+		save_hydrophobic_feature(hydrophobic_csv_path, hydrophobic_region_dict)
+		save_aa_feature(aa_csv_path, aa_region_dict)
 
 if __name__ == '__main__':
 	template_name = r"A5H0S3"
@@ -11,6 +11,20 @@ from qprotein.utilities import logger
 
 logger = logger.setup_log(name=__name__)
 
+PARQUET_TABLES = {
+	"feature": [("protein_name", "string"), ("hydrophobic", "float64"), ("hbond", "float64"),
+	            ("salt_bridge", "float64"), ("disulfide", "float64"), ("length", "int32")],
+}
+
+
+def parquet_rows(name, feature):
+	"""Rows of one protein for `PARQUET_TABLES`, as (table, row)."""
+	seq_length = feature['length']
+	sum_area = sum([float(cluster[0]) for cluster in list(feature["hydrophobic"].values())])
+	yield "feature", [name, sum_area / seq_length, float(feature["hbond"]), float(feature["saltbridge"]),
+	                  float(feature["disulfide"]), int(seq_length)]
+
+
 def save_feature(feature_file, feature_dict):
 	with open(feature_file, "w") as f:
 		f.write("Protein_name,Hydrophobic,Hbond,Salt_bridge,Disulfide\n")
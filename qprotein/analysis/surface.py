@@ -10,79 +10,84 @@
 import os
 import configparser
 
-from openpyxl import Workbook
-from openpyxl.styles import Alignment
-
 from qprotein.feature import compute_surface
-from qprotein.utilities import logger
+from qprotein.utilities import export, logger
 
 logger = logger.setup_log(name=__name__)
 
 
-def save2xlsx(data, xlsx_file):
-    workbook = Workbook()
-
-    if 'Sheet' in workbook.sheetnames:
-        del workbook['Sheet']
-
-    statistics_sheet = workbook.create_sheet("Statistics")
-    detail_sheet = workbook.create_sheet("Details")
-
-    statistics_sheet['A1'] = 'Enzyme names'
-    statistics_sheet['B1'] = 'Negative percentage'
-    statistics_sheet['C1'] = 'Positive percentage'
-    statistics_sheet['D1'] = 'Net charges'
-
-    for row_index, row_perc in enumerate(data, start=2):
-        statistics_sheet.cell(row=row_index, column=1, value=row_perc[0])
-        statistics_sheet.cell(row=row_index, column=2, value=row_perc[2]['negative'])
-        statistics_sheet.cell(row=row_index, column=3, value=row_perc[2]['positive'])
-        statistics_sheet.cell(row=row_index, column=4, value=row_perc[3])
-
-    # Write data into the sheet
-    for row_index, residue in enumerate(data, start=1):
-        name = residue[0]
-
-        start_row = row_index * 2 - 1
-        end_row = start_row + 1
-
-        detail_sheet.merge_cells(start_row=start_row, start_column=1, end_row=end_row, end_column=1)
-        detail_sheet.cell(row=start_row, column=1, value=name)
-        detail_sheet.cell(row=start_row, column=1).alignment = Alignment(horizontal="center", vertical="center")
-        detail_sheet.cell(row=row_index * 2 - 1, column=1, value=name + '_chainA')
-
-        # Write residue indices and types
-        for col_index, (res_idx, res_type) in enumerate(residue[1], start=2):
-            detail_sheet.cell(row=row_index * 2 - 1, column=col_index, value=res_idx)
-            detail_sheet.cell(row=row_index * 2, column=col_index, value=res_type)
-
-    for row in statistics_sheet.iter_rows():
-        for cell in row:
-            if cell.value is not None:
-                cell.alignment = Alignment(horizontal="center", vertical="center")
-
-    for row in detail_sheet.iter_rows():
-        for cell in row:
-            if cell.value is not None:
-                cell.alignment = Alignment(horizontal="center", vertical="center")
-
-    workbook.save(xlsx_file)
-    workbook.close()
-    logger.info('Results saved to {}'.format(xlsx_file))
-
-
-def run(work_dir, structure_dir, config_file):
+SURFACE_SHEETS = {
+    "Statistics": ['Enzyme names', 'Negative percentage', 'Positive percentage', 'Net charges'],
+    "Details": ['Enzyme names', 'Chain', 'Residue index', 'Residue type'],
+}
+PH_SCAN_SHEET = ['Enzyme names', 'pH', 'Net charges', 'Negative percentage', 'Positive percentage']
+
+
+PARQUET_TABLES = {
+    "statistics": [("protein_name", "string"), ("negative_percentage", "float64"),
+                   ("positive_percentage", "float64"), ("net_charge", "int32")],
+    "details": [("protein_name", "string"), ("chain", "string"), ("res_id", "int32"), ("res_type", "string")],
+    "ph_scan": [("protein_name", "string"), ("ph", "float64"), ("net_charge", "float64"),
+                ("negative_percentage", "float64"), ("positive_percentage", "float64")],
+}
+
+
+def parquet_rows(name, row):
+    """Rows of one `compute_surface.run` result for `PARQUET_TABLES`, as (table, row)."""
+    yield "statistics", [name, float(row[2]['negative']), float(row[2]['positive']),
+                         None if row[3] is None else int(row[3])]
+    for res_idx, res_type, chain_id in row[1]:
+        yield "details", [name, chain_id, int(res_idx), res_type]
+    if len(row) > 4:
+        scan = row[4]
+        for ph, charge, negative, positive in zip(scan['pH'], scan['net_charge'], scan['negative'], scan['positive']):
+            yield "ph_scan", [name, float(ph), float(charge), float(negative), float(positive)]
+
+
+def xlsx_rows(name, row):
+    """
+    Rows of one `compute_surface.run` result, as (sheet, row): one row per
+    enzyme (Statistics), surface charged residue (Details) and pH (pH scan).
+    """
+    yield "Statistics", [name, row[2]['negative'], row[2]['positive'], row[3]]
+    for res_idx, res_type, chain_id in row[1]:
+        yield "Details", [name, chain_id, res_idx, res_type]
+    if len(row) > 4:
+        scan = row[4]
+        for ph, charge, negative, positive in zip(scan['pH'], scan['net_charge'], scan['negative'], scan['positive']):
+            yield "pH scan", [name, float(ph), round(float(charge), 2), '{:.3}'.format(negative),
+                              '{:.3}'.format(positive)]
+
+
+def run(work_dir, structure_dir, config_file, workers=1, backend="dssp", point_number=compute_surface.SASA_POINTS,
+        potential=False, ph_grid=None, store=None, output_format="default"):
     #### CONFIGURATION PARSER ####
     config = configparser.ConfigParser()
     config.read(config_file)
-    dssp_bin = config.get('binary', 'dssp')
-    apbs_bin = config.get('binary', 'apbs')
+    dssp_bin = config.get('binary', 'dssp', fallback='mkdssp')
+    apbs_bin = config.get('binary', 'apbs', fallback='apbs')
     pdb2pqr_bin = config.get('binary', 'pdb2pqr')
     #### END OF CONFIGURATION PARSER ####
 
-    xlsx_file = os.path.join(work_dir, "surface.xlsx")
-    data = compute_surface.run(structure_dir, dssp_bin=dssp_bin, pdb2pqr_bin=pdb2pqr_bin, apbs_bin=apbs_bin)
-    save2xlsx(data, xlsx_file)
+    potential_dir = os.path.join(work_dir, "potential") if potential else None
+    kwargs = dict(dssp_bin=dssp_bin, pdb2pqr_bin=pdb2pqr_bin, apbs_bin=apbs_bin, workers=workers, backend=backend,
+                  point_number=point_number, potential_dir=potential_dir, ph_grid=ph_grid, store=store)
+    # rows are written as structures finish, in long format
+    if output_format == "parquet":
+        sink = export.ParquetSink(work_dir, "surface", PARQUET_TABLES)
+        rows_of = parquet_rows
+    else:
+        sheets = dict(SURFACE_SHEETS)
+        if ph_grid is not None:
+            sheets["pH scan"] = PH_SCAN_SHEET
+        sink = export.XlsxSink(os.path.join(work_dir, "surface.xlsx"), sheets)
+        rows_of = xlsx_rows
+    with sink:
+        def write_rows(index, row):
+            if row is not None:
+                for table, values in rows_of(row[0], row):
+                    sink.write(table, values)
+        compute_surface.run(structure_dir, on_result=write_rows, **kwargs)
 
 if __name__ == '__main__':
     structure_dir = r"/Users/douzhixin/Developer/qProtein/qProtein-main/test/structure"
@@ -17,9 +17,10 @@ import time
 
 import biotite.structure as struc
 import biotite.structure.io as strucio
+from biotite.sequence import ProteinSequence
 import pandas as pd
 
-from qprotein.utilities import logger
+from qprotein.utilities import cache, logger, usalign
 
 logger = logger.setup_log(name=__name__)
 
@@ -35,26 +36,27 @@ def read_labels(label_file):
     return label_dict
 
 
-def align_pdbs(work_dir, pdb_dir, template_name, label_dict, usalign_bin):
+def align_pdbs(work_dir, pdb_dir, template_name, label_dict, usalign_bin, store=None):
     """
     Align all structures
 
     Args:
         pdb_dir: pdb dir path
         usalign_bin: usalign binary path
+        store: result_store.ResultStore keeping alignments by template and target content
+            and USalign options, only new pairs are aligned
 
-    Returns: Path of aligned results as a fasta file.
+    Returns: [template, candidate, label] of every alignment, generated while USalign runs.
 
     """
     time1 = time.time()
     logger.info("Aligning PDBs...")
 
+    template_name = template_name.removesuffix(".pdb")
     chain_list = [file for file in os.listdir(pdb_dir) if file.endswith(".pdb")]
+    # the template is counted once, in create_landscape, and not aligned to itself
     total_protein_num = len(chain_list)
-
-    chain_list_path = os.path.join(work_dir, 'chain_list')
-    with open(chain_list_path, 'w') as f:
-        f.writelines(f"{line.rstrip('.pdb')}\n" for line in chain_list if line != template_name)
+    target_names = [file[:-len(".pdb")] for file in chain_list if file[:-len(".pdb")] != template_name]
 
     template_pdb = os.path.join(pdb_dir, template_name+'.pdb')
     structure = strucio.load_structure(template_pdb)
@@ -62,33 +64,54 @@ def align_pdbs(work_dir, pdb_dir, template_name, label_dict, usalign_bin):
 
     align_seq_df = pd.DataFrame(columns=res_idx)
 
-    usalign_cmd = [
-        usalign_bin,
-        "-mol",
-        "prot",
-        template_pdb,
-        "-dir2",
-        pdb_dir,
-        chain_list_path,
-        # "-do",  #show paired residues distances
-        "-outfmt",
-        "1"
-    ]
-
-    try:
-        result = subprocess.run(usalign_cmd, check=True, capture_output=True, text=True)
-        align_output = [align_pair.strip().split('\n') for align_pair in result.stdout.split("$$$$")[:-1]]
-        align_res_list = [[out[1], out[3],
-                           label_dict[out[2].split('\t')[0].split('/')[-1].split('.pdb')[0]]]
-                          for out in align_output]
+    alignments = {}
+    if store is not None:
+        params_hash = store.params_key("usalign", usalign.alignment_params(template_pdb, usalign_bin))
+        hashes = {name: cache.content_hash(os.path.join(pdb_dir, name + ".pdb")) for name in target_names}
+        stored = store.get_many(list(hashes.values()), params_hash)
+        alignments = {name: stored[hashes[name]] for name in target_names if hashes[name] in stored}
+        logger.info(f"Alignments: {len(alignments)} from the result store, "
+                    f"{len(target_names) - len(alignments)} to compute")
+    missing = [name for name in target_names if name not in alignments]
+    if not target_names:
+        logger.warning(f"No structures besides the template {template_name} in {pdb_dir}, "
+                       f"the landscape holds the template only")
+
+    def align_res_list():
+        # stored alignments first, then USalign records as they are written
+        for name in target_names:
+            if name in alignments:
+                alignment = alignments.pop(name)
+                yield [alignment.template, alignment.target, label_dict[name]]
+
+        if missing:
+            chain_list_path = os.path.join(work_dir, 'chain_list')
+            with open(chain_list_path, 'w') as f:
+                f.writelines(f"{name}\n" for name in missing)
+
+            usalign_cmd = [
+                usalign_bin,
+                template_pdb,
+                "-dir2",
+                pdb_dir,
+                chain_list_path,
+                # "-do",  #show paired residues distances
+                *usalign.ALIGN_OPTIONS
+            ]
+
+            try:
+                for alignment in usalign.stream_alignments(usalign_cmd):
+                    if store is not None and alignment.name in hashes:
+                        store.put(hashes[alignment.name], params_hash, "usalign", alignment)
+                    yield [alignment.template, alignment.target, label_dict[alignment.name]]
+            except subprocess.CalledProcessError as e:
+                logger.error(f"{e}: {e.stderr}")
+                raise
 
         time2 = time.time()
         logger.info(f"Aligning PDBs... DONE in {round(time2-time1, 2)} seconds.")
 
-        return align_res_list, total_protein_num, res_idx, align_seq_df
-
-    except subprocess.CalledProcessError as e:
-        logger.error(e)
+    return align_res_list(), total_protein_num, res_idx, align_seq_df
 
 
 def init_aa():
@@ -144,22 +167,41 @@ def map_positions_with_gap(seq_with_gap, seq_without_gap):
     return mapping
 
 
-def create_landscape(template_label, align_res_list, align_seq_df):
-    landscape = []
+def template_sequence(template_pdb):
+    """One letter sequence of the canonical amino acids of the template, by residue id."""
+    structure = strucio.load_structure(template_pdb)
+    structure = structure[struc.filter_canonical_amino_acids(structure)]
+    res_ids, res_names = struc.get_residues(structure)
+    residues = dict(zip(res_ids.tolist(), res_names))
+    return ''.join(ProteinSequence.convert_letter_3to1(residues[res_id]) for res_id in sorted(residues))
+
 
-    # process template
-    template_without_gaps = align_res_list[0][0].replace('-','')
-    align_seq_df.loc[0] = list(template_without_gaps)
+def create_landscape(template_label, align_res_list, align_seq_df, template_seq=None):
+    """
+    align_res_list: iterable of [template, candidate, label], consumed as alignments arrive
+    template_seq: template sequence used when there is no alignment, i.e. the
+        template is the only structure
+    """
+    landscape = []
+    template_without_gaps = None
+    align_seq_rows = []
 
-    for res in template_without_gaps:
-        aa_dict = init_aa()
-        aa_dict[res].append(template_label)
-        landscape.append(aa_dict)
+    def add_template(sequence):
+        align_seq_rows.append(list(sequence))
+        for res in sequence:
+            aa_dict = init_aa()
+            aa_dict[res].append(template_label)
+            landscape.append(aa_dict)
 
-    # continue to process candidates with landscape list
     for align_pair in align_res_list:
-        candi_res_str = ''
         template, candidate = align_pair[:2]
+        if template_without_gaps is None:
+            # process template
+            template_without_gaps = template.replace('-','')
+            add_template(template_without_gaps)
+
+        # continue to process candidates with landscape list
+        candi_res_str = ''
         mapping = map_positions_with_gap(template, template_without_gaps)
 
         for i in range(len(template)):
@@ -170,8 +212,12 @@ def create_landscape(template_label, align_res_list, align_seq_df):
                 candi_label = align_pair[2]
                 if candi_res != '-':
                     landscape[pos_without_gap][candi_res].append(candi_label)
-        align_seq_df.loc[len(align_seq_df)] = list(candi_res_str)
+        align_seq_rows.append(list(candi_res_str))
+
+    if template_without_gaps is None and template_seq is not None:
+        add_template(template_seq)
 
+    align_seq_df = pd.DataFrame(align_seq_rows, columns=align_seq_df.columns)
     return landscape, align_seq_df
 
 def calc_conservation(landscape, total_protein_num, res_idx, output_xlsx, label_pos_thrshold):
@@ -218,17 +264,21 @@ def calc_conservation(landscape, total_protein_num, res_idx, output_xlsx, label_
             else:
                 df.loc[aa, df.columns[pos_idx]] = None
 
-    df_write = df.map(lambda x: f"{x[0]}, {x[1]}" if isinstance(x, list) else x)
-    excel_file = output_xlsx
-    df_write.to_excel(excel_file)
+    if output_xlsx is not None:
+        df_write = df.map(lambda x: f"{x[0]}, {x[1]}" if isinstance(x, list) else x)
+        excel_file = output_xlsx
+        df_write.to_excel(excel_file)
 
     return df
 
 
-def run(work_dir, label_file, pdb_dir, template_name, output_xlsx, label_pos_thrshold, usalign_bin):
+def run(work_dir, label_file, pdb_dir, template_name, output_xlsx, label_pos_thrshold, usalign_bin, store=None):
     label_dict = read_labels(label_file)
-    template_label = label_dict[template_name.rstrip('.pdb')]
-    align_res_list, total_protein_num, res_idx, align_seq_df = align_pdbs(work_dir, pdb_dir, template_name, label_dict, usalign_bin)
-    landscape, aligned_seq_df = create_landscape(template_label, align_res_list, align_seq_df)
+    template_name = template_name.removesuffix('.pdb')
+    template_label = label_dict[template_name]
+    align_res_list, total_protein_num, res_idx, align_seq_df = align_pdbs(work_dir, pdb_dir, template_name, label_dict,
+                                                                          usalign_bin, store=store)
+    template_seq = template_sequence(os.path.join(pdb_dir, template_name + '.pdb'))
+    landscape, aligned_seq_df = create_landscape(template_label, align_res_list, align_seq_df, template_seq)
     df_landscape = calc_conservation(landscape, total_protein_num, res_idx, output_xlsx, label_pos_thrshold)
     return df_landscape, aligned_seq_df
@@ -9,21 +9,42 @@
 """
 
 import os
+import re
 import tempfile
+import time
 import warnings
 from pathlib import Path
 from subprocess import Popen, PIPE
 
 from Bio.PDB import PDBParser
-from Bio.PDB.DSSP import DSSP
+from Bio.PDB.DSSP import DSSP, residue_max_acc
 from Bio.PDB.PDBExceptions import PDBConstructionWarning
-from tqdm import tqdm
+import biotite.structure as struc
+import biotite.structure.io as strucio
+from biotite.sequence import ProteinSequence
+import numpy as np
 
-from qprotein.utilities import logger
+from qprotein.feature import protonation, titration
+from qprotein.utilities import cache, logger, result_store, structure_source
 
 logger = logger.setup_log(name=__name__)
 warnings.simplefilter('ignore', PDBConstructionWarning)
 
+# pdb2pqr settings of the surface charge calculation, part of the cache key
+SURFACE_PDB2PQR_PARAMS = ("PARSE", "no-titration", "apbs-input")
+
+# accessibility and secondary structure: external mkdssp or in-process biotite
+SURFACE_BACKENDS = ("dssp", "native")
+# sphere points per atom; from 300 on the native backend gives the same surface
+# charged residues as the DSSP results in test/surface.xlsx (test/benchmark_surface.py)
+SASA_POINTS = 500
+
+# DSSP atom radii, all other heavy atoms use SIDECHAIN_RADIUS
+DSSP_RADII = {"N": 1.65, "CA": 1.87, "C": 1.76, "O": 1.4}
+SIDECHAIN_RADIUS = 1.8
+# P-SEA classes of biotite.structure.annotate_sse -> DSSP codes
+SSE_CODES = {"a": "H", "b": "E", "c": "-", "": "-"}
+
 
 def get_dssp_dat(struct_path, dssp_bin):
     struct_file_name = os.path.split(struct_path)[1].split('.')[0]
@@ -33,33 +54,90 @@ def get_dssp_dat(struct_path, dssp_bin):
     start_residue_num = next(chain.get_residues()).id[1]
     try:
         dssp = DSSP(model, struct_path, dssp=dssp_bin)
-        dssp_dat = list(map(lambda residue_dat: (residue_dat[0] + start_residue_num - 1, *residue_dat[1:]), dssp))
+        # last field: (chain ID, residue number) of the residue, as in `get_native_dat`
+        dssp_dat = [(residue_dat[0] + start_residue_num - 1, *residue_dat[1:], (chain_id, res_key[1]))
+                    for (chain_id, res_key), residue_dat in zip(dssp.keys(), dssp)]
         return dssp_dat
     except FileNotFoundError:
         logger.error('dssp not found. Please designate to the directory where dssp binary is located.')
         return None
 
+def _one_letter(res_name):
+    try:
+        return ProteinSequence.convert_letter_3to1(res_name)
+    except KeyError:
+        return 'X'
+
+
+def get_native_dat(struct_path, point_number=SASA_POINTS):
+    """
+    DSSP-like residue data computed in-process.
+
+    Relative accessibility comes from a Shrake-Rupley SASA with DSSP atom
+    radii, normalized by the same maximum accessibilities (Sander) as
+    Bio.PDB.DSSP; secondary structure from P-SEA.
+
+    Returns
+    -------
+    list of tuple
+        (res_id, one letter code, secondary structure, relative accessibility)
+        per residue, as the first fields of `get_dssp_dat`, and (chain ID,
+        residue number) as the last field of both. Residues without a
+        maximum accessibility are 'X' with NaN accessibility.
+    """
+    structure = strucio.load_structure(struct_path)
+    structure = structure[struc.filter_amino_acids(structure) & (structure.element != "H")]
+    if structure.array_length() == 0:
+        return None
+
+    radii = np.full(structure.array_length(), SIDECHAIN_RADIUS)
+    for atom_name, radius in DSSP_RADII.items():
+        radii[structure.atom_name == atom_name] = radius
+    atom_sasa = struc.sasa(structure, point_number=point_number, vdw_radii=radii)
+    res_sasa = struc.apply_residue_wise(structure, atom_sasa, np.nansum)
+    sse = struc.annotate_sse(structure)
+
+    starts = struc.get_residue_starts(structure)
+    max_acc = residue_max_acc["Sander"]
+    native_dat = []
+    for chain_id, res_id, res_name, res_sse, acc in zip(structure.chain_id[starts], structure.res_id[starts],
+                                                         structure.res_name[starts], sse, res_sasa):
+        residue = (str(chain_id), int(res_id))
+        if res_name in max_acc:
+            native_dat.append((int(res_id), _one_letter(res_name), SSE_CODES[res_sse], acc / max_acc[res_name],
+                               residue))
+        else:
+            # no maximum accessibility, e.g. SEC or PYL: counted, never surface charged
+            native_dat.append((int(res_id), 'X', SSE_CODES[res_sse], np.nan, residue))
+    return native_dat
+
+
 def get_aa_charge(dssp_dat):
+    """
+    Percentages of surface charged residues and their positions, as
+    (residue number, one letter code, chain ID) from the last field of the
+    residue data.
+    """
     residue_physical = {
         'positive': ('K', 'R', 'H'),
         'negative': ('D', 'E')
     }
-    residues = [i[:4] for i in dssp_dat]
-    total = len(residues)
+    total = len(dssp_dat)
 
     positive = 0
     negative = 0
     # check residue charge
     charge_position = []
-    for res in residues:
+    for res in dssp_dat:
 
-        if res[1] != 'X' and res[3] > 0.05:
+        if res[1] != 'X' and res[3] != 'NA' and res[3] > 0.05:
+            chain_id, res_id = res[-1]
             if res[1] in residue_physical['positive']:
                 positive += 1
-                charge_position.append(res[:2])  # add positive charge
+                charge_position.append((res_id, res[1], chain_id))  # add positive charge
             elif res[1] in residue_physical['negative']:
                 negative += 1
-                charge_position.append(res[:2])  # add negative charge
+                charge_position.append((res_id, res[1], chain_id))  # add negative charge
     prop_positive = '{:.3}'.format(positive / total * 100)
     prop_negative = '{:.3}'.format(negative / total * 100)
 
@@ -67,17 +145,29 @@ def get_aa_charge(dssp_dat):
     return percent, charge_position
 
 
-def get_charges(pdb_file, pdb2pqr_bin, apbs_bin):
+def get_surface_pqr(pdb_file, pdb2pqr_bin, tmp_dir):
     """
-        Calls APBS, pdb2pqr
+    PARSE charges of the structure, from the protonation cache or pdb2pqr.
+
+    Returns
+    -------
+    pqr_atoms : AtomArray
+        Atoms with `charge` and `radius` annotations, None if pdb2pqr failed.
+    apbs_template : str
+        APBS input written by pdb2pqr, with @PQR_PATH@/@PQR_NAME@ placeholders.
     """
     base_pdb = os.path.basename(pdb_file.stem)
-    tmp_dir = tempfile.TemporaryDirectory().name
-    if not os.path.exists(tmp_dir):
-        os.makedirs(tmp_dir)
-
     apbs_input = os.path.join(tmp_dir, base_pdb + '.in')
     pqr_file = os.path.join(tmp_dir, base_pdb + '.pqr')
+
+    structure_cache = cache.get_cache()
+    if structure_cache is not None:
+        key = structure_cache.make_key(pdb_file, "surface", *SURFACE_PDB2PQR_PARAMS,
+                                       protonation.pdb2pqr_version(pdb2pqr_bin))
+        cached = structure_cache.get(key)
+        if cached is not None:
+            return cache.unpack_atoms(cached, "pqr"), str(cached["apbs_input"])
+
     pdb2pqr_cmd = [
         pdb2pqr_bin,
         "--nodebump",
@@ -86,51 +176,180 @@ def get_charges(pdb_file, pdb2pqr_bin, apbs_bin):
         "--whitespace",
         "--apbs-input",
         apbs_input,
-        pdb_file,
+        os.path.abspath(pdb_file),
         pqr_file
 
     ]
+    p1 = Popen(pdb2pqr_cmd, stdout=PIPE, stderr=PIPE, cwd=tmp_dir)
+    p1.communicate()
+    if not (os.path.exists(pqr_file) and os.path.exists(apbs_input)):
+        logger.error(f'pdb2pqr failed for {pdb_file}')
+        return None, None
+
+    with open(pqr_file) as f:
+        pqr_atoms = protonation.read_pqr(f.readlines())
+    with open(apbs_input) as f:
+        apbs_template = f.read().replace(pqr_file, "@PQR_PATH@").replace(os.path.basename(pqr_file), "@PQR_NAME@")
+    if structure_cache is not None:
+        structure_cache.put(key, {**cache.pack_atoms(pqr_atoms, "pqr"), "apbs_input": np.array(apbs_template)})
+    return pqr_atoms, apbs_template
 
-    try:
-        p1 = Popen(pdb2pqr_cmd, stdout=PIPE, stderr=PIPE, cwd=tmp_dir)
-        p1.communicate()
 
-        apbs_cmd = [apbs_bin, os.path.join(tmp_dir, base_pdb + ".in")]
-        p2 = Popen(apbs_cmd, stdout=PIPE, stderr=PIPE, cwd=tmp_dir)
-        stdout, stderr = p2.communicate()
-    except:
-        raise
+def net_charge(pqr_atoms):
+    """Net charge, the sum of the PQR partial charges."""
+    return int(round(float(np.sum(pqr_atoms.charge, dtype=np.float64))))
 
+
+def write_potential(pqr_atoms, apbs_template, apbs_bin, potential_dir, base_pdb, tmp_dir):
+    """
+    Solve the Poisson-Boltzmann equation with APBS and write the
+    electrostatic potential to `potential_dir`/`base_pdb`.dx.
+    """
+    pqr_file = os.path.join(tmp_dir, base_pdb + '.pqr')
+    apbs_input = os.path.join(tmp_dir, base_pdb + '.in')
+    protonation.write_pqr(pqr_atoms, pqr_file)
+    apbs_text = apbs_template.replace("@PQR_PATH@", pqr_file).replace("@PQR_NAME@", os.path.basename(pqr_file))
+    # APBS appends the .dx suffix
+    dx_stem = os.path.abspath(os.path.join(potential_dir, base_pdb))
+    apbs_text = re.sub(r"write pot dx \S+", f"write pot dx {dx_stem}", apbs_text)
+    with open(apbs_input, "w") as f:
+        f.write(apbs_text)
+
+    p2 = Popen([apbs_bin, apbs_input], stdout=PIPE, stderr=PIPE, cwd=tmp_dir)
+    _, stderr = p2.communicate()
     if stderr:
         logger.error(stderr)
-        return
 
-    apbs_out = stdout.decode("utf-8").split("\n")
-    charge = ''
-    for line in apbs_out:
-        if line.startswith("  Net charge"):
-            charge = str(float(line.split(" ")[4]))
 
-    return int(float(charge))
+def get_charges(pdb_file, pdb2pqr_bin, apbs_bin, potential_dir=None):
+    """
+    Net charge from the PQR charges of pdb2pqr (or the protonation cache).
+
+    APBS runs only if `potential_dir` is given, to write the electrostatic
+    potential of the structure there.
+    """
+    base_pdb = os.path.basename(pdb_file.stem)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pqr_atoms, apbs_template = get_surface_pqr(pdb_file, pdb2pqr_bin, tmp_dir)
+        if pqr_atoms is None:
+            return
+        if potential_dir:
+            os.makedirs(potential_dir, exist_ok=True)
+            write_potential(pqr_atoms, apbs_template, apbs_bin, potential_dir, base_pdb, tmp_dir)
+    return net_charge(pqr_atoms)
+
+
+def _structure_surface(structure, dssp_bin, pdb2pqr_bin, apbs_bin, backend="dssp", point_number=SASA_POINTS,
+                       potential_dir=None, ph_grid=None):
+    # mkdssp, pdb2pqr and propka read files: archive members are materialized meanwhile
+    with structure_source.local_file(structure) as struc_path:
+        return _surface_of_file(struc_path, dssp_bin, pdb2pqr_bin, apbs_bin, backend, point_number,
+                                potential_dir, ph_grid)
+
+
+def _surface_of_file(struc_path, dssp_bin, pdb2pqr_bin, apbs_bin, backend, point_number, potential_dir, ph_grid):
+    if backend == "native":
+        dssp_dat = get_native_dat(struc_path, point_number=point_number)
+    else:
+        dssp_dat = get_dssp_dat(struc_path, dssp_bin=dssp_bin)
+    charge = get_charges(struc_path, pdb2pqr_bin=pdb2pqr_bin, apbs_bin=apbs_bin, potential_dir=potential_dir)
+    if dssp_dat:
+        result = get_aa_charge(dssp_dat)
+        if ph_grid is None:
+            return [struc_path.stem, result[1], result[0], charge]
+        scan = titration.ph_scan(titration.get_pka(struc_path), dssp_dat, ph_grid)
+        return [struc_path.stem, result[1], result[0], charge, scan]
+
 
+def surface_params(dssp_bin, pdb2pqr_bin, backend="dssp", point_number=SASA_POINTS, ph_grid=None):
+    """Everything the surface results depend on, see `result_store.map_stored`."""
+    # rows: layout of the stored rows, charged residues carry their chain since 2
+    params = {"backend": backend, "pdb2pqr": protonation.pdb2pqr_version(pdb2pqr_bin), "rows": 2}
+    if backend == "native":
+        params.update(point_number=point_number, **result_store.package_versions("biotite"))
+    else:
+        params["dssp_bin"] = dssp_bin
+    if ph_grid is not None:
+        params.update(ph_grid=[float(ph) for ph in ph_grid], propka=titration.propka_version())
+    return params
 
-def run(structure_dir, dssp_bin, pdb2pqr_bin, apbs_bin):
+
+def run(structure_dir, dssp_bin, pdb2pqr_bin, apbs_bin, workers=1, backend="dssp", point_number=SASA_POINTS,
+        potential_dir=None, ph_grid=None, store=None, on_result=None):
+    """
+    Surface charged residues and net charge of every structure in `structure_dir`
+    (any `structure_source` input).
+
+    backend: "dssp" (external mkdssp) or "native" (biotite SASA and P-SEA)
+    potential_dir: if given, APBS writes the electrostatic potential (.dx) of
+        every structure there
+    ph_grid: if given, every row gets a fifth element with the net charge and
+        surface charged residue percentages at these pH values, see `titration.ph_scan`
+    store: ResultStore, only structures without stored results are computed
+    on_result: called as on_result(index, row) as soon as a structure is done, in
+        completion order; rows are then not kept and nothing is returned
+    """
+    if backend not in SURFACE_BACKENDS:
+        raise ValueError(f"backend should be one of {SURFACE_BACKENDS}")
     logger.info('Analyzing surface charged residues...')
-    ret = []
-    pdb_files = list(Path(structure_dir).glob("*.pdb"))
-    for struc_path in tqdm(pdb_files, desc='Computing surface charged residues'):
-        file_name = struc_path.stem
+    pdb_files = structure_source.list_structures(structure_dir)
+    if potential_dir:
+        # APBS has to run for every structure to write its potential
+        store = None
+    params = surface_params(dssp_bin, pdb2pqr_bin, backend=backend, point_number=point_number, ph_grid=ph_grid)
+
+    def named(index, row):
+        # stored rows may come from an identical structure under another file name
+        return [structure_source.stem(pdb_files[index]), *row[1:]] if row is not None else None
+
+    row_callback = (lambda index, row: on_result(index, named(index, row))) if on_result is not None else None
+    ret = result_store.map_stored(store, "surface", params, _structure_surface, pdb_files, workers=workers,
+                                  desc='Computing surface charged residues', on_result=row_callback,
+                                  dssp_bin=dssp_bin, pdb2pqr_bin=pdb2pqr_bin, apbs_bin=apbs_bin,
+                                  backend=backend, point_number=point_number, potential_dir=potential_dir,
+                                  ph_grid=ph_grid)
+    if on_result is None:
+        return [row for row in (named(index, row) for index, row in enumerate(ret)) if row is not None]
+
+
+def compare_backends(structure_dir, dssp_bin, point_number=SASA_POINTS, tolerance=0.05):
+    """
+    Benchmark the native backend against DSSP.
+
+    Returns per-structure runtimes of both backends, the mean and maximum
+    absolute difference of relative accessibility, the fraction of residues
+    within `tolerance`, and whether both give the same surface charged residues.
+    """
+    report = []
+    for struc_path in sorted(Path(structure_dir).glob("*.pdb")):
+        start = time.perf_counter()
         dssp_dat = get_dssp_dat(struc_path, dssp_bin=dssp_bin)
-        charge = get_charges(struc_path, pdb2pqr_bin=pdb2pqr_bin, apbs_bin=apbs_bin)
-        if dssp_dat:
-            result = get_aa_charge(dssp_dat)
-            ret.append([file_name, result[1], result[0], charge])
-    return ret
+        dssp_time = time.perf_counter() - start
+        start = time.perf_counter()
+        native_dat = get_native_dat(struc_path, point_number=point_number)
+        native_time = time.perf_counter() - start
+        if not dssp_dat or not native_dat:
+            continue
+
+        dssp_acc = {res[0]: res[3] for res in dssp_dat if res[3] != 'NA'}
+        native_acc = {res[0]: res[3] for res in native_dat if not np.isnan(res[3])}
+        shared = sorted(dssp_acc.keys() & native_acc.keys())
+        diff = np.abs(np.array([dssp_acc[i] for i in shared]) - np.array([native_acc[i] for i in shared]))
+        report.append({
+            "name": struc_path.stem,
+            "dssp_time": dssp_time,
+            "native_time": native_time,
+            "mean_diff": float(diff.mean()),
+            "max_diff": float(diff.max()),
+            "within_tolerance": float((diff <= tolerance).mean()),
+            "same_charged_residues": get_aa_charge(dssp_dat)[1] == get_aa_charge(native_dat)[1],
+        })
+    return report
 
 if __name__ == '__main__':
     structure_dir = r"/Users/douzhixin/Developer/qProtein2/Data/pdb"
     dssp_bin = "mkdssp"
     pdb2pqr_bin = "pdb2pqr"
     apbs_bin = "apbs"
-    ret = run(structure_dir, dssp_bin, pdb2pqr_bin, apbs_bin)
-    print(ret)
+    for row in compare_backends(structure_dir, dssp_bin):
+        print(row)
@@ -0,0 +1,194 @@
+"""
+# ------------------------------------------------------------------------------
+# Author:    Dou Zhixin
+# Email:     bj600800@gmail.com
+# DATE:      2025/03/08
+
+# Description: Per-structure context shared by the interaction modules.
+The structure is parsed once; atom masks, the protonated copy and one spatial
+index over all interaction atoms are built on first use and reused by the
+hydrogen bond, salt bridge, disulfide bond and hydrophobic cluster modules.
+# ------------------------------------------------------------------------------
+"""
+import numpy as np
+import biotite.structure as struc
+
+from qprotein.feature import protonation
+from qprotein.utilities import structure_source
+
+POSITIVE_ATOMS = {
+    "HIS": ("ND1", "NE2"),
+    "HSD": ("ND1", "NE2"),
+    "HSE": ("ND1", "NE2"),
+    "HSP": ("ND1", "NE2"),
+    "HIE": ("ND1", "NE2"),
+    "HIP": ("ND1", "NE2"),
+    "HID": ("ND1", "NE2"),
+    "LYS": ("NZ",),
+    "ARG": ("NH1", "NH2")
+}
+
+NEGATIVE_ATOMS = {
+    "ASP": ("OD1", "OD2"),
+    "GLU": ("OE1", "OE2")
+}
+
+HYDROPHOBIC_RESIDUES = ["ILE", "LEU", "VAL"]
+HYDROPHOBIC_ATOMS = ["CB", "CG1", "CG2", "CD1", "CD2"]
+
+# cell size of the shared index; queries work at any radius
+INDEX_CELL_SIZE = 5.0
+# Verlet skin of the trajectory candidates: the cell list is rebuilt once an
+# atom has moved more than half of it from the frame the list was built on
+VERLET_SKIN = 2.0
+
+
+def charged_mask(structure, label):
+    """
+    Boolean mask of the atoms listed in a residue name -> atom names table.
+    """
+    mask = np.zeros(structure.array_length(), dtype=bool)
+    for res_name, atom_names in label.items():
+        mask |= (structure.res_name == res_name) & np.isin(structure.atom_name, atom_names)
+    return mask
+
+
+def hydrophobic_mask(structure):
+    return np.isin(structure.res_name, HYDROPHOBIC_RESIDUES) & np.isin(structure.atom_name, HYDROPHOBIC_ATOMS)
+
+
+MASKS = {
+    "canonical": struc.filter_canonical_amino_acids,
+    "positive": lambda structure: charged_mask(structure, POSITIVE_ATOMS),
+    "negative": lambda structure: charged_mask(structure, NEGATIVE_ATOMS),
+    "sg": lambda structure: (structure.res_name == "CYS") & (structure.atom_name == "SG"),
+    "hydrophobic": hydrophobic_mask,
+}
+
+# atoms of the shared spatial index
+INDEXED_MASKS = ("positive", "negative", "sg", "hydrophobic")
+
+
+class StructureContext:
+    """
+    A structure parsed once, with cached masks, protonated copies and one
+    spatial index usable at several radii.
+
+    Parameters
+    ----------
+    atom_array : AtomArray
+        The parsed structure.
+    path : str or Path, optional
+        Structure file, needed for protonation backends that work on files
+        and for the protonation cache.
+    """
+
+    def __init__(self, atom_array, path=None):
+        self.atoms = atom_array
+        self.path = path
+        self._masks = {}
+        self._protonated = {}
+        self._cell_list = None
+        self._length = None
+
+    @classmethod
+    def load(cls, path):
+        return cls(structure_source.load(path), path)
+
+    @classmethod
+    def of(cls, structure):
+        """Wrap an AtomArray, or return a StructureContext unchanged."""
+        return structure if isinstance(structure, cls) else cls(structure)
+
+    @property
+    def length(self):
+        """Number of unique residue ids."""
+        if self._length is None:
+            self._length = len(np.unique(self.atoms.res_id))
+        return self._length
+
+    def mask(self, name):
+        """Cached boolean atom mask, see `MASKS`."""
+        if name not in self._masks:
+            self._masks[name] = MASKS[name](self.atoms)
+        return self._masks[name]
+
+    def indices(self, name):
+        return np.where(self.mask(name))[0]
+
+    @property
+    def cell_list(self):
+        if self._cell_list is None:
+            selection = np.zeros(self.atoms.array_length(), dtype=bool)
+            for name in INDEXED_MASKS:
+                selection |= self.mask(name)
+            self._cell_list = struc.CellList(self.atoms, cell_size=INDEX_CELL_SIZE, selection=selection)
+        return self._cell_list
+
+    def _pairs(self, cell_list, coord, query, target, radius):
+        query_indices = self.indices(query)
+        if len(query_indices) == 0:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        partners = cell_list.get_atoms(coord[query_indices], radius=radius)
+        rows, cols = np.nonzero(partners != -1)
+        partners = partners[rows, cols].astype(int)
+        keep = self.mask(target)[partners]
+        return query_indices[rows][keep], partners[keep]
+
+    def neighbours(self, query, target, radius):
+        """
+        All atom pairs between two masks within `radius` from one index query.
+
+        Parameters
+        ----------
+        query, target : str
+            Mask names of the query and partner atoms, see `INDEXED_MASKS`.
+        radius : float
+            Search radius (inclusive).
+
+        Returns
+        -------
+        tuple of ndarray
+            Query and partner atom indices of every pair.
+        """
+        return self._pairs(self.cell_list, self.atoms.coord, query, target, radius)
+
+    def candidates(self, query, target, radius, coord, skin=VERLET_SKIN):
+        """
+        Atom pairs between two masks that may be within `radius` in any frame.
+
+        Verlet list: pairs within `radius` + `skin` of a reference frame cover
+        every frame in which no atom has moved more than `skin` / 2 from it.
+        The cell list is rebuilt on the first frame beyond that, so the search
+        radius stays fixed however far the structure drifts. The caller
+        filters the candidates per frame.
+
+        Parameters
+        ----------
+        coord : ndarray, shape=(m, n, 3)
+            Coordinates of m frames of this structure.
+        skin : float
+            Verlet skin in Angstrom.
+        """
+        selection = self.mask(query) | self.mask(target)
+        if not selection.any():
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        n_atoms = self.atoms.array_length()
+        pair_codes = []
+        frame = 0
+        while frame < len(coord):
+            reference = coord[frame]
+            cell_list = struc.CellList(reference, cell_size=INDEX_CELL_SIZE, selection=selection)
+            query_atoms, target_atoms = self._pairs(cell_list, reference, query, target, radius + skin)
+            pair_codes.append(query_atoms * n_atoms + target_atoms)
+            shift = np.sqrt(((coord[frame + 1:, selection] - reference[selection]) ** 2).sum(axis=-1)).max(axis=-1)
+            moved = np.nonzero(shift > skin / 2)[0]
+            frame = frame + 1 + moved[0] if len(moved) else len(coord)
+        pair_codes = np.unique(np.concatenate(pair_codes))
+        return pair_codes // n_atoms, pair_codes % n_atoms
+
+    def protonated(self, backend="cli"):
+        """Protonated copy of the structure, computed once per backend."""
+        if backend not in self._protonated:
+            self._protonated[backend] = protonation.protonate(self.path, backend=backend, structure=self.atoms)
+        return self._protonated[backend]
@@ -12,6 +12,94 @@ Original code source by Sphinx-Gallery: https://www.biotite-python.org/examples/
 import numpy as np
 import biotite.structure as struc
 
+from qprotein.feature.context import StructureContext
+
+
+def cb_lookup(structure, sg_indices):
+    """
+    CB atom index of the residue of every SG atom (-1 for incomplete residues).
+
+    The residue -> CB index is built once from the cysteine CB atoms, so no
+    per-pair rescans of the whole structure are needed.
+    """
+    cb_indices = np.where((structure.res_name == "CYS") & (structure.atom_name == "CB"))[0]
+    residue_cb = {}
+    for idx, key in zip(cb_indices, zip(structure.chain_id[cb_indices], structure.res_id[cb_indices])):
+        residue_cb.setdefault(key, idx)
+    return np.array([residue_cb.get(key, -1)
+                     for key in zip(structure.chain_id[sg_indices], structure.res_id[sg_indices])], dtype=int)
+
+
+def _candidate_bonds(context, sg1, sg2):
+    """Keep each SG pair once (i < j), skip itself and residues without CB."""
+    sg_indices = context.indices("sg")
+    cb = np.full(context.atoms.array_length(), -1, dtype=int)
+    cb[sg_indices] = cb_lookup(context.atoms, sg_indices)
+    cb1, cb2 = cb[sg1], cb[sg2]
+    keep = (sg1 < sg2) & (cb1 != -1) & (cb2 != -1)
+    return sg1[keep], sg2[keep], cb1[keep], cb2[keep]
+
+
+def _bond_mask(coord, sg1, sg2, cb1, cb2, distance, distance_tol, dihedral, dihedral_tol):
+    """
+    Geometric criteria of candidate bonds; `coord` is one frame (n, 3) or
+    several frames (m, n, 3), the mask has the matching leading shape.
+    """
+    bond_dist = struc.distance(coord[..., sg1, :], coord[..., sg2, :])
+    bond_dihed = np.abs(np.rad2deg(struc.dihedral(coord[..., cb1, :], coord[..., sg1, :],
+                                                  coord[..., sg2, :], coord[..., cb2, :])))
+    cond_dist = ((distance - distance_tol) < bond_dist) & (bond_dist < (distance + distance_tol))
+    cond_dihed = ((dihedral - dihedral_tol) < bond_dihed) & (bond_dihed < (dihedral + dihedral_tol))
+    return cond_dist & cond_dihed
+
+
+def _detect_bonds(context, distance, distance_tol, dihedral, dihedral_tol):
+    """
+    Batched disulfide bond search.
+
+    All SG-SG candidate pairs come from one query of the shared spatial
+    index; distances and CB-SG-SG-CB dihedrals are computed for every
+    candidate at once.
+
+    Returns
+    -------
+    ndarray, dtype=int, shape=(n, 2)
+        SG atom index pairs (i < j), sorted by i then j.
+    """
+    if len(context.indices("sg")) < 2:
+        return np.zeros((0, 2), dtype=int)
+
+    sg1, sg2, cb1, cb2 = _candidate_bonds(context, *context.neighbours("sg", "sg", distance + distance_tol))
+    mask = _bond_mask(context.atoms.coord, sg1, sg2, cb1, cb2, distance, distance_tol, dihedral, dihedral_tol)
+    bonds = np.stack([sg1, sg2], axis=1)[mask]
+    return bonds[np.lexsort((bonds[:, 1], bonds[:, 0]))]
+
+
+def occupancy(stack, distance=2.05, distance_tol=0.05, dihedral=90, dihedral_tol=15, context=None):
+    """
+    Disulfide bonds in every frame of an AtomArrayStack.
+
+    Parameters
+    ----------
+    stack : AtomArrayStack
+        Frames of one structure.
+    context : StructureContext, optional
+        Context of the topology, to reuse atom masks between stacks.
+
+    Returns
+    -------
+    bonds : ndarray, dtype=int, shape=(n, 2)
+        SG atom index pairs formed in at least one frame.
+    mask : ndarray, dtype=bool, shape=(n, m)
+        Whether each bond is formed in each frame.
+    """
+    context = context or StructureContext(stack[0])
+    candidates = context.candidates("sg", "sg", distance + distance_tol, stack.coord)
+    sg1, sg2, cb1, cb2 = _candidate_bonds(context, *candidates)
+    mask = _bond_mask(stack.coord, sg1, sg2, cb1, cb2, distance, distance_tol, dihedral, dihedral_tol).T
+    formed = mask.any(axis=1)
+    return np.stack([sg1, sg2], axis=1)[formed], mask[formed]
+
 
 def run(
         structure,
@@ -27,7 +115,7 @@ def run(
 
     Parameters
     ----------
-    structure : AtomArray or AtomArrayStack
+    structure : AtomArray or StructureContext
         Biotite structure object.
     distance : float
         Ideal SG–SG bond distance.
@@ -54,68 +142,15 @@ def run(
     if extended_tol:
         distance_tol = 3.0
 
-    disulfide_bonds = []
-
-    # Mask SG atoms in cysteine
-    sulfide_mask = (structure.res_name == "CYS") & (structure.atom_name == "SG")
-
-    # Speed up neighbor search
-    cell_list = struc.CellList(
-        structure,
-        cell_size=distance + distance_tol,
-        selection=sulfide_mask
-    )
-
-    sulfide_indices = np.where(sulfide_mask)[0]
-
-    for i in sulfide_indices:
-        partners = cell_list.get_atoms(
-            coord=structure.coord[i],
-            radius=distance + distance_tol
-        )
-
-        for j in partners:
-            if i == j:
-                continue  # skip itself
-
-            sg1 = structure[i]
-            sg2 = structure[j]
-
-            # Retrieve CB atoms
-            cb1 = structure[
-                (structure.chain_id == sg1.chain_id) &
-                (structure.res_id  == sg1.res_id) &
-                (structure.atom_name == "CB")
-            ]
-            cb2 = structure[
-                (structure.chain_id == sg2.chain_id) &
-                (structure.res_id  == sg2.res_id) &
-                (structure.atom_name == "CB")
-            ]
-
-            if len(cb1) == 0 or len(cb2) == 0:
-                continue  # skip incomplete residues
-
-            bond_dist = struc.distance(sg1, sg2)
-            bond_dihed = abs(np.rad2deg(struc.dihedral(cb1, sg1, sg2, cb2)))
-
-            # geometric criteria
-            cond_dist = (distance - distance_tol) < bond_dist < (distance + distance_tol)
-            cond_dihed = (dihedral - dihedral_tol) < bond_dihed < (dihedral + dihedral_tol)
-
-            if cond_dist and cond_dihed:
-                # Always store sorted tuple to avoid duplicates
-                bond_tuple = tuple(sorted([
-                    (int(i) + 1, int(sg1.res_id)),
-                    (int(j) + 1, int(sg2.res_id))
-                ]))
-
-                if bond_tuple not in disulfide_bonds:
-                    disulfide_bonds.append(bond_tuple)
+    context = StructureContext.of(structure)
+    structure = context.atoms
+    bonds = _detect_bonds(context, distance, distance_tol, dihedral, dihedral_tol)
+    disulfide_bonds = [((int(i) + 1, int(res_i)), (int(j) + 1, int(res_j)))
+                       for (i, j), (res_i, res_j) in zip(bonds, structure.res_id[bonds])]
 
     # Return mode selector
     if return_mode == "frequency":
-        unique_res_ids_length = len(set(structure.res_id))
+        unique_res_ids_length = context.length
         return len(disulfide_bonds) / unique_res_ids_length if unique_res_ids_length > 0 else 0.0, unique_res_ids_length
 
     elif return_mode == "pairs":
@@ -1,124 +1,125 @@
-import os
-import subprocess
-import tempfile
 import warnings
 
 import numpy as np
 import biotite.structure as struc
-import biotite.structure.io as strucio
 from biotite.structure import hbond, angle, distance
 
+from qprotein.feature import protonation
+from qprotein.feature.context import StructureContext
+
 warnings.filterwarnings("ignore")
 
-def add_hydrogens(input_pdb):
+def add_hydrogens(input_pdb, backend="cli", structure=None):
     """
-    Use pdb2pqr to protonate the structure and output a temporary pdb file.
+    Protonate the structure with the chosen backend, see `protonation.BACKENDS`.
     """
-    pqr_temp = tempfile.NamedTemporaryFile(delete=False)
-    pqr_temp_path = pqr_temp.name
-    pqr_temp.close()
-
-    pdb_out_temp = tempfile.NamedTemporaryFile(delete=False)
-    pdb_out_path = pdb_out_temp.name + ".pdb"
-    pdb_out_temp.close()
+    return protonation.protonate(input_pdb, backend=backend, structure=structure)
 
-    pdb2pqr_cmd = [
-        "pdb2pqr",
-        "--nodebump",
-        "--protonate-all",
-        "--ff=AMBER",
-        "--log-level", "CRITICAL",
-        "--titration-state-method", "propka",
-        "--pdb-output", pdb_out_path,
-        input_pdb,
-        pqr_temp_path
-    ]
+def _atom_keys(structure, indices=None):
+    if indices is None:
+        indices = np.arange(structure.array_length())
+    keys = np.empty(len(indices), dtype=[("chain_id", "U4"), ("res_id", int), ("atom_name", "U6")])
+    keys["chain_id"] = structure.chain_id[indices]
+    keys["res_id"] = structure.res_id[indices]
+    keys["atom_name"] = structure.atom_name[indices]
+    return keys
 
-    subprocess.run(pdb2pqr_cmd, check=True)
 
-    os.remove(pqr_temp_path)
+def map_atoms(reference, query, indices):
+    """
+    Map atoms of `query` onto `reference` by (chain_id, res_id, atom_name).
 
-    return pdb_out_path
+    All keys are resolved in one vectorized step over a sorted key index
+    instead of a full-array mask per atom.
 
-def calculate_hbonds(pdb_original, pdb_h, return_mode):
+    Returns
+    -------
+    ndarray, dtype=int, shape=indices.shape
+        Atom index in `reference`, -1 if the atom does not exist there.
+    """
+    indices = np.asarray(indices)
+    ref_keys = _atom_keys(reference)
+    query_keys = _atom_keys(query, indices.ravel())
+    unique_keys, inverse = np.unique(np.concatenate([ref_keys, query_keys]), return_inverse=True)
+    inverse = inverse.ravel()
+    lookup = np.full(len(unique_keys), -1, dtype=int)
+    # reversed assignment keeps the first atom for duplicated keys
+    lookup[inverse[:len(ref_keys)][::-1]] = np.arange(len(ref_keys))[::-1]
+    return lookup[inverse[len(ref_keys):]].reshape(indices.shape)
+
+
+def calculate_hbonds(stack, stack_h, return_mode, return_geometry=False):
     """
     Unified hydrogen bond calculation:
 
+    stack:   original structure
+    stack_h: protonated structure
     return_mode:
         "frequency" → return (#hbonds / length)
         "pairs"     → return list of donor/acceptor atom/residue pairs
+    return_geometry:
+        frequency mode only, additionally return a dict of per-bond arrays:
+        "donor"/"acceptor" atom indices in the original structure (-1 if
+        missing there), "angle" (D-H...A, degree) and "distance" (H...A)
     """
-    stack = strucio.load_structure(pdb_original)
     residue_ids, _ = struc.get_residues(stack)
     length = len(residue_ids)
 
-    stack_h = strucio.load_structure(pdb_h)
-
     triplets_h = hbond(stack_h)  # triplet: (donor_idx, H_idx, acceptor_idx)
 
     if return_mode == "pairs":
-
-        hbonds = []
-
-        for bond in triplets_h:
-            donor = bond[0]
-            acceptor = bond[2]
-
-            donor_res = int(stack_h[donor].res_id)
-            acceptor_res = int(stack_h[acceptor].res_id)
-
-            donor_atom = donor + 1
-            acceptor_atom = acceptor + 1
-
-            pair = {(donor_atom, donor_res), (acceptor_atom, acceptor_res)}
-
-            if pair not in hbonds:
-                hbonds.append(list(pair))
-
+        donor_acceptor = triplets_h[:, [0, 2]]
+        res_ids = stack_h.res_id[donor_acceptor]
+        hbonds = [[(int(donor) + 1, int(donor_res)), (int(acceptor) + 1, int(acceptor_res))]
+                  for (donor, acceptor), (donor_res, acceptor_res) in zip(donor_acceptor, res_ids)]
         return hbonds
 
     elif return_mode == "frequency":
-        donor_acceptor = [(list(stack_h[bond].res_id[::2]),
-                           list(stack_h[bond].atom_name[::2])) for bond in triplets_h]
-
-        triplets = []
-        for res_id_list, atom_name_list in donor_acceptor:
-            idx_pair = []
-            for i in range(2):
-                mask = (stack.res_id == int(res_id_list[i])) & \
-                       (stack.atom_name == atom_name_list[i])
-                idx_pair.append(np.where(mask)[0])
-            idx_pair = np.concatenate(idx_pair)
-            triplets.append(idx_pair)
-
-        triplets = np.array(triplets)
-        donor = stack_h[triplets_h[:, 0]]
-        donor_h = stack_h[triplets_h[:, 1]]
-        acceptor = stack_h[triplets_h[:, 2]]
-
-        theta = angle(donor, donor_h, acceptor)
-        degree = np.rad2deg(theta)
-        dist = distance(donor_h, acceptor)
-
-        zip_results = list(zip(degree, dist, triplets))
-
-        return len(zip_results) / length, length
+        frequency = len(triplets_h) / length
+        if not return_geometry:
+            return frequency, length
+
+        donor_acceptor = map_atoms(stack, stack_h, triplets_h[:, [0, 2]])
+        coord = stack_h.coord
+        donor = coord[triplets_h[:, 0]]
+        donor_h = coord[triplets_h[:, 1]]
+        acceptor = coord[triplets_h[:, 2]]
+
+        geometry = {
+            "donor": donor_acceptor[:, 0],
+            "acceptor": donor_acceptor[:, 1],
+            "angle": np.rad2deg(angle(donor, donor_h, acceptor)),
+            "distance": distance(donor_h, acceptor),
+        }
+        return frequency, length, geometry
 
     else:
         raise ValueError("return_mode must be 'frequency' or 'pairs'")
 
-def run(structure_path, return_mode):
+def occupancy(stack):
     """
-    High-level unified H-bond analysis function.
-    Adds hydrogens, computes H-bonds, then removes temporary files.
+    Hydrogen bonds in every frame of an AtomArrayStack with explicit hydrogens.
+
+    Returns
+    -------
+    triplets : ndarray, dtype=int, shape=(n, 3)
+        (donor, hydrogen, acceptor) atom indices formed in at least one frame.
+    mask : ndarray, dtype=bool, shape=(n, m)
+        Whether each hydrogen bond is formed in each frame.
     """
+    triplets, mask = hbond(stack)
+    return triplets, mask.T
 
-    pdb_h = add_hydrogens(structure_path)
-    try:
-        result = calculate_hbonds(structure_path, pdb_h, return_mode=return_mode)
-    finally:
-        if os.path.exists(pdb_h):
-            os.remove(pdb_h)
-
-    return result
+def run(structure_path, return_mode, backend="cli", return_geometry=False):
+    """
+    High-level unified H-bond analysis function.
+    Adds hydrogens with the chosen protonation backend, then computes H-bonds.
 
+    structure_path: structure file or StructureContext
+    """
+    if isinstance(structure_path, StructureContext):
+        context = structure_path
+    else:
+        context = StructureContext.load(structure_path)
+    structure_h = context.protonated(backend)
+    return calculate_hbonds(context.atoms, structure_h, return_mode=return_mode, return_geometry=return_geometry)
@@ -10,9 +10,12 @@
 import warnings
 
 import biotite.structure as struc
-import networkx as nx
 import numpy as np
 from biotite.structure.info import vdw_radius_single
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from qprotein.feature.context import StructureContext
 
 warnings.filterwarnings("ignore", category=FutureWarning)
 warnings.filterwarnings("ignore", category=UserWarning)
@@ -29,66 +32,108 @@ def resi_area():
 
 
 def detect_hydrophobic_cluster(structure, bias=1.1):
+    """
+    Residue pairs with hydrophobic side-chain carbons in contact.
+
+    All contacts come from one query of the shared spatial index; no
+    per-atom `Atom` objects are created.
+
+    Residues are identified by (chain_id, res_id), so residues with the same
+    number on different chains stay apart.
+
+    Returns
+    -------
+    res_pairs : ndarray, dtype=int, shape=(n, 2)
+        Unique pairs of indices into `residues`, lower index first.
+    residues : list of tuple
+        (chain_id, res_id, res_name) of the hydrophobic residues, sorted by
+        chain and residue id.
+    """
     r_vdw = vdw_radius_single("C")
     hydropho_dist = r_vdw * 2 + bias  # hydropho_dist==4.5
 
-    hydrophobic_mask = np.isin(structure.res_name, ["ILE", "LEU", "VAL"]) & np.isin(structure.atom_name,
-                                                                                    ["CB", "CG1", "CG2", "CD1", "CD2"])
-    cell_list = struc.CellList(
-        structure,
-        cell_size=hydropho_dist,
-        selection=hydrophobic_mask
-    )
-
-    res_pairs = set()
-    for atom_idx in np.where(hydrophobic_mask)[0]:
-        target_res_id = structure[atom_idx].res_id
-        target_res_name = structure[atom_idx].res_name
-        atoms_in_cellist = cell_list.get_atoms(coord=structure.coord[atom_idx], radius=hydropho_dist)
-        potential_bond_partner_indices = [idx for idx in atoms_in_cellist if structure[idx].res_id != target_res_id]
-        for potential_atom_idx in potential_bond_partner_indices:
-            potential_res_id = structure[potential_atom_idx].res_id
-            potential_res_name = structure[potential_atom_idx].res_name
-            res_pairs.add(tuple(sorted([(target_res_id, target_res_name),
-                                        (potential_res_id, potential_res_name)])))
-    return list(sorted(res_pairs))
-
-
-def create_hydrophobic_graph(res_pairs):
-    graph = nx.Graph()
-    res_list = sorted([i for res_pair in res_pairs for i in res_pair])
-
-    for res in res_list:
-        graph.add_node(res[0], res_name=res[1])
-
-    for res1, res2 in res_pairs:
-        res1_id, res2_id = res1[0], res2[0]
-        graph.add_edge(res1_id, res2_id)
-
-    return graph
-
-
-def calculate_weighted_sum_of_clusters(G):
+    context = StructureContext.of(structure)
+    structure = context.atoms
+    indices = context.indices("hydrophobic")
+    keys = np.rec.fromarrays([structure.chain_id[indices], structure.res_id[indices]], names="chain_id,res_id")
+    keys, first, node = np.unique(keys, return_index=True, return_inverse=True)
+    residues = [(str(chain_id), int(res_id), str(res_name))
+                for (chain_id, res_id), res_name in zip(keys.tolist(), structure.res_name[indices][first])]
+    atom_node = np.full(structure.array_length(), -1)
+    atom_node[indices] = node.ravel()
+
+    atom1, atom2 = context.neighbours("hydrophobic", "hydrophobic", hydropho_dist)
+    res1 = atom_node[atom1]
+    res2 = atom_node[atom2]
+    other_res = res1 != res2
+    res_pairs = np.sort(np.stack([res1[other_res], res2[other_res]], axis=1), axis=1)
+    if len(res_pairs) == 0:
+        return np.zeros((0, 2), dtype=int), residues
+    return np.unique(res_pairs, axis=0), residues
+
+
+def occupancy(stack, bias=1.1, context=None):
+    """
+    Hydrophobic residue contacts in every frame of an AtomArrayStack.
+
+    Parameters
+    ----------
+    stack : AtomArrayStack
+        Frames of one structure.
+    context : StructureContext, optional
+        Context of the topology, to reuse atom masks between stacks.
+
+    Returns
+    -------
+    res_pairs : ndarray, dtype=int, shape=(n, 2)
+        Residue id pairs, lower residue id first, in contact in at least one frame.
+    mask : ndarray, dtype=bool, shape=(n, m)
+        Whether each residue pair is in contact in each frame.
+    """
+    hydropho_dist = vdw_radius_single("C") * 2 + bias
+
+    context = context or StructureContext(stack[0])
+    atom1, atom2 = context.candidates("hydrophobic", "hydrophobic", hydropho_dist, stack.coord)
+    res1 = context.atoms.res_id[atom1]
+    res2 = context.atoms.res_id[atom2]
+    other_res = res1 < res2  # each contact once
+    atom1, atom2 = atom1[other_res], atom2[other_res]
+    if len(atom1) == 0:
+        return np.zeros((0, 2), dtype=int), np.zeros((0, stack.stack_depth()), dtype=bool)
+
+    atom_mask = (struc.distance(stack.coord[:, atom1], stack.coord[:, atom2]) <= hydropho_dist).T
+    res_pairs, inverse = np.unique(np.stack([res1[other_res], res2[other_res]], axis=1), axis=0,
+                                   return_inverse=True)
+    mask = np.zeros((len(res_pairs), stack.stack_depth()), dtype=bool)
+    np.logical_or.at(mask, inverse.ravel(), atom_mask)
+    formed = mask.any(axis=1)
+    return res_pairs[formed], mask[formed]
+
+
+def calculate_weighted_sum_of_clusters(res_pairs, residues):
     residue_area = resi_area()
-    connected_components = nx.connected_components(G)
     cluster = {}
-    for idx, component in enumerate(connected_components):
-        if len(component) > 1:
-            component_subgraph = G.subgraph(component)
-
-            nodes = component_subgraph.nodes()
-            res_ids = [int(i) for i in nodes]
-
-            node_labels = nx.get_node_attributes(G, 'res_name')
-            res_names = [node_labels[node] for node in nodes]
-            sum_area = '{:.2f}'.format(sum([residue_area[i] for i in res_names]))
-            each_area = [residue_area[i] for i in res_names]
-            cluster[f'cluster_{idx}'] = [sum_area, res_ids, each_area]
+    if len(res_pairs) == 0:
+        return cluster
+
+    nodes, edges = np.unique(res_pairs, return_inverse=True)
+    edges = edges.reshape(-1, 2)
+    graph = coo_matrix((np.ones(len(edges)), (edges[:, 0], edges[:, 1])), shape=(len(nodes), len(nodes)))
+    _, labels = connected_components(graph, directed=False)
+
+    # components are labelled in order of their lowest node, i.e. chain and residue id
+    order = np.argsort(labels, kind="stable")
+    _, starts = np.unique(labels[order], return_index=True)
+    for idx, members in enumerate(np.split(order, starts[1:])):
+        members = [residues[i] for i in nodes[members]]
+        res_ids = [res_id for _, res_id, _ in members]
+        each_area = [residue_area[res_name] for _, _, res_name in members]
+        sum_area = '{:.2f}'.format(sum(each_area))
+        cluster[f'cluster_{idx}'] = [sum_area, res_ids, each_area]
     return cluster
 
 
 def run(atom_array):
-    res_pairs = detect_hydrophobic_cluster(atom_array)
-    Graph = create_hydrophobic_graph(res_pairs)
-    cluster = calculate_weighted_sum_of_clusters(Graph)
-    return cluster
\ No newline at end of file
+    res_pairs, residues = detect_hydrophobic_cluster(atom_array)
+    cluster = calculate_weighted_sum_of_clusters(res_pairs, residues)
+    return cluster
@@ -0,0 +1,466 @@
+"""
+# ------------------------------------------------------------------------------
+# Author:    Dou Zhixin
+# Email:     bj600800@gmail.com
+# DATE:      2025/03/02
+
+# Description: Pluggable protonation backends used before hydrogen bond search.
+    cli:     pdb2pqr command line with propka titration (original behaviour)
+    api:     pdb2pqr Python API in the calling process, set up once per process
+             and reused, structures passed in memory
+    builtin: fast geometric placement of polar hydrogens for standard residues
+# ------------------------------------------------------------------------------
+"""
+import importlib.metadata
+import io
+import logging
+import os
+import re
+import subprocess
+import tempfile
+
+import numpy as np
+import biotite.structure as struc
+import biotite.structure.io as strucio
+from biotite.structure.io.pdb import PDBFile
+
+from qprotein.utilities import cache, structure_source
+
+BACKENDS = ("cli", "api", "builtin")
+
+# pdb2pqr settings of the hydrogen bond protonation
+PDB2PQR_PARAMS = ("AMBER", "propka")
+
+_versions = {}
+
+PQR_RESIDUE = re.compile(r"([A-Za-z]?)\s*(-?\d+)([A-Za-z]?)")
+
+
+def _read_pdb_string(pdb_string):
+    return PDBFile.read(io.StringIO(pdb_string)).get_structure(model=1)
+
+
+def _to_pdb_string(structure):
+    pdb_file = PDBFile()
+    pdb_file.set_structure(structure)
+    out = io.StringIO()
+    pdb_file.write(out)
+    return out.getvalue()
+
+
+def pdb2pqr_options(ff="AMBER", titration="propka"):
+    """pdb2pqr arguments shared by the cli and api backends, part of the cache key."""
+    options = ["--nodebump", "--protonate-all", f"--ff={ff}", "--log-level", "CRITICAL"]
+    if titration:
+        options += ["--titration-state-method", titration]
+    return options
+
+
+# ------------------------------------------------------------------------------
+# cli backend
+# ------------------------------------------------------------------------------
+def cli_protonate(input_pdb, pdb2pqr_bin="pdb2pqr"):
+    """
+    Use pdb2pqr to protonate the structure and read the protonated pdb back.
+
+    Returns
+    -------
+    tuple
+        (protonated AtomArray, PQR lines)
+    """
+    pqr_temp = tempfile.NamedTemporaryFile(delete=False)
+    pqr_temp_path = pqr_temp.name
+    pqr_temp.close()
+
+    pdb_out_temp = tempfile.NamedTemporaryFile(delete=False)
+    pdb_out_path = pdb_out_temp.name + ".pdb"
+    pdb_out_temp.close()
+
+    pdb2pqr_cmd = [
+        pdb2pqr_bin,
+        *pdb2pqr_options(*PDB2PQR_PARAMS),
+        "--pdb-output", pdb_out_path,
+        str(input_pdb),
+        pqr_temp_path
+    ]
+
+    try:
+        subprocess.run(pdb2pqr_cmd, check=True)
+        with open(pqr_temp_path) as f:
+            pqr_lines = f.readlines()
+        return strucio.load_structure(pdb_out_path), pqr_lines
+    finally:
+        for path in (pqr_temp_path, pdb_out_temp.name, pdb_out_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def pdb2pqr_version(pdb2pqr_bin="pdb2pqr"):
+    """pdb2pqr version, part of every cache key."""
+    if pdb2pqr_bin not in _versions:
+        try:
+            _versions[pdb2pqr_bin] = importlib.metadata.version("pdb2pqr")
+        except importlib.metadata.PackageNotFoundError:
+            result = subprocess.run([pdb2pqr_bin, "--version"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            _versions[pdb2pqr_bin] = result.stdout.decode().strip()
+    return _versions[pdb2pqr_bin]
+
+
+def read_pqr(pqr_lines):
+    """
+    Parse PQR lines (fixed column or whitespace separated) into an AtomArray
+    with `charge` and `radius` float annotations.
+    """
+    records = [line.split() for line in pqr_lines if line.startswith(("ATOM", "HETATM"))]
+    atoms = struc.AtomArray(len(records))
+    atoms.add_annotation("charge", dtype=float)
+    atoms.add_annotation("radius", dtype=float)
+    for i, fields in enumerate(records):
+        # record, serial, atom name, residue name, [chain] residue id, x, y, z, charge, radius
+        chain_id, res_id, ins_code = PQR_RESIDUE.fullmatch(" ".join(fields[4:-5])).groups()
+        atoms.hetero[i] = fields[0] == "HETATM"
+        atoms.atom_name[i] = fields[2]
+        atoms.res_name[i] = fields[3]
+        atoms.chain_id[i] = chain_id
+        atoms.res_id[i] = int(res_id)
+        atoms.ins_code[i] = ins_code
+        atoms.element[i] = fields[2].lstrip("0123456789")[0]
+        atoms.coord[i] = [float(x) for x in fields[-5:-2]]
+        atoms.charge[i] = float(fields[-2])
+        atoms.radius[i] = float(fields[-1])
+    return atoms
+
+
+def write_pqr(atoms, pqr_path):
+    """Write an AtomArray with `charge`/`radius` annotations as whitespace separated PQR."""
+    with open(pqr_path, "w") as f:
+        for i, (atom_name, res_name, chain_id, res_id, ins_code, hetero, coord, charge, radius) in enumerate(zip(
+                atoms.atom_name, atoms.res_name, atoms.chain_id, atoms.res_id, atoms.ins_code,
+                atoms.hetero, atoms.coord, atoms.charge, atoms.radius), start=1):
+            record = "HETATM" if hetero else "ATOM  "
+            f.write(f"{record}{i:5d} {atom_name:<4s} {res_name:>3s} {chain_id:1s}{res_id:4d}{ins_code:1s}   "
+                    f"{coord[0]:8.3f} {coord[1]:8.3f} {coord[2]:8.3f} {charge:7.4f} {radius:6.4f}\n")
+        f.write("TER\nEND\n")
+
+
+# ------------------------------------------------------------------------------
+# api backend
+# ------------------------------------------------------------------------------
+class Pdb2pqrWorker:
+    """
+    pdb2pqr driven through its Python API in the calling process.
+
+    Topology definitions and arguments (the options of the cli backend) are
+    loaded once per process and reused for every structure, and structures
+    are passed as PDB text instead of files, so the interpreter start-up and
+    file round trips of the CLI are avoided.
+    """
+
+    def __init__(self, ff="AMBER", titration="propka"):
+        from pdb2pqr import io as pqr_io
+        from pdb2pqr import main as pqr_main
+        from pdb2pqr import pdb as pqr_pdb
+
+        for name in ("pdb2pqr", "propka"):
+            logging.getLogger(name).setLevel(logging.CRITICAL)
+
+        self._io = pqr_io
+        self._main = pqr_main
+        self._pdb = pqr_pdb
+        cmd = pdb2pqr_options(ff, titration)
+        self.args = pqr_main.transform_arguments(pqr_main.build_main_parser().parse_args(cmd + ["in.pdb", "out.pqr"]))
+        self.definition = pqr_io.get_definitions()
+
+    def run(self, pdb_string):
+        """
+        Protonate one structure.
+
+        Returns
+        -------
+        tuple
+            (protonated PDB text, PQR lines, propka pKa rows or None)
+        """
+        pdblist, _ = self._pdb.read_pdb(io.StringIO(pdb_string))
+        biomolecule, definition, ligand = self._main.setup_molecule(pdblist, self.definition, None)
+        biomolecule.set_termini(neutraln=self.args.neutraln, neutralc=self.args.neutralc)
+        biomolecule.update_bonds()
+        results = self._main.non_trivial(
+            args=self.args,
+            biomolecule=biomolecule,
+            ligand=ligand,
+            definition=definition,
+            is_cif=False,
+        )
+        pdb_lines = self._io.print_biomolecule_atoms(biomolecule.atoms, chainflag=self.args.keep_chain, pdbfile=True)
+        return "".join(pdb_lines), results["lines"], results["pka_df"]
+
+    def protonate(self, pdb_string):
+        """
+        Returns
+        -------
+        tuple
+            (protonated AtomArray, PQR lines)
+        """
+        pdb_text, pqr_lines, _ = self.run(pdb_string)
+        return _read_pdb_string(pdb_text), pqr_lines
+
+
+_workers = {}
+
+
+def get_worker(ff="AMBER", titration="propka"):
+    """Worker of the calling process, created on first use and kept afterwards."""
+    key = (ff, titration)
+    if key not in _workers:
+        _workers[key] = Pdb2pqrWorker(ff=ff, titration=titration)
+    return _workers[key]
+
+
+# ------------------------------------------------------------------------------
+# builtin backend
+# ------------------------------------------------------------------------------
+BOND_LENGTH = {"N": 1.01, "O": 0.96, "S": 1.34}
+ROTOR_SEARCH = 3.5
+# rotor hydrogens are tried every ROTOR_STEP degrees
+ROTOR_STEP = 30
+# N-C distance below which consecutive residues are peptide bonded
+PEPTIDE_BOND_CUTOFF = 2.0
+# SG-SG distance below which a cysteine is disulfide bonded and keeps no HG
+DISULFIDE_CUTOFF = 2.5
+
+# donor: (parent, reference, geometry, hydrogen names)
+#   bisector: sp2 donor with two heavy neighbours (parent, reference)
+#   planar:   sp2 NH2 group in the plane of parent/reference
+#   sp3:      three staggered hydrogens (NH3+)
+#   rotor:    single hydroxyl/thiol hydrogen towards the closest acceptor
+SIDECHAIN_DONORS = {
+    "ARG": {"NE": ("CD", "CZ", "bisector", ("HE",)),
+            "NH1": ("CZ", "NE", "planar", ("HH11", "HH12")),
+            "NH2": ("CZ", "NE", "planar", ("HH21", "HH22"))},
+    "ASN": {"ND2": ("CG", "OD1", "planar", ("HD21", "HD22"))},
+    "GLN": {"NE2": ("CD", "OE1", "planar", ("HE21", "HE22"))},
+    "HIS": {"NE2": ("CD2", "CE1", "bisector", ("HE2",))},
+    "LYS": {"NZ": ("CE", "CD", "sp3", ("HZ1", "HZ2", "HZ3"))},
+    "SER": {"OG": ("CB", "CA", "rotor", ("HG",))},
+    "THR": {"OG1": ("CB", "CA", "rotor", ("HG1",))},
+    "TYR": {"OH": ("CZ", "CE1", "rotor", ("HH",))},
+    "TRP": {"NE1": ("CD1", "CE2", "bisector", ("HE1",))},
+    "CYS": {"SG": ("CB", "CA", "rotor", ("HG",))},
+}
+
+
+def _unit(vectors):
+    return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+
+def _frame(donor, parent, reference):
+    """Unit bond vector parent->donor and an orthogonal vector towards reference."""
+    u = _unit(donor - parent)
+    r = reference - parent
+    v = _unit(r - np.sum(r * u, axis=-1, keepdims=True) * u)
+    return u, v
+
+
+def _place(donor, parent, reference, geometry, bond):
+    """Hydrogen positions, shape=(n_hydrogens, n_donors, 3)."""
+    if geometry == "bisector":
+        return (donor + bond * _unit(_unit(donor - parent) + _unit(donor - reference)))[np.newaxis]
+
+    u, v = _frame(donor, parent, reference)
+    w = np.cross(u, v)
+    if geometry == "planar":
+        # 120 degree bond angles in the plane, one H cis and one trans to reference
+        angles = [0.0, np.pi]
+        cos_a, sin_a = np.cos(np.deg2rad(60)), np.sin(np.deg2rad(60))
+    else:
+        # tetrahedral, staggered to reference
+        angles = [np.pi, np.pi / 3, -np.pi / 3]
+        cos_a, sin_a = np.cos(np.deg2rad(70.5)), np.sin(np.deg2rad(70.5))
+    return np.stack([
+        donor + bond * (cos_a * u + sin_a * (np.cos(phi) * v + np.sin(phi) * w))
+        for phi in angles
+    ])
+
+
+def _place_rotor(structure, cell_list, res_pos, donor_idx, parent_idx, ref_idx, bond):
+    """
+    Hydroxyl/thiol hydrogens turned towards the closest acceptor of another
+    residue, or anti to the reference atom if there is none in reach.
+    """
+    coord = structure.coord.astype(float)
+    donor, parent, reference = coord[donor_idx], coord[parent_idx], coord[ref_idx]
+    u, v = _frame(donor, parent, reference)
+    w = np.cross(u, v)
+    cos_a, sin_a = np.cos(np.deg2rad(70.5)), np.sin(np.deg2rad(70.5))
+    phis = np.deg2rad(np.arange(0, 360, ROTOR_STEP))
+    candidates = np.stack([
+        donor + bond * (cos_a * u + sin_a * (np.cos(phi) * v + np.sin(phi) * w))
+        for phi in phis
+    ])  # (phis, donors, 3)
+
+    # default: anti to reference
+    best = np.full(len(donor_idx), np.argmin(np.abs(phis - np.pi)))
+    partners = cell_list.get_atoms(donor, radius=ROTOR_SEARCH)
+    rows, cols = np.nonzero(partners != -1)
+    acceptors = partners[rows, cols]
+    other = res_pos[acceptors] != res_pos[donor_idx[rows]]
+    rows, acceptors = rows[other], acceptors[other]
+    if len(rows):
+        # closest acceptor per donor
+        dist = struc.distance(donor[rows], coord[acceptors])
+        order = np.lexsort((dist, rows))
+        rows, first = np.unique(rows[order], return_index=True)
+        target = coord[acceptors[order][first]]
+        h_dist = np.linalg.norm(candidates[:, rows] - target[np.newaxis], axis=-1)
+        best[rows] = np.argmin(h_dist, axis=0)
+    return candidates[best, np.arange(len(donor_idx))][np.newaxis]
+
+
+def _residue_lookup(structure, res_pos, atom_name):
+    """Index of `atom_name` in every residue (-1 if absent)."""
+    table = np.full(res_pos[-1] + 1, -1, dtype=int)
+    mask = structure.atom_name == atom_name
+    table[res_pos[mask]] = np.where(mask)[0]
+    return table
+
+
+def builtin_protonate(structure):
+    """
+    Add polar hydrogens to standard residues by ideal geometry.
+
+    Only hydrogens that can act in hydrogen bonds are placed: backbone NH,
+    charged N-termini, side-chain donors of ARG, ASN, GLN, HIS (HIE
+    tautomer), LYS, SER, THR, TYR, TRP and free CYS. Existing hydrogens are
+    removed first. Hydrogens are appended to the atoms of their residue.
+    """
+    structure = structure[structure.element != "H"]
+    coord = structure.coord.astype(float)
+    starts = np.zeros(structure.array_length(), dtype=bool)
+    starts[struc.get_residue_starts(structure)] = True
+    res_pos = np.cumsum(starts) - 1
+
+    donors, names, positions = [], [], []
+
+    acceptor_mask = np.isin(structure.element, ("N", "O"))
+    cell_list = struc.CellList(structure, cell_size=ROTOR_SEARCH, selection=acceptor_mask)
+
+    def add(donor_idx, parent_idx, ref_idx, geometry, h_names):
+        valid = (donor_idx != -1) & (parent_idx != -1) & (ref_idx != -1)
+        donor_idx, parent_idx, ref_idx = donor_idx[valid], parent_idx[valid], ref_idx[valid]
+        if len(donor_idx) == 0:
+            return
+        bond = BOND_LENGTH[structure.element[donor_idx[0]]]
+        if geometry == "rotor":
+            placed = _place_rotor(structure, cell_list, res_pos, donor_idx, parent_idx, ref_idx, bond)
+        else:
+            placed = _place(coord[donor_idx], coord[parent_idx], coord[ref_idx], geometry, bond)
+        for h_name, h_coord in zip(h_names, placed):
+            donors.append(donor_idx)
+            names.append(np.full(len(donor_idx), h_name, dtype="U6"))
+            positions.append(h_coord)
+
+    # backbone
+    n_idx = _residue_lookup(structure, res_pos, "N")
+    ca_idx = _residue_lookup(structure, res_pos, "CA")
+    c_idx = _residue_lookup(structure, res_pos, "C")
+    res_starts = np.where(starts)[0]
+    prev_c = np.concatenate([[-1], c_idx[:-1]])
+    same_chain = np.concatenate([[False], structure.chain_id[res_starts][1:] == structure.chain_id[res_starts][:-1]])
+    linked = same_chain & (prev_c != -1) & (n_idx != -1)
+    linked[linked] = struc.distance(coord[n_idx[linked]], coord[prev_c[linked]]) < PEPTIDE_BOND_CUTOFF
+    not_pro = structure.res_name[res_starts] != "PRO"
+    add(np.where(linked & not_pro, n_idx, -1), ca_idx, prev_c, "bisector", ("H",))
+    # chain starts are charged NH3+
+    terminal = ~linked & not_pro & (n_idx != -1)
+    add(np.where(terminal, n_idx, -1), ca_idx, c_idx, "sp3", ("H1", "H2", "H3"))
+
+    # side chains
+    sg_indices = np.where((structure.res_name == "CYS") & (structure.atom_name == "SG"))[0]
+    for res_name, donor_defs in SIDECHAIN_DONORS.items():
+        is_res = structure.res_name[res_starts] == res_name
+        if not is_res.any():
+            continue
+        for donor_name, (parent, reference, geometry, h_names) in donor_defs.items():
+            donor_idx = np.where(is_res, _residue_lookup(structure, res_pos, donor_name), -1)
+            if res_name == "CYS":
+                # no thiol hydrogen on disulfide bonded cysteines
+                for i in np.where(donor_idx != -1)[0]:
+                    if np.sum(struc.distance(coord[donor_idx[i]], coord[sg_indices]) < DISULFIDE_CUTOFF) > 1:
+                        donor_idx[i] = -1
+            add(donor_idx,
+                _residue_lookup(structure, res_pos, parent),
+                _residue_lookup(structure, res_pos, reference),
+                geometry, h_names)
+
+    if not donors:
+        return structure
+    donor_idx = np.concatenate(donors)
+    hydrogens = structure[donor_idx]
+    hydrogens.atom_name = np.concatenate(names)
+    hydrogens.element[:] = "H"
+    hydrogens.coord = np.concatenate(positions).astype(np.float32)
+
+    protonated = structure + hydrogens
+    order = np.argsort(np.concatenate([res_pos, res_pos[donor_idx]]), kind="stable")
+    return protonated[order]
+
+
+def builtin_params():
+    """Geometry of the builtin backend, e.g. as part of a result key."""
+    return {"bond_length": BOND_LENGTH, "rotor_search": ROTOR_SEARCH, "rotor_step": ROTOR_STEP,
+            "peptide_bond_cutoff": PEPTIDE_BOND_CUTOFF, "disulfide_cutoff": DISULFIDE_CUTOFF,
+            "sidechain_donors": SIDECHAIN_DONORS}
+
+
+def protonate(structure_path, backend="cli", structure=None):
+    """
+    Protonated copy of a structure.
+
+    The pdb2pqr backends are served from the protonation cache when the same
+    structure content was protonated before by the same backend with the same
+    pdb2pqr options and version.
+
+    Parameters
+    ----------
+    structure_path : str or Path
+        Structure file, used by the cli backend and to read the structure if
+        `structure` is not given.
+    backend : {"cli", "api", "builtin"}
+        Protonation backend.
+    structure : AtomArray, optional
+        Already parsed structure, passed in memory to the api and builtin backends.
+
+    Returns
+    -------
+    AtomArray
+        Structure with hydrogens.
+    """
+    if backend == "builtin":
+        if structure is None:
+            structure = structure_source.load(structure_path)
+        return builtin_protonate(structure)
+    elif backend not in BACKENDS:
+        raise ValueError(f"backend should be one of {', '.join(BACKENDS)}")
+
+    structure_cache = cache.get_cache()
+    if structure_cache is not None:
+        key = structure_cache.make_key(structure_path, "protonate", backend, *pdb2pqr_options(*PDB2PQR_PARAMS),
+                                       pdb2pqr_version())
+        cached = structure_cache.get(key)
+        if cached is not None:
+            return cache.unpack_atoms(cached, "atoms")
+
+    if backend == "cli":
+        with structure_source.local_file(structure_path) as local_path:
+            protonated, pqr_lines = cli_protonate(local_path)
+    else:
+        if structure is None:
+            pdb_string = structure_source.read_bytes(structure_path).decode()
+        else:
+            pdb_string = _to_pdb_string(structure)
+        protonated, pqr_lines = get_worker(*PDB2PQR_PARAMS).protonate(pdb_string)
+
+    if structure_cache is not None:
+        structure_cache.put(key, {**cache.pack_atoms(protonated, "atoms"),
+                                  **cache.pack_atoms(read_pqr(pqr_lines), "pqr")})
+    return protonated
@@ -10,52 +10,93 @@
 import numpy as np
 import biotite.structure as struc
 
-def detect_disulfide_bonds(structure, distance=4):
-    pos_label = {
-        "HIS": ("ND1", "NE2"),
-        "HSD": ("ND1", "NE2"),
-        "HSE": ("ND1", "NE2"),
-        "HSP": ("ND1", "NE2"),
-        "HIE": ("ND1", "NE2"),
-        "HIP": ("ND1", "NE2"),
-        "HID": ("ND1", "NE2"),
-        "LYS": ("NZ",),
-        "ARG": ("NH1", "NH2")
-    }
-
-    neg_label = {
-        "ASP": ("OD1", "OD2"),
-        "GLU": ("OE1", "OE2")
-    }
-    salt_bridges = []
-    try:
-        for pos_res_name, pos_atom_names in pos_label.items():
-            for one_pos_atom_name in pos_atom_names:
-                pos_mask = (structure.res_name == pos_res_name) & (structure.atom_name == one_pos_atom_name)
-                for neg_res_name, neg_atom_names in neg_label.items():
-                    for one_neg_atom_name in neg_atom_names:
-                        neg_mask = (structure.res_name == neg_res_name) & (structure.atom_name == one_neg_atom_name)
-                        for pos_idx in np.where(pos_mask)[0]:
-                            for neg_idx in np.where(neg_mask)[0]:
-                                pos_atom = structure[pos_idx]
-                                neg_atom = structure[neg_idx]
-                                bond_dist = struc.distance(pos_atom, neg_atom)
-                                if bond_dist < distance:
-                                    bridge = {(int(pos_idx) + 1, int(structure[pos_idx].res_id)),
-                                              (int(neg_idx) + 1, int(structure[neg_idx].res_id))}
-                                    if bridge not in salt_bridges:
-                                        salt_bridges.append(list(bridge))
-        return salt_bridges
-    except:
-        raise
-
-def run(atom_array, return_mode):
-    salt_bridges = detect_disulfide_bonds(structure=atom_array)
+from qprotein.feature.context import StructureContext
+
+
+def detect_salt_bridges(structure, distance=4):
+    """
+    Detect salt bridges with one neighbour query over all charged atoms.
+
+    Parameters
+    ----------
+    structure : AtomArray or StructureContext
+        Biotite structure object.
+    distance : float
+        Upper (exclusive) distance cutoff between the charged atoms.
+
+    Returns
+    -------
+    pairs : ndarray, dtype=int, shape=(n, 2)
+        Atom indices of the positive (column 0) and negative (column 1)
+        partner, sorted by positive then negative atom index.
+    dist : ndarray, dtype=float, shape=(n,)
+        Distance of each pair.
+    """
+    context = StructureContext.of(structure)
+    pos, neg = context.neighbours("positive", "negative", distance)
+    coord = context.atoms.coord
+    dist = struc.distance(coord[pos], coord[neg])
+    keep = dist < distance
+    pairs, dist = np.stack([pos[keep], neg[keep]], axis=1), dist[keep]
+
+    order = np.lexsort((pairs[:, 1], pairs[:, 0]))
+    return pairs[order], dist[order]
+
+
+def occupancy(stack, distance=4, context=None):
+    """
+    Salt bridges in every frame of an AtomArrayStack.
+
+    Parameters
+    ----------
+    stack : AtomArrayStack
+        Frames of one structure.
+    context : StructureContext, optional
+        Context of the topology, to reuse atom masks between stacks.
+
+    Returns
+    -------
+    pairs : ndarray, dtype=int, shape=(n, 2)
+        Positive and negative atom indices of the salt bridges formed in
+        at least one frame.
+    mask : ndarray, dtype=bool, shape=(n, m)
+        Whether each salt bridge is formed in each frame.
+    """
+    context = context or StructureContext(stack[0])
+    pos, neg = context.candidates("positive", "negative", distance, stack.coord)
+    mask = (struc.distance(stack.coord[:, pos], stack.coord[:, neg]) < distance).T
+    formed = mask.any(axis=1)
+    return np.stack([pos, neg], axis=1)[formed], mask[formed]
+
+
+def to_pairs(structure, pairs):
+    """
+    Convert an index pair array into [(atom_number, res_id), (atom_number, res_id)] lists.
+    """
+    res_ids = structure.res_id[pairs]
+    return [[(int(pos_idx) + 1, int(pos_res)), (int(neg_idx) + 1, int(neg_res))]
+            for (pos_idx, neg_idx), (pos_res, neg_res) in zip(pairs, res_ids)]
+
+
+def run(atom_array, return_mode, distance=4):
+    """
+    Salt bridges of a structure.
+
+    `distance` may be a single cutoff or a list of cutoffs. With a list, all
+    cutoffs are counted from one query at the largest cutoff and one result
+    per cutoff is returned (list of pairs, or an array of frequencies).
+    """
+    context = StructureContext.of(atom_array)
+    cutoffs = np.atleast_1d(np.asarray(distance, dtype=float))
+    pairs, dist = detect_salt_bridges(structure=context, distance=cutoffs.max())
+    within = dist[np.newaxis, :] < cutoffs[:, np.newaxis]  # (cutoffs, pairs)
+
     if return_mode == "pairs":
-        return salt_bridges
+        salt_bridges = [to_pairs(context.atoms, pairs[mask]) for mask in within]
+        return salt_bridges[0] if np.ndim(distance) == 0 else salt_bridges
     elif return_mode == "frequency":
-        length = len(set(atom_array.res_id))
-        return len(salt_bridges)/length, length
+        length = context.length
+        frequency = within.sum(axis=1) / length
+        return (frequency[0] if np.ndim(distance) == 0 else frequency), length
     else:
         raise ValueError("return_mode should be 'frequency' or 'pairs'")
-
@@ -0,0 +1,122 @@
+"""
+# ------------------------------------------------------------------------------
+# Author:    Dou Zhixin
+# Email:     bj600800@gmail.com
+# DATE:      2025/03/14
+
+# Description: pKa prediction and pH-dependent charges.
+propka runs once per structure; charges at any number of pH values follow
+from the Henderson-Hasselbalch equation over the predicted pKa values.
+# ------------------------------------------------------------------------------
+"""
+import importlib.metadata
+
+import numpy as np
+
+from qprotein.utilities import cache
+
+POSITIVE_RESIDUES = ("LYS", "ARG", "HIS")
+NEGATIVE_RESIDUES = ("ASP", "GLU")
+
+
+def propka_version():
+    """propka version, part of the cache key."""
+    try:
+        return importlib.metadata.version("propka")
+    except importlib.metadata.PackageNotFoundError:
+        return "unknown"
+
+
+def run_propka(structure_path):
+    """
+    Titratable groups of a structure predicted by propka.
+
+    Returns
+    -------
+    dict of ndarray
+        "chain_id", "res_id", "res_name" (propka residue type, "N+"/"C-"
+        for the termini), "pka" and "charge" (+1 for bases, -1 for acids)
+        of every titratable group.
+    """
+    import propka.run
+
+    molecule = propka.run.single(str(structure_path), optargs=["--quiet"], write_pka=False)
+    groups = molecule.conformations["AVR"].get_titratable_groups()
+    return {
+        "chain_id": np.array([group.atom.chain_id for group in groups], dtype="U4"),
+        "res_id": np.array([group.atom.res_num for group in groups], dtype=int),
+        "res_name": np.array([group.residue_type for group in groups], dtype="U4"),
+        "pka": np.array([group.pka_value for group in groups], dtype=float),
+        "charge": np.array([group.charge for group in groups], dtype=float),
+    }
+
+
+def get_pka(structure_path):
+    """`run_propka` through the structure cache."""
+    structure_cache = cache.get_cache()
+    if structure_cache is None:
+        return run_propka(structure_path)
+    key = structure_cache.make_key(structure_path, "pka", "propka", propka_version())
+    pka_table = structure_cache.get(key)
+    if pka_table is None:
+        pka_table = run_propka(structure_path)
+        structure_cache.put(key, pka_table)
+    return pka_table
+
+
+def charge_fractions(pka, charge, ph):
+    """
+    Henderson-Hasselbalch charge of every group at every pH.
+
+    Parameters
+    ----------
+    pka, charge : ndarray, shape=(n,)
+        pKa and charged state (+1 base, -1 acid) of the groups.
+    ph : ndarray, shape=(m,)
+        pH values.
+
+    Returns
+    -------
+    ndarray, shape=(m, n)
+        Average charge of each group, between 0 and its charged state.
+    """
+    ph = np.asarray(ph, dtype=float)[:, np.newaxis]
+    return charge / (1 + 10 ** (charge * (ph - pka)))
+
+
+def ph_scan(pka_table, dssp_dat, ph_grid, threshold=0.05):
+    """
+    Net charge and surface charged residue percentages over a pH grid.
+
+    Surface residues are selected as in `compute_surface.get_aa_charge`
+    (relative accessibility above `threshold`) and matched to the pKa table
+    by chain and residue number; each one counts with its charged fraction
+    at the given pH.
+
+    Returns
+    -------
+    dict of ndarray
+        "pH", "net_charge", "positive" and "negative" (percent of all residues).
+    """
+    ph_grid = np.asarray(ph_grid, dtype=float)
+    fractions = charge_fractions(pka_table["pka"], pka_table["charge"], ph_grid)
+
+    # last field of the residue data: (chain ID, residue number)
+    exposed = {res[-1] for res in dssp_dat if res[1] != 'X' and res[3] != 'NA' and res[3] > threshold}
+    on_surface = np.array([(str(chain_id), int(res_id)) in exposed
+                           for chain_id, res_id in zip(pka_table["chain_id"], pka_table["res_id"])], dtype=bool)
+    positive = on_surface & np.isin(pka_table["res_name"], POSITIVE_RESIDUES)
+    negative = on_surface & np.isin(pka_table["res_name"], NEGATIVE_RESIDUES)
+    total = len(dssp_dat)
+    return {
+        "pH": ph_grid,
+        "net_charge": fractions.sum(axis=1),
+        "positive": fractions[:, positive].sum(axis=1) / total * 100,
+        "negative": -fractions[:, negative].sum(axis=1) / total * 100,
+    }
+
+
+def parse_ph_grid(text):
+    """'start,stop,step' -> pH values from start to stop (inclusive)."""
+    start, stop, step = (float(value) for value in text.split(","))
+    return np.round(np.arange(start, stop + step / 2, step), 4)
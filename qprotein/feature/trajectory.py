@@ -0,0 +1,212 @@
+"""
+# ------------------------------------------------------------------------------
+# Author:    Dou Zhixin
+# Email:     bj600800@gmail.com
+# DATE:      2025/03/18
+
+# Description: Interaction occupancy over trajectories and multi-model files.
+Frames are streamed in chunks, so the trajectory is never held in memory.
+Each chunk is analysed as one AtomArrayStack and the per-frame interaction
+masks are stored bit-packed (interaction x frame).
+# ------------------------------------------------------------------------------
+"""
+import csv
+import io
+import os
+
+import numpy as np
+import biotite.structure as struc
+from biotite.structure.io.pdb import PDBFile
+
+from qprotein.feature import hbond, salt_bridge, disulfide_bond, hydrophobic
+from qprotein.feature.context import StructureContext
+from qprotein.utilities import logger
+
+logger = logger.setup_log(name=__name__)
+
+# frames per chunk, a multiple of 8 keeps packed chunks byte aligned
+CHUNK_SIZE = 256
+INTERACTIONS = ("hbond", "salt_bridge", "disulfide_bond", "hydrophobic")
+
+
+def _coord_lines(lines):
+    return np.array([(line[30:38], line[38:46], line[46:54]) for line in lines], dtype=np.float32)
+
+
+def _iter_pdb_models(pdb_path):
+    """Yield the lines of every model of a (multi-model) PDB file, one model at a time."""
+    model = []
+    with open(pdb_path) as f:
+        for line in f:
+            if line.startswith(("ATOM", "HETATM")):
+                model.append(line)
+            elif line.startswith("ENDMDL") and model:
+                yield model
+                model = []
+    if model:
+        yield model
+
+
+def iter_pdb_frames(pdb_path, chunk_size=CHUNK_SIZE):
+    """
+    Stream a multi-model PDB file.
+
+    Yields
+    ------
+    template : AtomArray
+        Topology and coordinates of the first model.
+    coord : ndarray, dtype=float32, shape=(m, n, 3)
+        Coordinates of up to `chunk_size` consecutive models.
+    """
+    template = None
+    chunk = []
+    for lines in _iter_pdb_models(pdb_path):
+        if template is None:
+            template = PDBFile.read(io.StringIO("".join(lines))).get_structure(model=1)
+        if len(lines) == template.array_length():
+            coord = _coord_lines(lines)
+        else:
+            # alternate locations: let biotite select the atoms as for the template
+            coord = PDBFile.read(io.StringIO("".join(lines))).get_structure(model=1).coord
+            if len(coord) != template.array_length():
+                raise ValueError(f"Models of {pdb_path} differ in their atoms")
+        chunk.append(coord)
+        if len(chunk) == chunk_size:
+            yield template, np.stack(chunk)
+            chunk = []
+    if chunk:
+        yield template, np.stack(chunk)
+
+
+def iter_dcd_frames(dcd_path, topology_path, chunk_size=CHUNK_SIZE):
+    """Stream a DCD trajectory with the topology of a PDB file, see `iter_pdb_frames`."""
+    import biotite.structure.io as strucio
+    from biotite.structure.io.dcd import DCDFile
+
+    template = strucio.load_structure(topology_path)
+    for coord, _, _ in DCDFile.read_iter(dcd_path, stack_size=chunk_size):
+        yield template, coord.reshape(-1, template.array_length(), 3)
+
+
+def iter_frames(trajectory_path, topology_path=None, chunk_size=CHUNK_SIZE):
+    if os.path.splitext(trajectory_path)[1].lower() == ".dcd":
+        if topology_path is None:
+            raise ValueError("DCD trajectories need a topology structure")
+        return iter_dcd_frames(trajectory_path, topology_path, chunk_size)
+    return iter_pdb_frames(trajectory_path, chunk_size)
+
+
+class OccupancyMatrix:
+    """
+    Bit-packed interaction x frame occupancy, filled chunk by chunk.
+
+    Interactions are identified by their atom (or residue) index tuple;
+    rows are created the first time an interaction is formed.
+    """
+
+    def __init__(self):
+        self._rows = {}
+        self._chunks = []
+        self.n_frames = 0
+
+    def add(self, interactions, mask):
+        rows = np.array([self._rows.setdefault(tuple(key), len(self._rows)) for key in interactions.tolist()],
+                        dtype=int)
+        self._chunks.append((self.n_frames, rows, np.packbits(mask, axis=1)))
+        self.n_frames += mask.shape[1]
+
+    def result(self):
+        """
+        Returns
+        -------
+        interactions : ndarray, dtype=int, shape=(n, k)
+            Index tuples, sorted.
+        packed : ndarray, dtype=uint8, shape=(n, ceil(frames / 8))
+            `np.packbits` of the occupancy matrix along the frame axis.
+        """
+        interactions = np.array(list(self._rows), dtype=int)
+        packed = np.zeros((len(interactions), (self.n_frames + 7) // 8), dtype=np.uint8)
+        for start, rows, bits in self._chunks:
+            packed[rows, start // 8:start // 8 + bits.shape[1]] = bits
+        if len(interactions) == 0:
+            return interactions, packed
+        order = np.lexsort(interactions.T[::-1])
+        return interactions[order], packed[order]
+
+
+def unpack(packed, n_frames):
+    """Occupancy matrix (interaction x frame) of bit-packed rows."""
+    return np.unpackbits(packed, axis=1, count=n_frames).astype(bool)
+
+
+def occupancy_fraction(packed, n_frames):
+    """Fraction of frames in which each interaction is formed."""
+    return np.unpackbits(packed, axis=1, count=n_frames).sum(axis=1) / n_frames
+
+
+def run(trajectory_path, topology_path=None, chunk_size=CHUNK_SIZE, interactions=INTERACTIONS):
+    """
+    Occupancy of the interactions over all frames of a trajectory.
+
+    Returns
+    -------
+    template : AtomArray
+        Topology of the trajectory.
+    result : dict
+        Interaction name -> (index tuples, bit-packed occupancy), see
+        `OccupancyMatrix.result`; hbond tuples are (donor, hydrogen,
+        acceptor) atoms, hydrophobic tuples residue ids, the others atoms.
+    n_frames : int
+    """
+    detectors = {
+        "hbond": lambda stack, context: hbond.occupancy(stack),
+        "salt_bridge": lambda stack, context: salt_bridge.occupancy(stack, context=context),
+        "disulfide_bond": lambda stack, context: disulfide_bond.occupancy(stack, context=context),
+        "hydrophobic": lambda stack, context: hydrophobic.occupancy(stack, context=context),
+    }
+    chunk_size = max(8, chunk_size - chunk_size % 8)
+    matrices = {name: OccupancyMatrix() for name in interactions}
+    template = context = None
+    for template, coord in iter_frames(trajectory_path, topology_path, chunk_size):
+        if context is None:
+            context = StructureContext(template)
+            if "hbond" in interactions and not (template.element == "H").any():
+                logger.warning("No hydrogen atoms in the trajectory, hydrogen bonds need explicit hydrogens")
+        stack = struc.from_template(template, coord)
+        for name in interactions:
+            matrices[name].add(*detectors[name](stack, context))
+
+    if template is None:
+        raise ValueError(f"No frames in {trajectory_path}")
+    n_frames = next(iter(matrices.values())).n_frames
+    return template, {name: matrix.result() for name, matrix in matrices.items()}, n_frames
+
+
+def save_occupancy(template, result, n_frames, out_dir):
+    """
+    Write occupancy.npz (index tuples and bit-packed matrices) and
+    occupancy.csv (one row per interaction with residues and occupancy).
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    npz_file = os.path.join(out_dir, "occupancy.npz")
+    arrays = {"n_frames": np.array(n_frames)}
+    for name, (interactions, packed) in result.items():
+        arrays[f"{name}/interactions"] = interactions
+        arrays[f"{name}/packed"] = packed
+    np.savez_compressed(npz_file, **arrays)
+
+    csv_file = os.path.join(out_dir, "occupancy.csv")
+    with open(csv_file, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["interaction", "residue 1", "residue 2", "atoms", "occupancy"])
+        for name, (interactions, packed) in result.items():
+            fractions = occupancy_fraction(packed, n_frames)
+            for key, fraction in zip(interactions, fractions):
+                if name == "hydrophobic":
+                    res1, res2 = key
+                    atoms = ""
+                else:
+                    res1, res2 = template.res_id[key[0]], template.res_id[key[-1]]
+                    atoms = "-".join(f"{template.res_name[i]}{template.res_id[i]}:{template.atom_name[i]}" for i in key)
+                writer.writerow([name, int(res1), int(res2), atoms, "{:.4f}".format(fraction)])
+    logger.info(f"Occupancy saved: {csv_file}")
@@ -5,48 +5,141 @@
 # DATE:      2023/04/14
 
 # Description: Get structures from AlphaFold structure database.
+Structures are downloaded by a bounded thread pool sharing one pooled
+session, rate limited, retried with backoff and written atomically.
 # ------------------------------------------------------------------------------
 """
-import io
+import gzip
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import requests
-from requests.adapters import Retry
-import numpy as np
-from Bio.PDB import PDBParser
+from tqdm import tqdm
 
-from qprotein.utilities import logger
+from qprotein.seq2struct import plddt
+from qprotein.utilities import http_session, logger
 
 logger = logger.setup_log(name=__name__)
 
+AFDB_URL = "https://alphafold.ebi.ac.uk/files"
+AFDB_VERSION = 6
+PLDDT_CUTOFF = plddt.PLDDT_CUTOFF
+OUTPUT_FORMATS = ("pdb", "pdb.gz")
+HEADERS = {
+	"User-Agent": "Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/70.0.3538.25 Safari/537.36 Core/1.70.3861.400 QQBrowser/10.7.4313.400",
+	"From": ""  # ALLWAYS TELLs WHO YOU ARE
+	}
+
+
+def model_url(uniprot_id, base_url=AFDB_URL, version=AFDB_VERSION):
+	return f"{base_url.rstrip('/')}/AF-{uniprot_id}-F1-model_v{version}.pdb"
+
+
+def atomic_write(path, text):
+	"""
+	Write through a temporary file in the same directory and rename, so `path`
+	is never partial. Paths ending in .gz are written gzipped.
+	"""
+	directory = os.path.dirname(os.path.abspath(path))
+	fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".part")
+	try:
+		with os.fdopen(fd, "wb") as f:
+			data = text.encode()
+			f.write(gzip.compress(data) if path.endswith(".gz") else data)
+		os.replace(tmp_path, path)
+	except BaseException:
+		os.remove(tmp_path)
+		raise
+
+
+_session = None
+
+
+def get_struct(uniprot_id, session=None, base_url=AFDB_URL, limiter=None, plddt_cutoff=PLDDT_CUTOFF,
+               trim_threshold=None, timeout=60, retries=3, backoff_factor=0.5):
+	"""
+	PDB text of the AFDB model of `uniprot_id`, None if it is missing or
+	fails the confidence filter (`plddt.filter_model`, trimmed of residues
+	below `trim_threshold` if given). Without `session` a module-wide session
+	is reused.
+
+	Network errors and `http_session.RETRY_STATUS` responses are retried up
+	to `retries` times with exponential backoff (or the server's Retry-After),
+	every attempt waiting for `limiter`, so retries keep to the rate limit.
+	"""
+	global _session
+	if session is None:
+		if _session is None:
+			_session = http_session.start_session(retries=0, headers=HEADERS)
+		session = _session
+	for attempt in range(retries + 1):
+		if limiter is not None:
+			limiter.wait()
+		delay = backoff_factor * 2 ** attempt
+		try:
+			response = session.get(model_url(uniprot_id, base_url), timeout=timeout)
+		except requests.RequestException as e:
+			reason = e
+		else:
+			if response.status_code == 200:
+				return plddt.filter_model(response.text, plddt_cutoff=plddt_cutoff, trim_threshold=trim_threshold)
+			if response.status_code not in http_session.RETRY_STATUS:
+				break
+			reason = f"HTTP {response.status_code}"
+			retry_after = response.headers.get("Retry-After", "")
+			if retry_after.isdigit():
+				delay = max(delay, int(retry_after))
+		if attempt < retries:
+			logger.info(f"Seq2Struct uniprot ID {uniprot_id} failed ({reason}), retrying")
+			time.sleep(delay)
+	logger.info(f"Seq2Struct uniprot ID failed: {uniprot_id}")
+
+
+def fetch_structs(id_list, structure_dir, concurrency=8, rate=10, base_url=AFDB_URL, retries=3,
+                  backoff_factor=0.5, plddt_cutoff=PLDDT_CUTOFF, trim_threshold=None, output_format="pdb"):
+	"""
+	Download AFDB models concurrently to `structure_dir/<id>.pdb` (or .pdb.gz).
+
+	Parameters
+	----------
+	id_list : list of str
+		UniProt accessions.
+	concurrency : int
+		Simultaneous downloads, also the connection pool size.
+	rate : float, optional
+		Maximum requests per second over all threads, None for no limit.
+	base_url : str
+		AFDB file server, e.g. a local stand-in (see `mock_afdb`).
+	trim_threshold : float, optional
+		Trim low-confidence termini and loops below this pLDDT instead of
+		rejecting the whole model, see `plddt.filter_model`.
+	output_format : {"pdb", "pdb.gz"}
+
+	Returns
+	-------
+	saved : list of str
+		IDs written to `structure_dir`.
+	"""
+	id_list = list(dict.fromkeys(id_list))
+	# retried only in `get_struct`, where every attempt waits for the rate limiter
+	session = http_session.start_session(pool_size=concurrency, retries=0, headers=HEADERS)
+	limiter = http_session.RateLimiter(rate)
+	saved = []
 
-def _start_request_session():
-	retries = Retry(total=3, backoff_factor=0.5, status_forcelist=[408, 429, 500, 502, 503, 504])
-	session = requests.Session()
-	session.mount('http://', requests.adapters.HTTPAdapter(max_retries=retries))
-	session.mount('https://', requests.adapters.HTTPAdapter(max_retries=retries))
-	return session
-
-
-def _get_bfactor(pdb_string):
-	pdb_file = io.StringIO(pdb_string)
-	parser = PDBParser(QUIET=True)
-	structure = parser.get_structure("structure", pdb_file)
-	b_factors = [atom.get_bfactor() for atom in structure.get_atoms()]
-	return np.mean(b_factors)
-
-def get_struct(uniprot_id):
-	headers = {
-		"User-Agent": "Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/70.0.3538.25 Safari/537.36 Core/1.70.3861.400 QQBrowser/10.7.4313.400",
-		"From": ""  # ALLWAYS TELLs WHO YOU ARE
-		}
-	
-	api_url = f"https://alphafold.ebi.ac.uk/files/AF-{uniprot_id}-F1-model_v6.pdb"
-	session = _start_request_session()
-	response = session.get(api_url, headers=headers)
-	if response.status_code == 200:
-		pdb_string = response.text
-		plddt = _get_bfactor(pdb_string)
-		if plddt > 70:
-			return pdb_string
-	else:
-		logger.info(f"Seq2Struct uniprot ID failed: {uniprot_id}")
+	def fetch(uniprot_id):
+		pdb_string = get_struct(uniprot_id, session=session, base_url=base_url, limiter=limiter,
+		                        plddt_cutoff=plddt_cutoff, trim_threshold=trim_threshold, retries=retries,
+		                        backoff_factor=backoff_factor)
+		if pdb_string:
+			atomic_write(os.path.join(structure_dir, f"{uniprot_id}.{output_format}"), pdb_string)
+			return uniprot_id
 
+	with session, ThreadPoolExecutor(max_workers=concurrency) as executor:
+		futures = [executor.submit(fetch, uniprot_id) for uniprot_id in id_list]
+		for future in tqdm(as_completed(futures), total=len(futures), desc="Crawling AlphaFold DB"):
+			uniprot_id = future.result()
+			if uniprot_id:
+				saved.append(uniprot_id)
+	return saved
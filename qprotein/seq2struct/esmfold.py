@@ -5,34 +5,225 @@
 # DATE:      2023/09/19
 
 # Description: Predict structure for non-structure sequences from sql.
+Sequences are folded in-process by a predictor backend, in length-sorted
+batches under a token budget. IDs already in the structure directory are
+skipped, identical sequences are folded once and written for every ID
+(`sequence.group_sequences`), and every model goes through the pLDDT
+filter and is written as soon as its batch is done.
 # ------------------------------------------------------------------------------
 """
 import os
+import time
+
 import numpy as np
-import subprocess
+from tqdm import tqdm
 
-from Bio.PDB import PDBParser
-from qprotein.utilities import logger
+from qprotein.seq2struct import afdb, plddt, sequence
+from qprotein.utilities import logger, structure_source
 
 logger = logger.setup_log(name=__name__)
 
-def _get_bfactor(pdb_file):
-	parser = PDBParser(QUIET=True)
-	structure = parser.get_structure("structure", pdb_file)
-	b_factors = [atom.get_bfactor() for atom in structure.get_atoms()]
-	return np.mean(b_factors)
-
-def run(fasta_file, structure_dir, esm_script, esm_dir):
-	cmd = ["python", esm_script, "--fasta", fasta_file, "--pdb", structure_dir, '-m', esm_dir]
-	result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-	logger.info(result.stdout.decode())
-	for query_name in os.listdir(structure_dir):
-		pdb_path = os.path.join(structure_dir, query_name)
-		if os.path.exists(pdb_path):
-			plddt = _get_bfactor(pdb_path)
-			if plddt < 70:
-				os.remove(pdb_path)
-
-					
-
-	
\ No newline at end of file
+# padded residues per batch (batch size x longest sequence)
+MAX_TOKENS = 1024
+FOLD_BACKENDS = ("esmfold", "mock")
+THREE_LETTER = {
+	"A": "ALA", "R": "ARG", "N": "ASN", "D": "ASP", "C": "CYS", "Q": "GLN", "E": "GLU", "G": "GLY",
+	"H": "HIS", "I": "ILE", "L": "LEU", "K": "LYS", "M": "MET", "F": "PHE", "P": "PRO", "S": "SER",
+	"T": "THR", "W": "TRP", "Y": "TYR", "V": "VAL",
+}
+
+
+class Predictor:
+	"""Structure predictor backend: `predict` folds a batch of sequences."""
+
+	def predict(self, sequences):
+		"""
+		Parameters
+		----------
+		sequences : list of str
+
+		Returns
+		-------
+		list of str
+			PDB text of every sequence, pLDDT in the B-factor column.
+		"""
+		raise NotImplementedError
+
+
+class ESMFoldPredictor(Predictor):
+	"""
+	ESMFold (fair-esm) in the calling process, on the GPU when available.
+
+	Parameters
+	----------
+	model_dir : str, optional
+		torch hub directory holding the ESMFold weights.
+	num_recycles : int, optional
+		Recycles of the folding trunk, the model default if None.
+	chunk_size : int, optional
+		Axial attention chunk size; smaller uses less memory for long sequences.
+	"""
+
+	def __init__(self, model_dir=None, num_recycles=None, chunk_size=None):
+		import torch
+		import esm
+
+		self._torch = torch
+		if model_dir:
+			torch.hub.set_dir(model_dir)
+		self.model = esm.pretrained.esmfold_v1().eval()
+		if torch.cuda.is_available():
+			self.model = self.model.cuda()
+		if chunk_size:
+			self.model.set_chunk_size(chunk_size)
+		self.num_recycles = num_recycles
+
+	def predict(self, sequences):
+		try:
+			with self._torch.no_grad():
+				output = self.model.infer(sequences, num_recycles=self.num_recycles)
+		except RuntimeError as e:
+			if "out of memory" not in str(e) or len(sequences) == 1:
+				raise
+			# halve the batch rather than fail the run
+			self._torch.cuda.empty_cache()
+			half = len(sequences) // 2
+			return self.predict(sequences[:half]) + self.predict(sequences[half:])
+		return self.model.output_to_pdb(output)
+
+
+class MockPredictor(Predictor):
+	"""
+	CPU stand-in for testing and benchmarking the pipeline without model
+	weights: every sequence becomes an ideal alpha-helix backbone.
+
+	Parameters
+	----------
+	seconds_per_token : float
+		Simulated cost per padded residue of a batch.
+	plddt : float
+		pLDDT of the core residues.
+	terminal_plddt : float
+		pLDDT of the first and last `terminal_fraction` of the residues.
+	"""
+
+	# (radius A, phase deg, rise A) of the backbone atoms in an alpha helix
+	HELIX_ATOMS = (("N", 1.55, -28.0, -0.95), ("CA", 2.30, 0.0, 0.0), ("C", 1.61, 28.1, 0.86),
+	               ("O", 1.76, 61.5, 2.05))
+
+	def __init__(self, seconds_per_token=0.0, plddt=90.0, terminal_plddt=40.0, terminal_fraction=0.1):
+		self.seconds_per_token = seconds_per_token
+		self.plddt = plddt
+		self.terminal_plddt = terminal_plddt
+		self.terminal_fraction = terminal_fraction
+		self.batches = []
+
+	def _model(self, seq):
+		n_terminal = int(len(seq) * self.terminal_fraction)
+		lines = []
+		serial = 1
+		for i, aa in enumerate(seq):
+			b = self.terminal_plddt if i < n_terminal or i >= len(seq) - n_terminal else self.plddt
+			for atom_name, radius, phase, rise in self.HELIX_ATOMS:
+				angle = np.radians(100.0 * i + phase)
+				x, y, z = radius * np.cos(angle), radius * np.sin(angle), 1.5 * i + rise
+				lines.append(f"ATOM  {serial:5d}  {atom_name:<3s} {THREE_LETTER.get(aa, 'UNK')} A{i + 1:4d}    "
+				             f"{x:8.3f}{y:8.3f}{z:8.3f}  1.00{b:6.2f}           {atom_name[0]}\n")
+				serial += 1
+		return "".join(lines) + "TER\nEND\n"
+
+	def predict(self, sequences):
+		self.batches.append([len(seq) for seq in sequences])
+		time.sleep(self.seconds_per_token * len(sequences) * max(len(seq) for seq in sequences))
+		return [self._model(seq) for seq in sequences]
+
+
+def get_predictor(backend="esmfold", **kwargs):
+	if backend == "esmfold":
+		return ESMFoldPredictor(**kwargs)
+	if backend == "mock":
+		return MockPredictor(**kwargs)
+	raise ValueError(f"backend should be one of {', '.join(FOLD_BACKENDS)}")
+
+
+def token_batches(records, max_tokens=MAX_TOKENS):
+	"""
+	Longest first, batches of similar length whose padded size (batch size x
+	longest sequence) stays within `max_tokens`; longer sequences fold alone.
+
+	records : list of (key, sequence)
+	"""
+	records = sorted(records, key=lambda record: len(record[1]), reverse=True)
+	batch = []
+	for record in records:
+		# the first record of a batch is its longest
+		if batch and (len(batch) + 1) * len(batch[0][1]) > max_tokens:
+			yield batch
+			batch = []
+		batch.append(record)
+	if batch:
+		yield batch
+
+
+def run(fasta_file, structure_dir, predictor=None, max_tokens=MAX_TOKENS, plddt_cutoff=plddt.PLDDT_CUTOFF,
+        trim_threshold=None, output_format="pdb"):
+	"""
+	Fold the sequences of a FASTA file into `structure_dir/<id>.pdb`.
+
+	Parameters
+	----------
+	predictor : Predictor, optional
+		Backend, `ESMFoldPredictor` by default.
+	max_tokens : int
+		Padded residues per batch, see `token_batches`.
+	trim_threshold : float, optional
+		See `plddt.filter_model`.
+	output_format : {"pdb", "pdb.gz"}
+
+	Returns
+	-------
+	dict
+		Numbers of "folded" sequences, "written" and "rejected" IDs,
+		"existing" IDs skipped, "duplicates" served by the prediction of
+		another ID and IDs "copied" from an existing model of their sequence.
+	"""
+	groups = sequence.group_sequences(sequence.get_sequence(fasta_file))
+	existing = {structure_source.stem(item): item for item in structure_source.list_structures(structure_dir)}
+	names_of = {}
+	summary = {"folded": 0, "written": 0, "rejected": 0, "existing": 0, "duplicates": 0, "copied": 0}
+	for seq, names in groups.values():
+		missing = [name for name in names if name not in existing]
+		summary["existing"] += len(names) - len(missing)
+		if not missing:
+			continue
+		if len(missing) < len(names):
+			# another ID of the sequence is already predicted
+			model = structure_source.read_bytes(existing[next(name for name in names if name in existing)])
+			for name in missing:
+				afdb.atomic_write(os.path.join(structure_dir, f"{name}.{output_format}"), model.decode())
+			summary["copied"] += len(missing)
+			continue
+		names_of[seq] = missing
+		summary["duplicates"] += len(missing) - 1
+	summary["folded"] = len(names_of)
+	logger.info(f"Folding {len(names_of)} unique sequences: {summary['existing']} IDs already predicted, "
+	            f"{summary['copied']} copied from a predicted duplicate, {summary['duplicates']} duplicate "
+	            f"sequences written from one prediction")
+	if not names_of:
+		return summary
+
+	predictor = predictor or ESMFoldPredictor()
+	with tqdm(total=len(names_of), desc="Predicting structures") as progress:
+		for batch in token_batches([(names, seq) for seq, names in names_of.items()], max_tokens):
+			models = predictor.predict([seq for _, seq in batch])
+			for (names, _), pdb_string in zip(batch, models):
+				kept = plddt.filter_model(pdb_string, plddt_cutoff=plddt_cutoff, trim_threshold=trim_threshold)
+				if kept is None:
+					summary["rejected"] += len(names)
+					continue
+				for name in names:
+					afdb.atomic_write(os.path.join(structure_dir, f"{name}.{output_format}"), kept)
+					summary["written"] += 1
+			progress.update(len(batch))
+	logger.info(f"Predicted structures: {summary['written']} written, {summary['rejected']} rejected by pLDDT")
+	return summary
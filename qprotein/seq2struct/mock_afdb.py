@@ -0,0 +1,112 @@
+"""
+# ------------------------------------------------------------------------------
+# Author:    Dou Zhixin
+# Email:     bj600800@gmail.com
+# DATE:      2025/03/24
+
+# Description: Local stand-in for the AlphaFold DB file server.
+Serves AF-<id>-F1-model_v<n>.pdb from a directory of <id>.pdb files, with
+optional latency and transient failures, to test fetch throughput and
+retries offline:
+
+	with MockAFDB("test/structure", latency=0.05, fail_every=3) as server:
+		afdb.fetch_structs(ids, out_dir, base_url=server.url)
+# ------------------------------------------------------------------------------
+"""
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MODEL_PATTERN = re.compile(r"^/(?:files/)?AF-(?P<id>[^/]+)-F1-model_v\d+\.pdb$")
+
+
+class MockAFDB:
+	"""
+	Threaded HTTP server on localhost.
+
+	Parameters
+	----------
+	structure_dir : str
+		Directory of <uniprot_id>.pdb files to serve.
+	latency : float
+		Seconds to wait before every response.
+	fail_every : int, optional
+		Answer every n-th request with 503, to exercise retries.
+	port : int
+		0 picks a free port.
+	"""
+
+	def __init__(self, structure_dir, latency=0.0, fail_every=None, port=0):
+		self.structure_dir = structure_dir
+		self.latency = latency
+		self.fail_every = fail_every
+		self.requests = 0
+		self.failures = 0
+		self.max_active = 0
+		self._active = 0
+		self._lock = threading.Lock()
+		self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+		self._server.daemon_threads = True
+		self._thread = None
+
+	@property
+	def url(self):
+		return f"http://127.0.0.1:{self._server.server_address[1]}/files"
+
+	def _handler(self):
+		server = self
+
+		class Handler(BaseHTTPRequestHandler):
+			protocol_version = "HTTP/1.1"
+
+			def do_GET(self):
+				with server._lock:
+					server.requests += 1
+					server._active += 1
+					server.max_active = max(server.max_active, server._active)
+					fail = server.fail_every and server.requests % server.fail_every == 0
+				try:
+					time.sleep(server.latency)
+					match = MODEL_PATTERN.match(self.path)
+					path = match and os.path.join(server.structure_dir, match.group("id") + ".pdb")
+					if fail:
+						with server._lock:
+							server.failures += 1
+						self._send(503, b"")
+					elif path and os.path.isfile(path):
+						with open(path, "rb") as f:
+							self._send(200, f.read())
+					else:
+						self._send(404, b"")
+				finally:
+					with server._lock:
+						server._active -= 1
+
+			def _send(self, status, body):
+				self.send_response(status)
+				self.send_header("Content-Type", "chemical/x-pdb")
+				self.send_header("Content-Length", str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, *args):
+				pass
+
+		return Handler
+
+	def start(self):
+		self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+		self._thread.start()
+		return self
+
+	def stop(self):
+		self._server.shutdown()
+		self._server.server_close()
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, *exc):
+		self.stop()
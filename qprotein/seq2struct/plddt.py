@@ -0,0 +1,120 @@
+"""
+# ------------------------------------------------------------------------------
+# Author:    Dou Zhixin
+# Email:     bj600800@gmail.com
+# DATE:      2025/03/28
+
+# Description: pLDDT of predicted models from the B-factor column.
+Columns are sliced from the ATOM records without building a structure.
+Models can be trimmed of low-confidence termini and long loops instead of
+being rejected as a whole.
+# ------------------------------------------------------------------------------
+"""
+import numpy as np
+
+PLDDT_CUTOFF = 70
+# AlphaFold: below 50 is likely disordered
+TRIM_THRESHOLD = 50
+MIN_LOOP = 10
+MIN_LENGTH = 30
+
+
+def _first_model_atoms(lines):
+    atoms = []
+    for line in lines:
+        if line.startswith(("ATOM", "HETATM")):
+            atoms.append(line)
+        elif line.startswith("ENDMDL") and atoms:
+            break
+    return atoms
+
+
+def atom_plddt(pdb_string):
+    """pLDDT (B-factor column) of every atom of the first model."""
+    atoms = _first_model_atoms(pdb_string.splitlines())
+    return np.array([line[60:66] for line in atoms], dtype=float)
+
+
+def mean_plddt(pdb_string):
+    """Atom-averaged pLDDT, as averaging the B-factors of a parsed structure."""
+    plddt = atom_plddt(pdb_string)
+    return plddt.mean() if len(plddt) else 0.0
+
+
+def residue_plddt(pdb_string):
+    """
+    Per-residue pLDDT.
+
+    Returns
+    -------
+    residues : list of str
+        Residue keys (chain, number and insertion code columns) in file order.
+    plddt : ndarray, dtype=float, shape=(n,)
+        Mean pLDDT of the atoms of each residue.
+    """
+    atoms = _first_model_atoms(pdb_string.splitlines())
+    if not atoms:
+        return [], np.zeros(0)
+    keys = [line[21:27] for line in atoms]
+    values = np.array([line[60:66] for line in atoms], dtype=float)
+    starts = np.array([0] + [i for i in range(1, len(keys)) if keys[i] != keys[i - 1]])
+    counts = np.diff(np.append(starts, len(keys)))
+    return [keys[i] for i in starts], np.add.reduceat(values, starts) / counts
+
+
+def confident_residues(plddt, threshold=TRIM_THRESHOLD, min_loop=MIN_LOOP):
+    """
+    Mask of residues to keep: low-confidence runs (pLDDT below `threshold`)
+    are removed at both termini, inside the chain only when at least
+    `min_loop` residues long.
+    """
+    keep = np.ones(len(plddt), dtype=bool)
+    low = plddt < threshold
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], low.astype(np.int8), [0]])))
+    for start, stop in zip(edges[::2], edges[1::2]):
+        if start == 0 or stop == len(plddt) or stop - start >= min_loop:
+            keep[start:stop] = False
+    return keep
+
+
+def trim(pdb_string, threshold=TRIM_THRESHOLD, min_loop=MIN_LOOP):
+    """
+    PDB text without the low-confidence residues of `confident_residues`.
+
+    Returns
+    -------
+    pdb_string : str
+    plddt : ndarray
+        Per-residue pLDDT of the kept residues.
+    """
+    residues, plddt = residue_plddt(pdb_string)
+    keep = confident_residues(plddt, threshold, min_loop)
+    if keep.all():
+        return pdb_string, plddt
+    kept = {residue for residue, k in zip(residues, keep) if k}
+    lines = [line for line in pdb_string.splitlines(keepends=True)
+             if not line.startswith(("ATOM", "HETATM", "ANISOU")) or line[21:27] in kept]
+    return "".join(lines), plddt[keep]
+
+
+def filter_model(pdb_string, plddt_cutoff=PLDDT_CUTOFF, trim_threshold=None, min_loop=MIN_LOOP,
+                 min_length=MIN_LENGTH):
+    """
+    Confidence filter of a predicted model.
+
+    Without `trim_threshold` the model is kept when its mean pLDDT is above
+    `plddt_cutoff`. With it, low-confidence termini and loops are trimmed
+    first and the rest is kept when its mean residue pLDDT is above
+    `plddt_cutoff` and at least `min_length` residues remain.
+
+    Returns
+    -------
+    str or None
+        PDB text to keep, None if the model is rejected.
+    """
+    if trim_threshold is None:
+        return pdb_string if mean_plddt(pdb_string) > plddt_cutoff else None
+    trimmed, plddt = trim(pdb_string, trim_threshold, min_loop)
+    if len(plddt) < min_length or plddt.mean() <= plddt_cutoff:
+        return None
+    return trimmed
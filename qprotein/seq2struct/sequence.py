@@ -7,6 +7,7 @@
 # Description: Process input: sequences or Uniprot IDs
 # ------------------------------------------------------------------------------
 """
+import hashlib
 import re
 from Bio import SeqIO
 
@@ -31,9 +32,45 @@ def get_sequence(fasta_file):
     logger.info(f"Get sequences: {len(sequences)}")
     return sequences
 
+def clean_sequence(seq):
+    """Upper case residues without whitespace, gaps or a trailing stop."""
+    return re.sub(r"[\s\-.]", "", seq).upper().rstrip("*")
+
+def sequence_hash(seq):
+    return hashlib.sha256(clean_sequence(seq).encode()).hexdigest()
+
+def group_sequences(records):
+    """
+    Identical sequences under different IDs, by the hash of the cleaned sequence.
+
+    Parameters
+    ----------
+    records : list of (id, sequence)
+
+    Returns
+    -------
+    dict
+        {sequence hash: (cleaned sequence, [ids])} in input order; the first
+        ID of each group is its representative.
+    """
+    groups = {}
+    for name, seq in records:
+        seq = clean_sequence(seq)
+        groups.setdefault(sequence_hash(seq), (seq, []))[1].append(name)
+    n_duplicates = len(records) - len(groups)
+    if n_duplicates:
+        saved = sum(len(seq) * (len(names) - 1) for seq, names in groups.values())
+        logger.info(f"Unique sequences: {len(groups)} of {len(records)}, {n_duplicates} duplicates "
+                    f"({saved} residues) processed once")
+    return groups
+
 def get_id(id_file):
     with open(id_file, "r") as f:
-        id_list = [line.strip() for line in f]
+        id_list = [line.strip() for line in f if line.strip()]
+    n_ids = len(id_list)
+    id_list = list(dict.fromkeys(id_list))
+    if len(id_list) < n_ids:
+        logger.info(f"Duplicate uniprot IDs removed: {n_ids - len(id_list)}")
     # print(id_list)
     logger.info(f"Get uniprot IDs: {len(id_list)}")
     return id_list
@@ -0,0 +1,235 @@
+"""
+# ------------------------------------------------------------------------------
+# Author:    Dou Zhixin
+# Email:     bj600800@gmail.com
+# DATE:      2025/03/05
+
+# Description: Content-addressed on-disk cache for protonated structures.
+Entries are keyed by the structure file content plus the parameters that
+produced them and stored as compressed numpy archives. The cache is capped
+in size and evicts least recently used entries.
+# ------------------------------------------------------------------------------
+"""
+import hashlib
+import io
+import os
+import tempfile
+import time
+
+import numpy as np
+from biotite.structure import AtomArray
+
+from qprotein.utilities import logger, structure_source
+
+logger = logger.setup_log(name=__name__)
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "qprotein")
+DEFAULT_MAX_SIZE = 2 * 1024 ** 3  # bytes
+# fraction of the cap kept after an eviction
+LOW_WATER_MARK = 0.9
+
+ANNOTATIONS = ("chain_id", "res_id", "ins_code", "res_name", "hetero", "atom_name", "element")
+FLOAT_ANNOTATIONS = ("charge", "radius")
+
+_hashes = {}
+
+
+def content_hash(path):
+    """
+    SHA-256 of a file, memoized per path, size and modification time.
+    Archive members and gzipped files (`structure_source.StructureMember`)
+    are hashed by their decompressed content, packed structures keep the
+    hash of the file they were packed from.
+    """
+    if isinstance(path, structure_source.PackedStructure):
+        return path.content_hash
+    if isinstance(path, structure_source.StructureMember):
+        stat = os.stat(path.path)
+        memo_key = (os.path.abspath(path.path), path.offset, stat.st_size, stat.st_mtime_ns)
+        if memo_key not in _hashes:
+            _hashes[memo_key] = structure_source.content_hash(path)
+        return _hashes[memo_key]
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _hashes:
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+        _hashes[memo_key] = sha.hexdigest()
+    return _hashes[memo_key]
+
+
+def pack_atoms(atoms, prefix):
+    """
+    Flatten an AtomArray into arrays: float32 coordinates and categorical
+    annotations stored as (codes, categories).
+    """
+    arrays = {f"{prefix}/coord": atoms.coord.astype(np.float32)}
+    for name in ANNOTATIONS:
+        categories, codes = np.unique(atoms.get_annotation(name), return_inverse=True)
+        arrays[f"{prefix}/{name}/categories"] = categories
+        arrays[f"{prefix}/{name}/codes"] = codes.astype(np.int32)
+    for name in FLOAT_ANNOTATIONS:
+        if name in atoms.get_annotation_categories():
+            arrays[f"{prefix}/{name}"] = atoms.get_annotation(name).astype(np.float32)
+    return arrays
+
+
+def unpack_atoms(arrays, prefix):
+    coord = arrays[f"{prefix}/coord"]
+    atoms = AtomArray(len(coord))
+    atoms.coord = coord
+    for name in ANNOTATIONS:
+        categories = arrays[f"{prefix}/{name}/categories"]
+        atoms.set_annotation(name, categories[arrays[f"{prefix}/{name}/codes"]])
+    for name in FLOAT_ANNOTATIONS:
+        if f"{prefix}/{name}" in arrays:
+            atoms.set_annotation(name, arrays[f"{prefix}/{name}"])
+    return atoms
+
+
+class StructureCache:
+    """
+    On-disk cache of per-structure results.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory holding the cache entries.
+    max_size : int
+        Size cap in bytes. Above it, least recently used entries are removed
+        down to `LOW_WATER_MARK` of the cap. Processes sharing the directory
+        (`--workers`) each re-read the directory size before evicting, so the
+        cap holds for all of them together, overshooting by at most
+        1 - `LOW_WATER_MARK` of the cap per process.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        # path -> [mtime, size] of the entries, read from disk once
+        self._index = None
+        self._size = 0
+        # bytes put since the index was read from disk
+        self._written = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(structure_path, *params):
+        """Key from the structure file content and the parameters that produced the entry."""
+        sha = hashlib.sha256(content_hash(structure_path).encode())
+        for param in params:
+            sha.update(b"\0" + str(param).encode())
+        return sha.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".npz")
+
+    def get(self, key):
+        """Cached arrays of `key`, or None."""
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                arrays = {name: data[name] for name in data.files}
+            os.utime(path)  # mark as recently used
+            if self._index is not None and path in self._index:
+                self._index[path][0] = time.time()
+            return arrays
+        except (FileNotFoundError, OSError, ValueError):
+            return None
+
+    def put(self, key, arrays):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **arrays)
+        # atomic write: concurrent readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        data = buffer.getvalue()
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        index = self._entries()
+        self._size += len(data) - index.get(path, [0, 0])[1]
+        self._written += len(data)
+        index[path] = [time.time(), len(data)]
+        # other processes sharing the directory write entries this index does not
+        # see, so the real size is re-read before evicting and at least every
+        # (1 - LOW_WATER_MARK) of the cap written by this process
+        if self._size > self.max_size or self._written > (1 - LOW_WATER_MARK) * self.max_size:
+            self._index = None
+            self._entries()
+            if self._size > self.max_size:
+                self._evict()
+
+    def _entries(self):
+        """In-memory index of the entries, built by one directory walk."""
+        if self._index is None:
+            self._index = {}
+            for root, _, files in os.walk(self.cache_dir):
+                for file in files:
+                    if file.endswith(".npz"):
+                        path = os.path.join(root, file)
+                        try:
+                            stat = os.stat(path)
+                        except FileNotFoundError:
+                            continue
+                        self._index[path] = [stat.st_mtime, stat.st_size]
+            self._size = sum(size for _, size in self._index.values())
+            self._written = 0
+        return self._index
+
+    def _evict(self):
+        """
+        Remove least recently used entries down to 90% of the cap, so eviction
+        runs rarely. Entries just written by any process have the newest
+        modification times and go last.
+        """
+        low_water = LOW_WATER_MARK * self.max_size
+        for path, (_, size) in sorted(self._index.items(), key=lambda entry: entry[1][0]):
+            if self._size <= low_water:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # already evicted by another process
+            del self._index[path]
+            self._size -= size
+
+
+_cache = {"dir": DEFAULT_CACHE_DIR, "max_size": DEFAULT_MAX_SIZE, "enabled": True, "instance": None}
+
+
+def configure(cache_dir=None, max_size=None, enabled=True):
+    """Set the process-wide cache location, size cap (bytes) and switch."""
+    _cache["dir"] = cache_dir or DEFAULT_CACHE_DIR
+    _cache["max_size"] = max_size or DEFAULT_MAX_SIZE
+    _cache["enabled"] = enabled
+    _cache["instance"] = None
+
+
+def settings():
+    """Current `configure` arguments, e.g. to set up worker processes."""
+    return {"cache_dir": _cache["dir"], "max_size": _cache["max_size"], "enabled": _cache["enabled"]}
+
+
+def get_cache():
+    """Process-wide StructureCache, or None if caching is disabled."""
+    if not _cache["enabled"]:
+        return None
+    if _cache["instance"] is None:
+        try:
+            _cache["instance"] = StructureCache(_cache["dir"], _cache["max_size"])
+        except OSError as e:
+            logger.warning(f"Cache disabled, cannot use {_cache['dir']}: {e}")
+            _cache["enabled"] = False
+            return None
+    return _cache["instance"]
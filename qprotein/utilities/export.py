@@ -0,0 +1,255 @@
+"""
+# ------------------------------------------------------------------------------
+# Author:    Dou Zhixin
+# Email:     bj600800@gmail.com
+# DATE:      2025/03/22
+
+# Description: Streaming export of long-format result tables.
+Rows are written as they come, so memory stays flat for any number of
+proteins: to openpyxl write-only workbooks, split before Excel's row limit
+is reached, or to typed Parquet files in row groups.
+# ------------------------------------------------------------------------------
+"""
+import os
+
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment
+from openpyxl.utils import get_column_letter
+
+from qprotein.utilities import logger
+
+logger = logger.setup_log(name=__name__)
+
+EXCEL_MAX_ROWS = 1048576
+CENTER = Alignment(horizontal="center", vertical="center")
+ROW_GROUP_SIZE = 65536
+OUTPUT_FORMATS = ("default", "parquet")
+
+
+class XlsxSink:
+    """
+    Write-only workbook with fixed sheets and header rows.
+
+    When a sheet is full, the current workbook is saved and the next part
+    (`name_2.xlsx`, `name_3.xlsx`, ...) is started with all sheets and headers.
+    Workbooks are saved as `.part` files and renamed when the sink is closed
+    without an error, so an interrupted export never looks complete.
+
+    Parameters
+    ----------
+    xlsx_file : str
+        Path of the first workbook.
+    sheets : dict
+        Sheet name -> list of column names.
+    max_rows : int
+        Rows per sheet, header included.
+    """
+
+    def __init__(self, xlsx_file, sheets, max_rows=EXCEL_MAX_ROWS):
+        self.xlsx_file = xlsx_file
+        self.sheets = sheets
+        self.max_rows = max_rows
+        self.files = []
+        self._workbook = None
+        self._rows = {}
+        self._open()
+
+    def _part_file(self):
+        if not self.files:
+            return self.xlsx_file
+        stem, suffix = os.path.splitext(self.xlsx_file)
+        return f"{stem}_{len(self.files) + 1}{suffix}"
+
+    def _open(self):
+        self._workbook = Workbook(write_only=True)
+        self._worksheets = {}
+        for name, header in self.sheets.items():
+            worksheet = self._workbook.create_sheet(name)
+            for column, title in enumerate(header, start=1):
+                worksheet.column_dimensions[get_column_letter(column)].width = max(len(title) * 2, 10)
+            self._worksheets[name] = worksheet
+            self._rows[name] = 0
+            header_cells = []
+            for title in header:
+                cell = WriteOnlyCell(worksheet, value=title)
+                cell.alignment = CENTER
+                header_cells.append(cell)
+            self._append(name, header_cells)
+
+    def _save(self):
+        xlsx_file = self._part_file()
+        self._workbook.save(xlsx_file + ".part")
+        self._workbook.close()
+        self.files.append(xlsx_file)
+
+    def _append(self, sheet, row):
+        # data cells are written unstyled, per-cell styles double the export time
+        self._worksheets[sheet].append(row)
+        self._rows[sheet] += 1
+
+    def write(self, sheet, row):
+        if self._rows[sheet] >= self.max_rows:
+            self._save()
+            self._open()
+        self._append(sheet, row)
+
+    def write_rows(self, sheet, rows):
+        for row in rows:
+            self.write(sheet, row)
+
+    def close(self):
+        """Save the last workbook; returns the paths of all written workbooks."""
+        if self._workbook is not None:
+            self._save()
+            self._workbook = None
+            for xlsx_file in self.files:
+                os.replace(xlsx_file + ".part", xlsx_file)
+            logger.info('Results saved to {}'.format(', '.join(self.files)))
+        return self.files
+
+    def discard(self):
+        """Drop the unfinished export: no workbook is saved, saved parts are removed."""
+        if self._workbook is not None:
+            # a write-only workbook only releases its temporary files when saved
+            self._save()
+            self._workbook = None
+            for xlsx_file in self.files:
+                try:
+                    os.remove(xlsx_file + ".part")
+                except FileNotFoundError:
+                    pass
+            self.files = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+class ParquetSink:
+    """
+    Typed Parquet tables written incrementally in row groups.
+
+    Each table goes to `out_dir/prefix_table.parquet`; buffered rows are
+    flushed as one row group every `row_group_size` rows, so memory stays
+    bounded. A Parquet file is only readable once closed: tables are written
+    as `.part` files and renamed on a clean close, as by `XlsxSink`.
+
+    Parameters
+    ----------
+    out_dir : str
+    prefix : str
+    tables : dict
+        Table name -> list of (column name, type), type one of
+        "string", "int32", "int64", "float64", "bool".
+    """
+
+    def __init__(self, out_dir, prefix, tables, row_group_size=ROW_GROUP_SIZE):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Parquet output needs pyarrow: pip install pyarrow")
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self.row_group_size = row_group_size
+        self.files = []
+        self._schemas = {}
+        self._buffers = {}
+        self._writers = {}
+        for name, columns in tables.items():
+            self._schemas[name] = pyarrow.schema([(column, getattr(pyarrow, dtype)()) for column, dtype in columns])
+            self._buffers[name] = []
+            path = os.path.join(out_dir, f"{prefix}_{name}.parquet")
+            self._writers[name] = self._pq.ParquetWriter(path + ".part", self._schemas[name])
+            self.files.append(path)
+
+    def _flush(self, table):
+        rows = self._buffers[table]
+        if not rows:
+            return
+        schema = self._schemas[table]
+        columns = [self._pa.array([row[i] for row in rows], type=field.type) for i, field in enumerate(schema)]
+        self._writers[table].write_table(self._pa.Table.from_arrays(columns, schema=schema))
+        self._buffers[table] = []
+
+    def write(self, table, row):
+        self._buffers[table].append(row)
+        if len(self._buffers[table]) >= self.row_group_size:
+            self._flush(table)
+
+    def write_rows(self, table, rows):
+        for row in rows:
+            self.write(table, row)
+
+    def close(self):
+        """Write the last row groups; returns the paths of all tables."""
+        if self._writers:
+            for table, writer in self._writers.items():
+                self._flush(table)
+                writer.close()
+            self._writers = {}
+            for path in self.files:
+                os.replace(path + ".part", path)
+            logger.info('Results saved to {}'.format(', '.join(self.files)))
+        return self.files
+
+    def discard(self):
+        """Drop the unfinished export: buffered rows are lost, `.part` files removed."""
+        if self._writers:
+            for writer in self._writers.values():
+                writer.close()
+            self._writers = {}
+            for path in self.files:
+                try:
+                    os.remove(path + ".part")
+                except FileNotFoundError:
+                    pass
+            self.files = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+class OrderedEmitter:
+    """
+    `on_result(index, result)` callback that passes results on in index
+    order, e.g. to write records in input order while threads finish out of
+    order. Results wait until all earlier ones are done, so use it only
+    when few results are in flight at a time.
+    """
+
+    def __init__(self, emit):
+        self.emit = emit
+        self._next = 0
+        self._pending = {}
+
+    def __call__(self, index, result):
+        self._pending[index] = result
+        while self._next in self._pending:
+            self.emit(self._next, self._pending.pop(self._next))
+            self._next += 1
+
+
+def row_emitter(sink, names, rows_of):
+    """
+    `on_result` callback writing the rows of every result to `sink` as it
+    arrives, in completion order, so no result waits in memory;
+    `rows_of(name, result)` yields (table, row) pairs.
+    """
+    def emit(index, result):
+        if result is not None:
+            for table, row in rows_of(names[index], result):
+                sink.write(table, row)
+    return emit
@@ -0,0 +1,54 @@
+"""
+# ------------------------------------------------------------------------------
+# Author:    Dou Zhixin
+# Email:     bj600800@gmail.com
+# DATE:      2025/04/08
+
+# Description: Pooled HTTP sessions and request rate limiting.
+Shared by the AFDB and NCBI Entrez clients: one session with kept-alive
+connections for all threads, and a thread-safe limit of requests per second.
+# ------------------------------------------------------------------------------
+"""
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter, Retry
+
+RETRY_STATUS = [408, 429, 500, 502, 503, 504]
+
+
+def start_session(pool_size=10, retries=3, backoff_factor=0.5, headers=None):
+    """
+    Session with `pool_size` kept-alive connections per host. With `retries`,
+    failed connections and RETRY_STATUS responses are retried with
+    exponential backoff; 0 leaves retrying to the caller.
+    """
+    max_retries = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=RETRY_STATUS,
+                        respect_retry_after_header=True) if retries else 0
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=max_retries)
+    session = requests.Session()
+    if headers:
+        session.headers.update(headers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class RateLimiter:
+    """Thread-safe limit of `rate` requests per second, spaced evenly."""
+
+    def __init__(self, rate=None):
+        self.interval = 1 / rate if rate else 0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
@@ -0,0 +1,153 @@
+"""
+# ------------------------------------------------------------------------------
+# Author:    Dou Zhixin
+# Email:     bj600800@gmail.com
+# DATE:      2025/04/02
+
+# Description: Local stand-in for the NCBI E-utilities epost and efetch.
+IDs posted to epost.fcgi are kept under a WebEnv and query key, efetch.fcgi
+returns FASTA records of a retstart/retmax slice of them. Optional latency
+and transient failures test throughput, rate limiting and retries offline:
+
+	with MockEntrez("sequences.fasta", latency=0.05, fail_every=3) as server:
+		EntrezClient(base_url=server.url).fetch_fasta(ids, "out.fasta")
+# ------------------------------------------------------------------------------
+"""
+import threading
+import time
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from Bio import SeqIO
+
+
+class MockEntrez:
+	"""
+	Threaded HTTP server on localhost.
+
+	Parameters
+	----------
+	records : str or dict
+		FASTA file, or a dict of ID to sequence, to serve.
+	latency : float
+		Seconds to wait before every response.
+	fail_every : int, optional
+		Answer every n-th request with 429 and an NCBI style error body.
+	port : int
+		0 picks a free port.
+	"""
+
+	def __init__(self, records, latency=0.0, fail_every=None, port=0):
+		if isinstance(records, str):
+			records = {record.id: str(record.seq) for record in SeqIO.parse(records, "fasta")}
+		self.records = records
+		self.latency = latency
+		self.fail_every = fail_every
+		self.requests = 0
+		self.failures = 0
+		self.max_active = 0
+		# most requests started within one second
+		self.max_rate = 0
+		self._active = 0
+		self._recent = deque()
+		self._history = {}
+		self._lock = threading.Lock()
+		self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+		self._server.daemon_threads = True
+		self._thread = None
+
+	@property
+	def url(self):
+		return f"http://127.0.0.1:{self._server.server_address[1]}/entrez/eutils"
+
+	def epost(self, params):
+		ids = [i for i in params.get("id", [""])[0].split(",") if i]
+		with self._lock:
+			webenv = params.get("WebEnv", [None])[0] or f"MCID_{uuid.uuid4().hex}"
+			queries = self._history.setdefault(webenv, [])
+			queries.append(ids)
+			query_key = len(queries)
+		body = (f"<?xml version=\"1.0\" encoding=\"UTF-8\" ?>\n<ePostResult>\n\t<QueryKey>{query_key}</QueryKey>"
+		        f"\n\t<WebEnv>{webenv}</WebEnv>\n</ePostResult>\n")
+		return 200, "text/xml", body
+
+	def efetch(self, params):
+		try:
+			ids = self._history[params["WebEnv"][0]][int(params["query_key"][0]) - 1]
+		except (KeyError, IndexError, ValueError):
+			return 400, "application/json", "{\"error\":\"Unable to obtain query\"}"
+		retstart = int(params.get("retstart", ["0"])[0])
+		retmax = int(params.get("retmax", ["20"])[0])
+		body = "".join(f">{i}\n{self.records[i]}\n" for i in ids[retstart:retstart + retmax] if i in self.records)
+		return 200, "text/plain", body
+
+	def _handler(self):
+		server = self
+
+		class Handler(BaseHTTPRequestHandler):
+			protocol_version = "HTTP/1.1"
+
+			def do_GET(self):
+				self._handle(urlsplit(self.path).query)
+
+			def do_POST(self):
+				self._handle(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode())
+
+			def _handle(self, query):
+				now = time.monotonic()
+				with server._lock:
+					server.requests += 1
+					server._active += 1
+					server.max_active = max(server.max_active, server._active)
+					server._recent.append(now)
+					while server._recent[0] <= now - 1:
+						server._recent.popleft()
+					server.max_rate = max(server.max_rate, len(server._recent))
+					fail = server.fail_every and server.requests % server.fail_every == 0
+				try:
+					time.sleep(server.latency)
+					utility = urlsplit(self.path).path.rsplit("/", 1)[-1]
+					params = parse_qs(query)
+					if fail:
+						with server._lock:
+							server.failures += 1
+						self._send(429, "application/json", "{\"error\":\"API rate limit exceeded\"}")
+					elif utility == "epost.fcgi":
+						self._send(*server.epost(params))
+					elif utility == "efetch.fcgi":
+						self._send(*server.efetch(params))
+					else:
+						self._send(404, "text/plain", "")
+				finally:
+					with server._lock:
+						server._active -= 1
+
+			def _send(self, status, content_type, body):
+				body = body.encode()
+				self.send_response(status)
+				self.send_header("Content-Type", content_type)
+				self.send_header("Content-Length", str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, *args):
+				pass
+
+		return Handler
+
+	def start(self):
+		self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+		self._thread.start()
+		return self
+
+	def stop(self):
+		self._server.shutdown()
+		self._server.server_close()
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, *exc):
+		self.stop()
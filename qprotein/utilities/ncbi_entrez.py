@@ -4,34 +4,187 @@
 # Email:     bj600800@gmail.com
 # DATE:      2024/01/11
 
-# Description: 
+# Description: Fetch protein sequences from NCBI Entrez.
+IDs are posted to the Entrez history server once, then fetched in large
+batches by concurrent workers within the NCBI rate limit (3 requests per
+second, 10 with an API key). Failed batches are retried individually and
+records are streamed to the FASTA file as batches arrive.
 # ------------------------------------------------------------------------------
 """
-import http.client
+import io
 import os
-from Bio import Entrez
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from Bio import SeqIO
 from tqdm import tqdm
 
-def fetch(entry_file):
+from qprotein.utilities import export, http_session, logger
+
+logger = logger.setup_log(name=__name__)
+
+EUTILS_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils"
+# requests per second allowed by NCBI
+RATE_LIMIT = 3
+API_KEY_RATE_LIMIT = 10
+BATCH_SIZE = 500
+POST_SIZE = 10000
+
+
+class EntrezError(Exception):
+	pass
+
+
+class EntrezClient:
+	"""
+	Entrez E-utilities over one pooled session.
+
+	Parameters
+	----------
+	email : str
+		Contact address, required by NCBI.
+	api_key : str, optional
+		NCBI API key, raises the rate limit to 10 requests per second.
+	base_url : str
+		E-utilities endpoint, e.g. a local stand-in (see `mock_entrez`).
+	concurrency : int, optional
+		Simultaneous requests, the rate limit by default.
+	rate : float, optional
+		Requests per second, the NCBI limit by default.
+	retries : int
+		Attempts per request after the first one, with exponential backoff.
+	"""
+
+	def __init__(self, email="", api_key=None, base_url=EUTILS_URL, concurrency=None, rate=None, retries=3,
+	             backoff_factor=1.0):
+		self.base_url = base_url.rstrip("/")
+		self.rate = rate or (API_KEY_RATE_LIMIT if api_key else RATE_LIMIT)
+		self.concurrency = concurrency or int(self.rate)
+		self.retries = retries
+		self.backoff_factor = backoff_factor
+		self.params = {"tool": "qprotein", "email": email}
+		if api_key:
+			self.params["api_key"] = api_key
+		self.limiter = http_session.RateLimiter(self.rate)
+		# retried only in `_request`, where every attempt waits for the rate limiter
+		self.session = http_session.start_session(pool_size=self.concurrency, retries=0)
+
+	def _request(self, utility, data, check=None):
+		"""
+		Response text of an E-utility, retried with exponential backoff on
+		network errors, error statuses and responses rejected by `check`.
+		"""
+		for attempt in range(self.retries + 1):
+			try:
+				self.limiter.wait()
+				response = self.session.post(f"{self.base_url}/{utility}.fcgi", data={**self.params, **data},
+				                             timeout=120)
+				response.raise_for_status()
+				if check is not None:
+					check(response.text)
+				return response.text
+			except (requests.RequestException, EntrezError) as e:
+				if attempt == self.retries:
+					raise
+				logger.info(f"{utility} failed ({e}), retrying")
+				time.sleep(self.backoff_factor * 2 ** attempt)
+
+	def epost(self, ids, db="protein", webenv=None):
+		"""Post IDs to the history server; returns (WebEnv, query_key)."""
+		def check(text):
+			if not ("<WebEnv>" in text and "<QueryKey>" in text):
+				raise EntrezError(f"unexpected epost response: {text[:200]}")
+
+		data = {"db": db, "id": ",".join(ids)}
+		if webenv:
+			data["WebEnv"] = webenv
+		text = self._request("epost", data, check)
+		return (re.search(r"<WebEnv>(\S+)</WebEnv>", text).group(1),
+		        re.search(r"<QueryKey>(\d+)</QueryKey>", text).group(1))
+
+	def efetch_batch(self, webenv, query_key, retstart, retmax, db="protein"):
+		"""FASTA records of one slice of a history query."""
+		def check(text):
+			if text.strip() and not text.lstrip().startswith(">"):
+				raise EntrezError(f"unexpected efetch response: {text[:200]}")
+
+		data = {"db": db, "WebEnv": webenv, "query_key": query_key, "retstart": retstart, "retmax": retmax,
+		        "rettype": "fasta", "retmode": "text"}
+		text = self._request("efetch", data, check)
+		return list(SeqIO.parse(io.StringIO(text), "fasta"))
+
+	def fetch_fasta(self, ids, fasta_file, db="protein", batch_size=BATCH_SIZE):
+		"""
+		Fetch the FASTA records of `ids` into `fasta_file`.
+
+		Records are written in batch order as soon as the batches before
+		them are done, to `fasta_file.part` renamed at the end.
+
+		Returns
+		-------
+		n_records : int
+		failed : list of str
+			IDs of batches that failed after all retries.
+		"""
+		ids = list(dict.fromkeys(ids))
+		batches = []
+		webenv = None
+		for start in range(0, len(ids), POST_SIZE):
+			chunk = ids[start:start + POST_SIZE]
+			webenv, query_key = self.epost(chunk, db=db, webenv=webenv)
+			batches.extend((query_key, retstart, chunk[retstart:retstart + batch_size])
+			               for retstart in range(0, len(chunk), batch_size))
+
+		part_file = fasta_file + ".part"
+		n_records = 0
+		failed = []
+		with open(part_file, "w") as f:
+			def write(index, records):
+				nonlocal n_records
+				SeqIO.write(records, f, "fasta")
+				n_records += len(records)
+
+			emit = export.OrderedEmitter(write)
+			with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+				futures = {executor.submit(self.efetch_batch, webenv, query_key, retstart, len(batch_ids), db): i
+				           for i, (query_key, retstart, batch_ids) in enumerate(batches)}
+				for future in tqdm(as_completed(futures), total=len(futures), desc="Fetching Entrez batches"):
+					index = futures[future]
+					try:
+						records = future.result()
+					except (requests.RequestException, EntrezError) as e:
+						logger.error(f"Entrez batch of {len(batches[index][2])} IDs failed: {e}")
+						failed.extend(batches[index][2])
+						records = []
+					emit(index, records)
+		os.replace(part_file, fasta_file)
+		logger.info(f"Fetched {n_records} sequences to {fasta_file}")
+		return n_records, failed
+
+	def close(self):
+		self.session.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+
+def read_entry_ids(entry_file):
+	"""Protein accessions of a tab-separated entry list (second to last column)."""
 	with open(entry_file, "r") as f:
-		id_list = [i.rstrip().split("\t")[-2] for i in f.readlines()]
-
-	Entrez.email = ""  # 请写上你自己的电子邮件地址以遵守NCBI的规则
-	Entrez.api_key = ""  # 如果有NCBI API key请填入，这样可以提高访问速度和配额限制
-	
-	sequences = []
-	batch_size = 50
-	total_query = len(id_list)
-	for i in range(0, total_query, batch_size):
-		try:
-			handle = Entrez.efetch(db="protein", id=id_list[i:i+batch_size], rettype="fasta", retmode="text")
-			batch_sequences = handle.read()
-			sequences.extend(batch_sequences)
-		except:
-			pass
-	
-
-	return sequences
+		return [line.rstrip().split("\t")[-2] for line in f if line.strip()]
+
+
+def fetch(entry_file, fasta_file, email="", api_key=None, **kwargs):
+	"""Fetch the sequences of an entry list into `fasta_file`; returns the IDs of failed batches."""
+	with EntrezClient(email=email, api_key=api_key, **kwargs) as client:
+		_, failed = client.fetch_fasta(read_entry_ids(entry_file), fasta_file)
+	return failed
+
 
 if __name__ == '__main__':
 	work_dir = r"D:\subject\active\2-GetThermo\data\TIM"
@@ -39,17 +192,13 @@ if __name__ == '__main__':
 	            'GH39', 'GH42', 'GH50', 'GH51', 'GH53', 'GH59', 'GH72', 'GH79',
 	            'GH86', 'GH113', 'GH128', 'GH140', 'GH147', 'GH148', 'GH157',
 	            'GH158', 'GH164', 'GH167', 'GH169', 'GH173']
-	for d_name in tqdm(tim_dirs):
-		entry_file = os.path.join(work_dir, d_name, d_name+'.txt')
-		fasta_file = os.path.join(work_dir, d_name, d_name+'.fasta')
-		if not os.path.exists(fasta_file):
-			try:
-				print()
-				print(d_name)
-				sequences = fetch(entry_file)
-				with open(fasta_file, "w") as f:
-					f.writelines(sequences)
-			except ValueError as ve:
-				print(f"ValueError: {ve}")
-			except http.client.IncompleteRead as ire:
-				print(f"IncompleteRead: {ire}")
+	email = ""  # 请写上你自己的电子邮件地址以遵守NCBI的规则
+	api_key = None  # 如果有NCBI API key请填入，这样可以提高访问速度和配额限制
+	with EntrezClient(email=email, api_key=api_key) as client:
+		for d_name in tqdm(tim_dirs):
+			entry_file = os.path.join(work_dir, d_name, d_name+'.txt')
+			fasta_file = os.path.join(work_dir, d_name, d_name+'.fasta')
+			if not os.path.exists(fasta_file):
+				_, failed = client.fetch_fasta(read_entry_ids(entry_file), fasta_file)
+				if failed:
+					logger.error(f"{d_name}: {len(failed)} IDs not fetched")
@@ -0,0 +1,229 @@
+"""
+# ------------------------------------------------------------------------------
+# Author:    Dou Zhixin
+# Email:     bj600800@gmail.com
+# DATE:      2025/03/30
+
+# Description: Packed structure store.
+Many structures in one binary file: per structure int64 residue ids,
+float32 coordinates, uint16 codes of categorical annotations and hetero
+flags, followed by a JSON index of offsets and the category tables. The
+file is memory-mapped; coordinates, residue ids and hetero flags of a
+loaded AtomArray are views into the map, no text is parsed.
+# ------------------------------------------------------------------------------
+"""
+import hashlib
+import json
+import os
+import shutil
+import struct
+
+import numpy as np
+from biotite.structure import AtomArray
+
+from qprotein.utilities import logger
+
+logger = logger.setup_log(name=__name__)
+
+MAGIC = b"QPSTORE1"
+PACKED_SUFFIX = ".qps"
+FOOTER = struct.Struct("<Q8s")
+CATEGORICAL = ("chain_id", "ins_code", "res_name", "atom_name", "element")
+MAX_CATEGORIES = np.iinfo(np.uint16).max + 1
+ALIGNMENT = 8
+
+
+def _layout(n_atoms):
+    """Byte offsets of the arrays of one structure relative to its start, and the padded total size."""
+    offsets = {"res_id": 0, "coord": 8 * n_atoms}
+    position = offsets["coord"] + 12 * n_atoms
+    for name in CATEGORICAL:
+        offsets[name] = position
+        position += 2 * n_atoms
+    offsets["hetero"] = position
+    position += n_atoms
+    return offsets, position + (-position) % ALIGNMENT
+
+
+def is_packed(path):
+    """Packed store file, recognized by its leading magic bytes."""
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except (IsADirectoryError, OSError):
+        return False
+
+
+def _read_index(f):
+    f.seek(-FOOTER.size, os.SEEK_END)
+    index_offset, magic = FOOTER.unpack(f.read(FOOTER.size))
+    if magic != MAGIC:
+        raise ValueError(f"{f.name} is not a complete packed structure store")
+    f.seek(index_offset)
+    index = json.loads(f.read(os.fstat(f.fileno()).st_size - FOOTER.size - index_offset))
+    return index_offset, index
+
+
+class PackedStoreWriter:
+    """
+    Append structures to a packed store, created if missing.
+
+    The store is written to `path.part`, a copy of an existing store whose
+    index is overwritten by new structures, and replaces `path` only when
+    `close` has written the new index. Until then, and after an error,
+    `path` keeps its complete previous content.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._part_path = path + ".part"
+        if os.path.exists(path):
+            shutil.copyfile(path, self._part_path)
+            self._file = open(self._part_path, "r+b")
+            self._data_end, self.index = _read_index(self._file)
+        else:
+            self._file = open(self._part_path, "w+b")
+            self._file.write(MAGIC)
+            self._data_end = len(MAGIC)
+            self.index = {"version": 1, "categories": {name: [] for name in CATEGORICAL}, "structures": {}}
+        self._data_end += (-self._data_end) % ALIGNMENT
+        self._codes = {name: {value: code for code, value in enumerate(values)}
+                       for name, values in self.index["categories"].items()}
+
+    def __contains__(self, name):
+        return name in self.index["structures"]
+
+    def _encode(self, name, values):
+        table = self._codes[name]
+        categories = self.index["categories"][name]
+        unique, inverse = np.unique(values, return_inverse=True)
+        codes = []
+        for value in unique.tolist():
+            if value not in table:
+                if len(categories) == MAX_CATEGORIES:
+                    raise ValueError(f"More than {MAX_CATEGORIES} distinct {name} values in {self.path}")
+                table[value] = len(categories)
+                categories.append(value)
+            codes.append(table[value])
+        return np.array(codes, dtype=np.uint16)[inverse]
+
+    def add(self, name, atoms, content_hash=None):
+        """
+        Add an AtomArray under `name`; the index then points to it instead
+        of an earlier structure of that name.
+
+        content_hash : str, optional
+            SHA-256 of the source file, so results stored for the file are
+            reused for the packed structure (see `cache.content_hash`).
+        """
+        n_atoms = atoms.array_length()
+        offsets, size = _layout(n_atoms)
+        blob = bytearray(size)
+        arrays = {
+            "res_id": atoms.res_id.astype(np.int64),
+            "coord": atoms.coord.astype(np.float32),
+            "hetero": atoms.hetero.astype(np.uint8),
+        }
+        for category in CATEGORICAL:
+            arrays[category] = self._encode(category, atoms.get_annotation(category))
+        for array_name, array in arrays.items():
+            data = np.ascontiguousarray(array).tobytes()
+            blob[offsets[array_name]:offsets[array_name] + len(data)] = data
+        self._file.seek(self._data_end)
+        self._file.write(blob)
+        if content_hash is None:
+            content_hash = hashlib.sha256(bytes(blob)).hexdigest()
+        self.index["structures"][name] = {"offset": self._data_end, "n_atoms": n_atoms, "sha256": content_hash}
+        self._data_end += size
+
+    def close(self):
+        if self._file is None:
+            return
+        self._file.seek(self._data_end)
+        self._file.write(json.dumps(self.index).encode())
+        self._file.write(FOOTER.pack(self._data_end, MAGIC))
+        self._file.truncate()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+        os.replace(self._part_path, self.path)
+
+    def discard(self):
+        """Drop the structures added since opening; the store keeps its previous content."""
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        os.remove(self._part_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+class PackedStore:
+    """
+    Memory-mapped packed store, read only.
+
+    Parameters
+    ----------
+    path : str
+        Store file written by `PackedStoreWriter`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._index_offset, index = _read_index(f)
+        self.structures = index["structures"]
+        self.categories = {name: np.array(values, dtype=str) for name, values in index["categories"].items()}
+        # copy-on-write: biotite's Cython routines need writable buffers, pages
+        # are only copied if written, the file never changes
+        self._map = np.memmap(path, dtype=np.uint8, mode="c", shape=(self._index_offset,))
+
+    def names(self):
+        return list(self.structures)
+
+    def __contains__(self, name):
+        return name in self.structures
+
+    def __len__(self):
+        return len(self.structures)
+
+    def _view(self, start, dtype, shape):
+        count = int(np.prod(shape))
+        return self._map[start:start + count * np.dtype(dtype).itemsize].view(dtype).reshape(shape)
+
+    def load(self, name):
+        """AtomArray of a structure; coord, res_id and hetero share memory with the map."""
+        entry = self.structures[name]
+        n_atoms, start = entry["n_atoms"], entry["offset"]
+        offsets, _ = _layout(n_atoms)
+        atoms = AtomArray(n_atoms)
+        atoms.coord = self._view(start + offsets["coord"], np.float32, (n_atoms, 3))
+        atoms.set_annotation("res_id", self._view(start + offsets["res_id"], np.int64, (n_atoms,)))
+        atoms.set_annotation("hetero", self._view(start + offsets["hetero"], np.bool_, (n_atoms,)))
+        for category in CATEGORICAL:
+            codes = self._view(start + offsets[category], np.uint16, (n_atoms,))
+            atoms.set_annotation(category, self.categories[category][codes])
+        return atoms
+
+
+_stores = {}
+
+
+def open_store(path):
+    """`PackedStore` of a path, opened once per process and reopened when the file changes."""
+    stat = os.stat(path)
+    key = os.path.abspath(path)
+    stamp = (stat.st_size, stat.st_mtime_ns)
+    if key not in _stores or _stores[key][0] != stamp:
+        _stores[key] = (stamp, PackedStore(path))
+    return _stores[key][1]
+
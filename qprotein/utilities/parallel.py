@@ -0,0 +1,118 @@
+"""
+# ------------------------------------------------------------------------------
+# Author:    Dou Zhixin
+# Email:     bj600800@gmail.com
+# DATE:      2025/03/10
+
+# Description: Process-pool execution of per-structure work.
+Structures are dispatched largest first in chunks, results come back in input
+order, or are passed to a callback as they finish, and progress of all
+workers is shown in one tqdm bar.
+# ------------------------------------------------------------------------------
+"""
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+
+from tqdm import tqdm
+
+from qprotein.utilities import cache, structure_source
+
+# keep external binaries (apbs, pdb2pqr, mkdssp) and numpy from spawning a
+# thread per core in every worker; BLAS reads them when numpy is imported,
+# so workers are spawned, not forked, with them already in the environment
+THREAD_LIMIT_VARS = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS")
+
+
+def _size(path):
+    try:
+        return structure_source.size(path)
+    except OSError:
+        return 0
+
+
+@contextmanager
+def _thread_limits():
+    """Thread limits in the environment inherited by spawned workers, unless set by the user."""
+    added = [var for var in THREAD_LIMIT_VARS if var not in os.environ]
+    for var in added:
+        os.environ[var] = "1"
+    try:
+        yield
+    finally:
+        for var in added:
+            os.environ.pop(var, None)
+
+
+def _init_worker(cache_settings):
+    cache.configure(**cache_settings)
+
+
+def _run_chunk(func, chunk, kwargs):
+    return [(index, func(item, **kwargs)) for index, item in chunk]
+
+
+def default_chunksize(n_items, workers):
+    """About four chunks per worker, to balance load against dispatch overhead."""
+    return max(1, n_items // (workers * 4))
+
+
+def map_structures(func, items, workers=1, desc=None, chunksize=None, on_result=None, **kwargs):
+    """
+    Apply `func(item, **kwargs)` to every structure.
+
+    Parameters
+    ----------
+    func : callable
+        Module-level (picklable) per-structure function.
+    items : list
+        Structure paths.
+    workers : int
+        Number of worker processes. 1 runs in the calling process.
+    desc : str, optional
+        Progress bar description.
+    chunksize : int, optional
+        Structures per task, see `default_chunksize`.
+    on_result : callable, optional
+        Called as `on_result(index, result)` in the calling process as soon
+        as a structure is done, in completion order. Results are then only
+        passed on, not kept, so memory does not grow with the number of
+        structures.
+
+    Returns
+    -------
+    list or None
+        Results in the order of `items`; None with `on_result`.
+    """
+    items = list(items)
+    results = [None] * len(items) if on_result is None else None
+
+    def collect(index, result):
+        if on_result is None:
+            results[index] = result
+        else:
+            on_result(index, result)
+
+    if workers is None or workers <= 1 or len(items) <= 1:
+        for index, item in enumerate(tqdm(items, desc=desc)):
+            collect(index, func(item, **kwargs))
+        return results
+
+    # longest structures first: large files are dispatched early and do not
+    # end up as the tail of the run
+    order = sorted(range(len(items)), key=lambda i: _size(items[i]), reverse=True)
+    chunksize = chunksize or default_chunksize(len(items), workers)
+    chunks = [[(i, items[i]) for i in order[start:start + chunksize]]
+              for start in range(0, len(order), chunksize)]
+
+    with _thread_limits(), ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                               initializer=_init_worker,
+                                               initargs=(cache.settings(),)) as executor:
+        futures = {executor.submit(_run_chunk, func, chunk, kwargs): len(chunk) for chunk in chunks}
+        with tqdm(total=len(items), desc=desc) as progress:
+            for future in as_completed(futures):
+                for index, result in future.result():
+                    collect(index, result)
+                progress.update(futures[future])
+    return results
@@ -0,0 +1,166 @@
+"""
+# ------------------------------------------------------------------------------
+# Author:    Dou Zhixin
+# Email:     bj600800@gmail.com
+# DATE:      2025/03/20
+
+# Description: Persistent per-structure result store for incremental runs.
+Results live in one SQLite file, keyed by the structure file content hash
+and a hash of every parameter that produced them. Reruns compute only new,
+changed or re-parameterized structures.
+# ------------------------------------------------------------------------------
+"""
+import hashlib
+import inspect
+import json
+import pickle
+import sqlite3
+import importlib.metadata
+
+from qprotein.utilities import cache, logger, parallel
+
+logger = logger.setup_log(name=__name__)
+
+RESULT_STORE_NAME = "qprotein_results.sqlite"
+# SQLite host parameter limit is 999 on old builds
+QUERY_BATCH = 500
+
+
+def function_defaults(*funcs):
+    """
+    Default arguments of functions, as parameters of the result key: a changed
+    default cutoff then invalidates the stored results.
+    """
+    defaults = {}
+    for func in funcs:
+        for name, param in inspect.signature(func).parameters.items():
+            if param.default is not inspect.Parameter.empty:
+                defaults[f"{func.__module__}.{func.__name__}.{name}"] = param.default
+    return defaults
+
+
+def package_versions(*packages):
+    versions = {}
+    for package in packages:
+        try:
+            versions[package] = importlib.metadata.version(package)
+        except importlib.metadata.PackageNotFoundError:
+            versions[package] = None
+    return versions
+
+
+class ResultStore:
+    """
+    SQLite store of pickled per-structure results.
+
+    Parameters
+    ----------
+    db_path : str
+        SQLite database file, created if missing.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "content_hash TEXT NOT NULL, params_hash TEXT NOT NULL, kind TEXT NOT NULL, "
+            "value BLOB NOT NULL, PRIMARY KEY (content_hash, params_hash))"
+        )
+        self.connection.commit()
+
+    @staticmethod
+    def params_key(kind, params):
+        """Hash of the result kind and its parameters (JSON, sorted keys)."""
+        text = json.dumps([kind, params], sort_keys=True, default=str)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def get_many(self, content_hashes, params_hash):
+        """Stored results of the given structure hashes, as {content_hash: value}."""
+        content_hashes = list(set(content_hashes))
+        found = {}
+        for start in range(0, len(content_hashes), QUERY_BATCH):
+            batch = content_hashes[start:start + QUERY_BATCH]
+            rows = self.connection.execute(
+                f"SELECT content_hash, value FROM results WHERE params_hash = ? "
+                f"AND content_hash IN ({','.join('?' * len(batch))})", [params_hash, *batch])
+            found.update((content_hash, pickle.loads(value)) for content_hash, value in rows)
+        return found
+
+    def put(self, content_hash, params_hash, kind, value):
+        self.connection.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                                (content_hash, params_hash, kind, pickle.dumps(value)))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def map_stored(store, kind, params, func, items, workers=1, desc=None, on_result=None, **kwargs):
+    """
+    `parallel.map_structures` that only computes structures without a stored
+    result for `kind` and `params`, and stores every new result.
+
+    Structures of identical content, e.g. models written for every alias of
+    a duplicate sequence, are computed once and the result is passed on to
+    all of them. With `store` None nothing is read or stored.
+
+    Without `on_result`, returns the results in the order of `items`. With
+    it, `on_result(index, result)` is called for every item, stored results
+    first, then computed ones in completion order, and no result is kept:
+    stored results are read in batches and nothing is returned.
+    """
+    items = list(items)
+    indices_of = {}
+    for index, item in enumerate(items):
+        indices_of.setdefault(cache.content_hash(item), []).append(index)
+    if len(indices_of) < len(items):
+        logger.info(f"{kind}: {len(items)} structures, {len(indices_of)} unique, "
+                    f"{len(items) - len(indices_of)} duplicate computations saved")
+
+    results = {} if on_result is None else None
+
+    def fan_out(content_hash, result):
+        if on_result is None:
+            results[content_hash] = result
+        else:
+            for index in indices_of[content_hash]:
+                on_result(index, result)
+
+    missing = list(indices_of)
+    if store is not None:
+        params_hash = store.params_key(kind, params)
+        missing = []
+        unique = list(indices_of)
+        for start in range(0, len(unique), QUERY_BATCH):
+            batch = unique[start:start + QUERY_BATCH]
+            stored = store.get_many(batch, params_hash)
+            for content_hash in batch:
+                if content_hash in stored:
+                    fan_out(content_hash, stored[content_hash])
+                else:
+                    missing.append(content_hash)
+        logger.info(f"{kind}: {len(indices_of) - len(missing)} structures from the result store, "
+                    f"{len(missing)} to compute")
+
+    def store_result(index, result):
+        content_hash = missing[index]
+        if store is not None and result is not None:
+            store.put(content_hash, params_hash, kind, result)
+        fan_out(content_hash, result)
+
+    parallel.map_structures(func, [items[indices_of[content_hash][0]] for content_hash in missing], workers=workers,
+                            desc=desc, on_result=store_result, **kwargs)
+    if on_result is None:
+        ordered = [None] * len(items)
+        for content_hash, indices in indices_of.items():
+            for index in indices:
+                ordered[index] = results[content_hash]
+        return ordered
@@ -0,0 +1,339 @@
+"""
+# ------------------------------------------------------------------------------
+# Author:    Dou Zhixin
+# Email:     bj600800@gmail.com
+# DATE:      2025/03/26
+
+# Description: Structure input sources for --pre_pdb.
+A source is a directory of .pdb/.cif files (optionally gzipped), an
+uncompressed tar archive of such files (AFDB proteome shards), a packed
+structure store or a manifest listing them. Archive members are indexed once and read by offset, never
+extracted; external binaries get a temporary file on tmpfs only while
+they run.
+# ------------------------------------------------------------------------------
+"""
+import contextlib
+import gzip
+import hashlib
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+from pathlib import Path
+
+from biotite.structure import AtomArrayStack
+import biotite.structure.io as strucio
+from biotite.structure.io import pdb, pdbx
+
+from qprotein.utilities import logger, packed_store
+
+logger = logger.setup_log(name=__name__)
+
+STRUCTURE_SUFFIXES = (".pdb", ".ent", ".cif")
+# PDB first: archives with both formats of one model (AFDB shards) yield the PDB
+SUFFIX_PREFERENCE = {packed_store.PACKED_SUFFIX: -1, ".pdb": 0, ".ent": 1, ".cif": 2}
+TMPFS_DIR = "/dev/shm"
+MEMBER_SEPARATOR = "::"
+
+
+def _split_name(file_name):
+    """'AF-X-F1-model_v4.pdb.gz' -> ('AF-X-F1-model_v4', '.pdb', True); None if not a structure."""
+    compressed = file_name.endswith(".gz")
+    base = file_name[:-3] if compressed else file_name
+    stem, suffix = os.path.splitext(base)
+    if suffix.lower() not in STRUCTURE_SUFFIXES:
+        return None
+    return stem, suffix.lower(), compressed
+
+
+def tmp_dir():
+    """tmpfs when available, so materialized structures never touch the disk."""
+    return TMPFS_DIR if os.path.isdir(TMPFS_DIR) and os.access(TMPFS_DIR, os.W_OK) else tempfile.gettempdir()
+
+
+class StructureMember:
+    """
+    A structure that is not a plain file: a gzipped file or a tar member.
+
+    Members are small and picklable, worker processes read them by offset.
+
+    Parameters
+    ----------
+    stem : str
+        Structure name.
+    suffix : str
+        Format of the decompressed content, ".pdb", ".ent" or ".cif".
+    path : str
+        The gzipped file, or the tar archive.
+    offset, size : int, optional
+        Position of the member data in the tar archive.
+    compressed : bool
+        Content is gzipped.
+    """
+
+    def __init__(self, stem, suffix, path, offset=None, size=None, compressed=False):
+        self.stem = stem
+        self.suffix = suffix
+        self.path = path
+        self.offset = offset
+        self.size = size if size is not None else os.path.getsize(path)
+        self.compressed = compressed
+
+    @property
+    def name(self):
+        return self.stem + self.suffix
+
+    def read_bytes(self):
+        with open(self.path, "rb") as f:
+            if self.offset is not None:
+                f.seek(self.offset)
+                data = f.read(self.size)
+            else:
+                data = f.read()
+        return gzip.decompress(data) if self.compressed else data
+
+    def __repr__(self):
+        where = f"{self.path}{MEMBER_SEPARATOR}{self.offset}" if self.offset is not None else self.path
+        return f"StructureMember({self.name!r}, {where!r})"
+
+
+class PackedStructure:
+    """
+    A structure of a packed store (`packed_store`), loaded from the memory map.
+
+    Parameters
+    ----------
+    stem : str
+    path : str
+        The store file.
+    size : int
+        Number of atoms, for load balancing.
+    content_hash : str
+        SHA-256 of the file the structure was packed from.
+    """
+    suffix = packed_store.PACKED_SUFFIX
+
+    def __init__(self, stem, path, size, content_hash):
+        self.stem = stem
+        self.path = path
+        self.size = size
+        self.content_hash = content_hash
+
+    def load(self):
+        return packed_store.open_store(self.path).load(self.stem)
+
+    def __repr__(self):
+        return f"PackedStructure({self.stem!r}, {self.path!r})"
+
+
+def _packed_structures(store_path):
+    store = packed_store.PackedStore(store_path)
+    return [PackedStructure(name, store_path, entry["n_atoms"], entry["sha256"])
+            for name, entry in store.structures.items()]
+
+
+def _tar_members(archive_path):
+    """Index an uncompressed tar archive: headers are read, member data is skipped."""
+    members = []
+    try:
+        tar = tarfile.open(archive_path, "r:")
+    except tarfile.ReadError:
+        raise ValueError(f"{archive_path}: only uncompressed tar archives can be read member by member, "
+                         f"as the AFDB proteome shards are (members may be gzipped)")
+    with tar:
+        for info in tar:
+            if not info.isfile():
+                continue
+            split = _split_name(os.path.basename(info.name))
+            if split is not None:
+                stem, suffix, compressed = split
+                members.append(StructureMember(stem, suffix, archive_path, info.offset_data, info.size, compressed))
+    return members
+
+
+def _file_item(path):
+    split = _split_name(os.path.basename(path))
+    if split is None:
+        return None
+    stem, suffix, compressed = split
+    if compressed:
+        return StructureMember(stem, suffix, str(path), compressed=True)
+    return Path(path)
+
+
+def _manifest_items(manifest_path):
+    """One structure file, tar archive or directory per line, relative to the manifest; '#' comments."""
+    base = os.path.dirname(os.path.abspath(manifest_path))
+    items = []
+    with open(manifest_path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            items.extend(_source_items(os.path.join(base, line), manifest=False))
+    return items
+
+
+def _source_items(source, manifest=True):
+    if os.path.isdir(source):
+        items = [_file_item(os.path.join(source, name)) for name in sorted(os.listdir(source))]
+        return [item for item in items if item is not None]
+    if _split_name(os.path.basename(source)) is not None:
+        return [_file_item(source)]
+    if packed_store.is_packed(source):
+        return _packed_structures(source)
+    if tarfile.is_tarfile(source):
+        return _tar_members(source)
+    if manifest:
+        return _manifest_items(source)
+    raise ValueError(f"Not a structure, tar archive, packed store or directory: {source}")
+
+
+def list_structures(source):
+    """
+    Structures of a source, one per name.
+
+    Returns
+    -------
+    list
+        `Path` for plain structure files, `PackedStructure` for structures
+        of packed stores, `StructureMember` otherwise.
+    """
+    chosen = {}
+    for item in _source_items(str(source)):
+        name = stem(item)
+        if name not in chosen or SUFFIX_PREFERENCE[_suffix(item)] < SUFFIX_PREFERENCE[_suffix(chosen[name])]:
+            chosen[name] = item
+    return list(chosen.values())
+
+
+def _is_file(item):
+    return isinstance(item, (str, os.PathLike))
+
+
+def stem(item):
+    return Path(item).stem if _is_file(item) else item.stem
+
+
+def _suffix(item):
+    return Path(item).suffix.lower() if _is_file(item) else item.suffix
+
+
+def size(item):
+    return os.path.getsize(item) if _is_file(item) else item.size
+
+
+def _pdb_text(atoms):
+    pdb_file = pdb.PDBFile()
+    pdb_file.set_structure(atoms)
+    out = io.StringIO()
+    pdb_file.write(out)
+    return out.getvalue()
+
+
+def read_bytes(item):
+    """Structure file content; packed structures as PDB text."""
+    if isinstance(item, PackedStructure):
+        return _pdb_text(item.load()).encode()
+    if isinstance(item, StructureMember):
+        return item.read_bytes()
+    with open(item, "rb") as f:
+        return f.read()
+
+
+def content_hash(item):
+    """SHA-256 of the (decompressed) structure content, of the packed file for packed structures."""
+    if isinstance(item, PackedStructure):
+        return item.content_hash
+    return hashlib.sha256(read_bytes(item)).hexdigest()
+
+
+def load(item):
+    """
+    AtomArray of a structure file or member, as `strucio.load_structure`.
+    Packed structures are loaded zero-copy from the memory-mapped store.
+    """
+    if isinstance(item, PackedStructure):
+        return item.load()
+    if _is_file(item):
+        return strucio.load_structure(item)
+    text = io.StringIO(item.read_bytes().decode())
+    if item.suffix == ".cif":
+        return pdbx.get_structure(pdbx.PDBxFile.read(text), model=1)
+    return pdb.PDBFile.read(text).get_structure(model=1)
+
+
+def _write_pdb(item, path):
+    if _suffix(item) == ".cif":
+        Path(path).write_text(_pdb_text(load(item)))
+    else:
+        Path(path).write_bytes(read_bytes(item))
+
+
+@contextlib.contextmanager
+def local_file(item):
+    """
+    PDB file of a structure for external binaries (pdb2pqr, mkdssp, propka):
+    plain PDB files as they are, members and mmCIF files written as PDB to a
+    temporary file on tmpfs while the context lasts.
+    """
+    if _is_file(item) and _suffix(item) != ".cif":
+        yield item
+        return
+    directory = tempfile.mkdtemp(prefix="qprotein_", dir=tmp_dir())
+    path = Path(directory) / (stem(item) + ".pdb")
+    try:
+        _write_pdb(item, path)
+        yield path
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+@contextlib.contextmanager
+def materialized_dir(source, out_dir=None):
+    """
+    Directory of <name>.pdb files of a source, for tools that take a whole
+    directory (USalign -dir, PyMOL scripts).
+
+    A plain directory of PDB files is used as is. Otherwise the structures
+    are written to `out_dir`, or to a temporary tmpfs directory removed on exit.
+    """
+    items = list_structures(source)
+    if os.path.isdir(source) and all(isinstance(item, Path) and item.suffix == ".pdb" for item in items):
+        yield str(source)
+        return
+    temporary = out_dir is None
+    directory = tempfile.mkdtemp(prefix="qprotein_", dir=tmp_dir()) if temporary else out_dir
+    os.makedirs(directory, exist_ok=True)
+    try:
+        for item in items:
+            _write_pdb(item, os.path.join(directory, stem(item) + ".pdb"))
+        logger.info(f"Materialized {len(items)} structures in {directory}")
+        yield directory
+    finally:
+        if temporary:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def pack(source, store_path):
+    """
+    Pack the structures of a source into a packed store, skipping names
+    already in it. Returns the number of structures added.
+    """
+    added = 0
+    with packed_store.PackedStoreWriter(store_path) as writer:
+        for item in list_structures(source):
+            name = stem(item)
+            if name in writer:
+                continue
+            atoms = load(item)
+            if isinstance(atoms, AtomArrayStack):
+                atoms = atoms[0]
+            if atoms.array_length() == 0:
+                logger.info(f"Skipped empty structure: {name}")
+                continue
+            writer.add(name, atoms, content_hash(item))
+            added += 1
+    logger.info(f"Packed {added} structures into {store_path}")
+    return added
@@ -0,0 +1,223 @@
+"""
+# ------------------------------------------------------------------------------
+# Author:    Dou Zhixin
+# Email:     bj600800@gmail.com
+# DATE:      2025/04/05
+
+# Description: Template-anchored structure alignment with USalign.
+Every structure is aligned to the template in its own USalign process, in
+parallel worker processes, and kept in the result store by the content of
+both structures. The pairwise alignments are merged into one
+template-numbered multiple alignment, read by `align_map.run` as the
+`USalign -mm 4` output, in time linear in the number of structures.
+# ------------------------------------------------------------------------------
+"""
+import os
+import re
+import subprocess
+import tempfile
+from collections import namedtuple
+
+from qprotein.utilities import cache, logger, result_store, structure_source
+
+logger = logger.setup_log(name=__name__)
+
+# -outfmt 1: aligned sequences in FASTA format, one record per pair
+ALIGN_OPTIONS = ("-mol", "prot", "-outfmt", "1")
+RECORD_END = "$$$$"
+
+PairAlignment = namedtuple("PairAlignment", ["name", "template", "target", "tm_score"])
+PairAlignment.__doc__ = """
+Alignment of one structure to the template: the gapped template and target
+sequences and the TM-score normalized by the template length.
+"""
+
+
+def _header_name(header):
+    name = os.path.basename(header[1:].split("\t")[0])
+    return name.rsplit(":", 1)[0].split(".pdb")[0]
+
+
+def parse_record(lines):
+    """
+    PairAlignment of one -outfmt 1 record: two FASTA entries, template first,
+    with TM-score in the headers; comment lines are skipped.
+    """
+    headers, sequences = [], []
+    for line in lines:
+        line = line.rstrip()
+        if line.startswith(">"):
+            headers.append(line)
+            sequences.append("")
+        elif line and not line.startswith("#") and line != RECORD_END and sequences:
+            sequences[-1] += line
+    if len(headers) != 2 or len(sequences[0]) != len(sequences[1]) or not sequences[0]:
+        raise ValueError(f"malformed USalign record: {headers or lines[:2]}")
+    tm_score = re.search(r"TM-score=([\d.]+)", headers[0])
+    return PairAlignment(_header_name(headers[1]), sequences[0], sequences[1],
+                         float(tm_score.group(1)) if tm_score else None)
+
+
+def iter_records(lines):
+    """
+    PairAlignments of -outfmt 1 output, each yielded as soon as its record
+    ends. Malformed records are logged and skipped.
+    """
+    record = []
+    n_skipped = 0
+    for line in lines:
+        if line.startswith(RECORD_END):
+            try:
+                yield parse_record(record)
+            except ValueError as e:
+                n_skipped += 1
+                logger.warning(f"Skipped {e}")
+            record = []
+        elif not line.startswith("#"):
+            record.append(line)
+    if any(line.startswith(">") for line in record):
+        n_skipped += 1
+        logger.warning(f"Skipped incomplete USalign record: {record[0].rstrip()}")
+    if n_skipped:
+        logger.warning(f"{n_skipped} malformed USalign records skipped")
+
+
+def stream_alignments(cmd):
+    """
+    Run a USalign command with -outfmt 1 and yield its PairAlignments while
+    it runs, reading stdout line by line instead of keeping it whole.
+
+    Raises
+    ------
+    subprocess.CalledProcessError
+        After the last record, if USalign exits with an error.
+    """
+    with tempfile.TemporaryFile(mode="w+") as stderr:
+        process = subprocess.Popen([str(arg) for arg in cmd], stdout=subprocess.PIPE, stderr=stderr, text=True)
+        try:
+            yield from iter_records(process.stdout)
+            returncode = process.wait()
+        finally:
+            # consumer stopped early
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close()
+        if returncode:
+            stderr.seek(0)
+            raise subprocess.CalledProcessError(returncode, cmd, stderr=stderr.read())
+
+
+def align_pair(template_path, target_path, usalign_bin="usalign", options=ALIGN_OPTIONS):
+    """PairAlignment of `target_path` to `template_path`."""
+    result = subprocess.run([usalign_bin, str(template_path), str(target_path), *options],
+                            check=True, capture_output=True, text=True)
+    return parse_record(result.stdout.splitlines())
+
+
+def alignment_params(template, usalign_bin="usalign", options=ALIGN_OPTIONS):
+    """
+    Everything a stored alignment to `template` depends on, see
+    `result_store.map_stored`; targets are keyed by their own content hash.
+    """
+    return {"template": cache.content_hash(template), "usalign": os.path.basename(str(usalign_bin)),
+            "options": list(options)}
+
+
+def _align_item(item, template_path, usalign_bin, options):
+    name = structure_source.stem(item)
+    try:
+        with structure_source.local_file(item) as target_path:
+            alignment = align_pair(template_path, target_path, usalign_bin, options)
+    except (subprocess.CalledProcessError, OSError, ValueError) as e:
+        detail = e.stderr.strip() if isinstance(e, subprocess.CalledProcessError) and e.stderr else e
+        logger.warning(f"USalign failed for {name}: {detail}")
+        return None
+    return alignment._replace(name=name)
+
+
+def align_to_template(template, items, usalign_bin="usalign", workers=1, options=ALIGN_OPTIONS, store=None):
+    """
+    Align every structure to the template in parallel USalign processes.
+    With a `result_store.ResultStore`, alignments are kept by template and
+    target content and options, and only new pairs are aligned.
+
+    Parameters
+    ----------
+    template : str or structure item
+        Template structure.
+    items : list
+        Structures of `structure_source.list_structures`; the template itself is skipped.
+
+    Returns
+    -------
+    alignments : list of PairAlignment
+        In the order of `items`, without the failed structures.
+    failed : list of str
+        Names of structures USalign could not align.
+    """
+    template_name = structure_source.stem(template)
+    items = [item for item in items if structure_source.stem(item) != template_name]
+    with structure_source.local_file(template) as template_path:
+        results = result_store.map_stored(store, "usalign", alignment_params(template, usalign_bin, options),
+                                          _align_item, items, workers=workers, desc="Aligning to template",
+                                          template_path=str(template_path), usalign_bin=usalign_bin,
+                                          options=tuple(options))
+    failed = [structure_source.stem(item) for item, result in zip(items, results) if result is None]
+    # stored and deduplicated results carry the name they were computed for
+    alignments = [result._replace(name=structure_source.stem(item))
+                  for item, result in zip(items, results) if result is not None]
+    logger.info(f"Aligned {len(alignments)} structures to the template, {len(failed)} failed")
+    return alignments, failed
+
+
+def merge_alignments(template_name, alignments):
+    """
+    Template-numbered multiple alignment of pairwise alignments to one template.
+
+    Every template residue is one column holding the target residues aligned
+    to it. Target residues inserted between two template residues fill
+    insertion columns there, as many as the longest insertion, in which the
+    template has gaps.
+
+    Returns
+    -------
+    list of (name, aligned sequence)
+        The template first, then the targets; all sequences have equal length.
+    """
+    template_seq = None
+    pairs = []
+    for alignment in alignments:
+        ungapped = alignment.template.replace("-", "")
+        if template_seq is None:
+            template_seq = ungapped
+        elif ungapped != template_seq:
+            logger.warning(f"{alignment.name}: aligned to a different template sequence, skipped")
+            continue
+        # insertions[p]: target residues before template residue p; matches[p]: residue aligned to it
+        insertions = [""] * (len(template_seq) + 1)
+        matches = []
+        for template_res, target_res in zip(alignment.template, alignment.target):
+            if template_res == "-":
+                insertions[len(matches)] += target_res
+            else:
+                matches.append(target_res)
+        pairs.append((alignment.name, insertions, matches))
+    if template_seq is None:
+        return []
+
+    widths = [max([len(insertions[p]) for _, insertions, _ in pairs]) for p in range(len(template_seq) + 1)]
+    template_row = "".join("-" * widths[p] + template_seq[p] for p in range(len(template_seq))) + "-" * widths[-1]
+    rows = [(template_name, template_row)]
+    for name, insertions, matches in pairs:
+        row = "".join(insertions[p].ljust(widths[p], "-") + matches[p] for p in range(len(template_seq)))
+        rows.append((name, row + insertions[-1].ljust(widths[-1], "-")))
+    return rows
+
+
+def write_msa(rows, out_file):
+    """FASTA in the `USalign -mm 4` layout read by `align_map.run`."""
+    with open(out_file, "w") as f:
+        for name, seq in rows:
+            f.write(f">{name}.pdb\n{seq}\n")
+    return out_file
@@ -11,68 +11,74 @@ import os
 import argparse
 import subprocess
 import time
-from tqdm import tqdm
-import biotite.structure.io as strucio
 
 from qprotein.seq2struct.sequence import get_id
-from qprotein.seq2struct.afdb import get_struct
+from qprotein.seq2struct import afdb
 from qprotein.seq2struct import esmfold
-from qprotein.feature import hydrophobic, hbond, salt_bridge, disulfide_bond
+from qprotein.feature import compute_surface, hydrophobic, hbond, salt_bridge, disulfide_bond, titration, trajectory
+from qprotein.feature.context import StructureContext
 from qprotein.analysis import overall, local
-from qprotein.utilities import logger
+from qprotein.utilities import cache, export, logger, packed_store, result_store, structure_source, usalign
 
 from qprotein.analysis import internal, surface, landscape
 logger = logger.setup_log(name=__name__)
 
-def crawl_struct(id_list, structure_folder):
+def crawl_struct(id_list, structure_folder, concurrency=8, rate=10, base_url=afdb.AFDB_URL, trim_threshold=None,
+                 output_format="pdb"):
     """Download AFDB structures unless already existing."""
     def search_exist_struct(structure_folder):
-        exists = [file for file in os.listdir(structure_folder)
-                  if os.path.isfile(os.path.join(structure_folder, file))
-                  and os.path.getsize(os.path.join(structure_folder, file)) > 0]
-        return [os.path.splitext(item)[0] for item in exists]
+        exists = [item for item in structure_source.list_structures(structure_folder)
+                  if structure_source.size(item) > 0]
+        return [structure_source.stem(item) for item in exists]
 
     id_list = list(set(id_list) - set(search_exist_struct(structure_folder)))
     if id_list:
-        for uniprot_id in tqdm(id_list):
-            pdb_string = get_struct(uniprot_id)
-            if pdb_string:
-                save_path = os.path.join(structure_folder, uniprot_id + ".pdb")
-                with open(save_path, "w") as f:
-                    f.write(pdb_string)
-
-    logger.info(f"Crawled structures: {len(os.listdir(structure_folder))}")
-
-
-def calc_feature(pdb_list, return_mode):
+        afdb.fetch_structs(id_list, structure_folder, concurrency=concurrency, rate=rate, base_url=base_url,
+                           trim_threshold=trim_threshold, output_format=output_format)
+
+    logger.info(f"Crawled structures: {len(search_exist_struct(structure_folder))}")
+
+
+def _structure_feature(pdb_file, return_mode, protonation="cli"):
+    context = StructureContext.load(pdb_file)
+    hbond_freq, length = hbond.run(context, return_mode, backend=protonation)
+    salt_freq, length = salt_bridge.run(context, return_mode)
+    disul_freq, length = disulfide_bond.run(context, return_mode)
+    hydrophobic_ret = hydrophobic.run(context)
+    return {
+        "hydrophobic": hydrophobic_ret,
+        "hbond": hbond_freq,
+        "saltbridge": salt_freq,
+        "disulfide": disul_freq,
+        "length": length
+    }
+
+def feature_params(return_mode, protonation="cli"):
+    """Everything the interaction features depend on, see `result_store.map_stored`."""
+    return {"return_mode": return_mode, **internal.interaction_params(protonation)}
+
+def calc_feature(pdb_list, return_mode, protonation="cli", workers=1, store=None, sink=None):
+    """
+    sink: ParquetSink of `overall.PARQUET_TABLES`, rows are written while structures finish
+    and nothing is returned; otherwise returns {name: features}
+    """
     logger.info(f"Calculating features, please wait...")
-    feature_dict = {}
-    for pdb_file in tqdm(pdb_list):
-        name = os.path.basename(pdb_file).split(".")[0]
-        structure = strucio.load_structure(pdb_file)
-        hbond_freq, length = hbond.run(pdb_file, return_mode)
-        salt_freq, length = salt_bridge.run(structure, return_mode)
-        disul_freq, length = disulfide_bond.run(structure, return_mode)
-        hydrophobic_ret = hydrophobic.run(structure)
-        feature_dict[name] = {
-            "hydrophobic": hydrophobic_ret,
-            "hbond": hbond_freq,
-            "saltbridge": salt_freq,
-            "disulfide": disul_freq,
-            "length": length
-        }
-    return feature_dict
-
-def calc_local_hydrophobic(pdb_list):
-    hydro_dict = {}
-    for pdb_file in tqdm(pdb_list):
-        name = os.path.basename(pdb_file).split(".")[0]
-        structure = strucio.load_structure(pdb_file)
-        hydrophobic_ret = hydrophobic.run(structure)
-        hydro_dict[name] = hydrophobic_ret
-    return hydro_dict
-
-def align_structure(structure_folder, usalign_binary="usalign"):
+    names = [structure_source.stem(pdb_file) for pdb_file in pdb_list]
+    on_result = export.row_emitter(sink, names, overall.parquet_rows) if sink is not None else None
+    features = result_store.map_stored(store, "overall", feature_params(return_mode, protonation),
+                                       _structure_feature, pdb_list, workers=workers, on_result=on_result,
+                                       return_mode=return_mode, protonation=protonation)
+    if sink is None:
+        return dict(zip(names, features))
+
+def _local_hydrophobic(pdb_file):
+    return hydrophobic.run(structure_source.load(pdb_file))
+
+def calc_local_hydrophobic(pdb_list, workers=1):
+    clusters = result_store.map_stored(None, "local", None, _local_hydrophobic, pdb_list, workers=workers)
+    return {structure_source.stem(pdb_file): cluster for pdb_file, cluster in zip(pdb_list, clusters)}
+
+def align_structure(structure_folder, usalign_binary="usalign", out_dir=None):
     files = [file for file in os.listdir(structure_folder) if file.endswith(".pdb")]
     name_txt = os.path.join(structure_folder, "name.txt")
 
@@ -80,7 +86,7 @@ def align_structure(structure_folder, usalign_binary="usalign"):
         for fn in files:
             f.write(fn + "\n")
 
-    out_file = os.path.join(os.path.dirname(structure_folder), "usalign_out.fasta")
+    out_file = os.path.join(out_dir or os.path.dirname(structure_folder), "usalign_out.fasta")
 
     cmd = [usalign_binary, "-dir", structure_folder, name_txt, "-suffix", ".pdb", "-mm", "4"]
     result = subprocess.run(cmd, check=True, stdout=subprocess.PIPE)
@@ -91,14 +97,31 @@ def align_structure(structure_folder, usalign_binary="usalign"):
     os.remove(name_txt)
     return out_file
 
+def align_to_template(pdb_list, template_name, usalign_binary="usalign", out_dir=None, workers=1, store=None):
+    """
+    Template-anchored alternative to `align_structure`: every structure is
+    aligned to the template in parallel, merged into a template-numbered MSA.
+    """
+    template = next((item for item in pdb_list if structure_source.stem(item) == template_name), None)
+    if template is None:
+        raise ValueError(f"Template {template_name} is not among the structures")
+    alignments, failed = usalign.align_to_template(template, pdb_list, usalign_bin=usalign_binary, workers=workers,
+                                                   store=store)
+    if failed:
+        logger.warning(f"Structures without alignment, left out of local analysis: {', '.join(failed)}")
+    out_file = os.path.join(out_dir, "usalign_out.fasta")
+    return usalign.write_msa(usalign.merge_alignments(template_name, alignments), out_file)
+
 def main():
-    modes = ["fetch", "overall", "local", "visual", "surface", "landscape"]
+    modes = ["fetch", "pack", "overall", "local", "visual", "surface", "landscape", "occupancy"]
 
     parser = argparse.ArgumentParser(description="qProtein analysis kit")
     parser.add_argument("--mode", type=str, choices=modes, required=True)
     parser.add_argument("--fasta")
     parser.add_argument("--id")
-    parser.add_argument("--pre_pdb")
+    parser.add_argument("--pre_pdb",
+                        help="structures: a directory of .pdb/.cif files (optionally .gz), an uncompressed tar "
+                             "archive of them (e.g. an AFDB proteome shard) or a manifest file listing them")
     parser.add_argument("--work_dir", required=True)
     parser.add_argument("--template_name")
     parser.add_argument("--dist1")
@@ -108,8 +131,62 @@ def main():
     parser.add_argument("--positions")
     parser.add_argument("--label_file")
     parser.add_argument("--label_pos_threshold")
+    parser.add_argument("--protonation", choices=["cli", "api", "builtin"], default="cli",
+                        help="protonation backend for hydrogen bonds: pdb2pqr CLI, pdb2pqr Python API "
+                             "or built-in polar hydrogen placement")
+    parser.add_argument("--cache_dir", help="protonation cache directory (default: ~/.cache/qprotein)")
+    parser.add_argument("--cache_size", type=int, default=2048, help="protonation cache size cap in MB")
+    parser.add_argument("--no_cache", action="store_true", help="always rerun pdb2pqr")
+    parser.add_argument("--result_store",
+                        help="per-structure result database of overall, visual and surface modes and of "
+                             "template alignments of local (--align_mode template) and landscape modes "
+                             "(default: work_dir/qprotein_results.sqlite)")
+    parser.add_argument("--no_store", action="store_true", help="recompute all structures, do not use the result store")
+    parser.add_argument("--output_format", "--output-format", choices=export.OUTPUT_FORMATS, default="default",
+                        help="default: csv/xlsx files of each mode; parquet: typed Parquet tables written incrementally")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes for per-structure calculations (default: 1)")
+    parser.add_argument("--surface_backend", "--surface-backend", choices=["dssp", "native"], default="dssp",
+                        help="surface accessibility and secondary structure: mkdssp or in-process biotite")
+    parser.add_argument("--sasa_points", type=int, default=compute_surface.SASA_POINTS,
+                        help="sphere points per atom of the native SASA calculation")
+    parser.add_argument("--potential", action="store_true",
+                        help="surface mode: also solve electrostatics with APBS and write potential .dx files")
+    parser.add_argument("--fetch_concurrency", type=int, default=8,
+                        help="fetch mode: simultaneous AFDB downloads (default: 8)")
+    parser.add_argument("--fetch_rate", type=float, default=10,
+                        help="fetch mode: maximum AFDB requests per second (default: 10, 0 for no limit)")
+    parser.add_argument("--afdb_url", default=afdb.AFDB_URL,
+                        help="fetch mode: AFDB file server, e.g. a local mirror or stand-in server")
+    parser.add_argument("--fetch_format", "--fetch-format", choices=afdb.OUTPUT_FORMATS, default="pdb",
+                        help="fetch mode: write AFDB or predicted models as plain or gzipped PDB files")
+    parser.add_argument("--fold_backend", choices=esmfold.FOLD_BACKENDS, default="esmfold",
+                        help="fetch mode with --fasta: ESMFold, or a CPU mock predictor for pipeline tests")
+    parser.add_argument("--fold_max_tokens", type=int, default=esmfold.MAX_TOKENS,
+                        help="fetch mode with --fasta: padded residues per ESMFold batch (default: 1024)")
+    parser.add_argument("--esm_dir", default="/opt/app/esm-main/",
+                        help="fetch mode with --fasta: torch hub directory of the ESMFold weights")
+    parser.add_argument("--packed_store",
+                        help="pack mode: packed structure store to write or extend "
+                             "(default: work_dir/structures.qps), usable as --pre_pdb")
+    parser.add_argument("--trim_plddt", "--trim-plddt", type=float, metavar="PLDDT",
+                        help="fetch mode: trim termini and long loops below this pLDDT (e.g. 50) instead of "
+                             "rejecting models with mean pLDDT <= 70")
+    parser.add_argument("--align_mode", "--align-mode", choices=["msa", "template"], default="msa",
+                        help="local mode: one USalign -mm 4 multiple alignment, or every structure aligned to "
+                             "--template_name in parallel (--workers) and merged into a template-numbered MSA")
+    parser.add_argument("--trajectory", help="occupancy mode: multi-model PDB or DCD trajectory")
+    parser.add_argument("--topology", help="occupancy mode: topology structure of a DCD trajectory")
+    parser.add_argument("--ph_scan", metavar="START,STOP,STEP",
+                        help="surface mode: net charge and surface charges over a pH grid, e.g. 2,12,0.5")
 
     args = parser.parse_args()
+    cache.configure(cache_dir=args.cache_dir, max_size=args.cache_size * 1024 ** 2, enabled=not args.no_cache)
+    store = None
+    if args.mode in ("overall", "local", "visual", "surface", "landscape") and not args.no_store:
+        os.makedirs(args.work_dir, exist_ok=True)
+        store = result_store.ResultStore(
+            args.result_store or os.path.join(args.work_dir, result_store.RESULT_STORE_NAME))
 
     # ------------------------------------------------------------------------------
     # MODE — FETCH: Fetch pdbs from AFDB or ESMFold
@@ -121,16 +198,22 @@ def main():
         # 1. get structure
         if args.fasta:
             logger.info("Predicting structures by ESMFold")
+            predictor = esmfold.get_predictor(args.fold_backend,
+                                              **({"model_dir": args.esm_dir} if args.fold_backend == "esmfold" else {}))
             esmfold.run(
                 fasta_file=args.fasta,
                 structure_dir=structure_dir,
-                esm_script="/opt/app/esm-main/scripts/fold.py",
-                esm_dir="/opt/app/esm-main/",
+                predictor=predictor,
+                max_tokens=args.fold_max_tokens,
+                trim_threshold=args.trim_plddt,
+                output_format=args.fetch_format,
             )
 
         elif args.id:
             logger.info("Crawling AlphaFold DB")
-            crawl_struct(get_id(args.id), structure_dir)
+            crawl_struct(get_id(args.id), structure_dir, concurrency=args.fetch_concurrency,
+                         rate=args.fetch_rate or None, base_url=args.afdb_url, trim_threshold=args.trim_plddt,
+                         output_format=args.fetch_format)
 
         else:
             logger.error("fetch mode requires either --fasta or --id")
@@ -140,6 +223,18 @@ def main():
         logger.info(f"Structure fetch completed. Saved to: {structure_dir}")
         return
 
+    # ------------------------------------------------------------------------------
+    # MODE — PACK: Pack structures into one memory-mapped store
+    # ------------------------------------------------------------------------------
+    elif args.mode == "pack":
+        if not args.pre_pdb:
+            logger.error("pack mode requires --pre_pdb")
+            return
+        os.makedirs(args.work_dir, exist_ok=True)
+        store_path = args.packed_store or os.path.join(args.work_dir, "structures" + packed_store.PACKED_SUFFIX)
+        structure_source.pack(args.pre_pdb, store_path)
+        return
+
     # ------------------------------------------------------------------------------
     # MODE — OVERALL: Calculate overall protein structure features
     # ------------------------------------------------------------------------------
@@ -153,11 +248,7 @@ def main():
             return
 
         # 2. feature calculation — only if PDB files exist
-        pdb_list = [
-            os.path.join(structure_dir, fn)
-            for fn in os.listdir(structure_dir)
-            if fn.lower().endswith(".pdb")
-        ]
+        pdb_list = structure_source.list_structures(structure_dir)
 
         if len(pdb_list) == 0:
             logger.error(f"No PDB structures found in: {structure_dir}")
@@ -166,11 +257,18 @@ def main():
 
         # 2. feature calculation
         return_mode = "frequency"
-        feature_dict = calc_feature(pdb_list, return_mode)
+        if args.output_format == "parquet":
+            # 3. save overall while calculating
+            with export.ParquetSink(args.work_dir, "overall", overall.PARQUET_TABLES) as sink:
+                calc_feature(pdb_list, return_mode, protonation=args.protonation, workers=args.workers,
+                             store=store, sink=sink)
+        else:
+            feature_dict = calc_feature(pdb_list, return_mode, protonation=args.protonation, workers=args.workers,
+                                        store=store)
 
-        # 3. save overall
-        overall_file = os.path.join(args.work_dir, "overall_feature.csv")
-        overall.save_feature(overall_file, feature_dict)
+            # 3. save overall
+            overall_file = os.path.join(args.work_dir, "overall_feature.csv")
+            overall.save_feature(overall_file, feature_dict)
 
         logger.info(f"Overall analysis finished in {int(time.time() - start)} seconds.")
         return
@@ -189,11 +287,7 @@ def main():
         if not (args.template_name and args.positions and args.dist1 and args.dist2):
             parser.error("Local mode requires --template_name --template_active_res --dist1 --dist2")
 
-        pdb_list = [
-            os.path.join(structure_dir, fn)
-            for fn in os.listdir(structure_dir)
-            if fn.lower().endswith(".pdb")
-        ]
+        pdb_list = structure_source.list_structures(structure_dir)
 
         if len(pdb_list) == 0:
             logger.error(f"No PDB structures found in: {structure_dir}")
@@ -201,27 +295,29 @@ def main():
             return
 
         # 1. hydrophobic cluster calculation
-        hydrophobic_feature = calc_local_hydrophobic(pdb_list)
+        hydrophobic_feature = calc_local_hydrophobic(pdb_list, workers=args.workers)
 
-        # 2. alignment
-        align_file = align_structure(structure_dir)
+        # 2. alignment, USalign -mm 4 reads a directory of PDB files
+        align_dir = os.path.dirname(os.path.abspath(structure_dir))
+        if args.align_mode == "template":
+            align_file = align_to_template(pdb_list, args.template_name, out_dir=align_dir, workers=args.workers,
+                                           store=store)
+        else:
+            with structure_source.materialized_dir(structure_dir) as pdb_dir:
+                align_file = align_structure(pdb_dir, out_dir=align_dir)
 
         # 3. local output
         local_hpd_file = os.path.join(args.work_dir, "local_hydrophobic_feature.csv")
         local_aa_file = os.path.join(args.work_dir, "local_aa_feature.csv")
 
         # 5. run local analysis
-        local.run(
-            args.template_name,
-            align_file,
-            args.positions.split(","),
-            hydrophobic_feature,
-            pdb_list,
-            local_hpd_file,
-            local_aa_file,
-            int(args.dist1),
-            int(args.dist2)
-        )
+        local_args = (args.template_name, align_file, args.positions.split(","), hydrophobic_feature, pdb_list,
+                      local_hpd_file, local_aa_file, int(args.dist1), int(args.dist2))
+        if args.output_format == "parquet":
+            with export.ParquetSink(args.work_dir, "local", local.PARQUET_TABLES) as sink:
+                local.run(*local_args, sink=sink)
+        else:
+            local.run(*local_args)
 
         logger.info(f"Local analysis finished in {int(time.time() - start)} seconds.")
         return
@@ -236,7 +332,8 @@ def main():
             logger.error("visual mode requires --pre_pdb")
             return
 
-        internal.run(work_dir=args.work_dir, pdb_dir=structure_dir, pml=args.pml)
+        internal.run(work_dir=args.work_dir, pdb_dir=structure_dir, pml=args.pml, protonation=args.protonation,
+                     workers=args.workers, store=store, output_format=args.output_format)
 
     # ------------------------------------------------------------------------------
     # MODE — surface: Surface charge analysis
@@ -252,7 +349,10 @@ def main():
             logger.error("visual mode requires --config_file")
             return
 
-        surface.run(work_dir=args.work_dir, structure_dir=structure_dir, config_file=args.config_file)
+        surface.run(work_dir=args.work_dir, structure_dir=structure_dir, config_file=args.config_file,
+                    workers=args.workers, backend=args.surface_backend, point_number=args.sasa_points,
+                    potential=args.potential, store=store, output_format=args.output_format,
+                    ph_grid=titration.parse_ph_grid(args.ph_scan) if args.ph_scan else None)
 
     # ------------------------------------------------------------------------------
     # MODE — landscape: function landscape visualization
@@ -284,15 +384,32 @@ def main():
             logger.error("visual mode requires --config_file")
             return
 
-        landscape.run(
-            work_dir=args.work_dir,
-            pdb_dir=structure_dir,
-            label_file=args.label_file,
-            template_name=args.template_name,
-            input_pos_list=args.positions,
-            label_pos_threshold=args.label_pos_threshold,
-            config_file=args.config_file,
-        )
+        with structure_source.materialized_dir(structure_dir) as pdb_dir:
+            landscape.run(
+                work_dir=args.work_dir,
+                pdb_dir=pdb_dir,
+                label_file=args.label_file,
+                template_name=args.template_name,
+                input_pos_list=args.positions,
+                label_pos_threshold=args.label_pos_threshold,
+                config_file=args.config_file,
+                output_format=args.output_format,
+                store=store,
+            )
+
+    # ------------------------------------------------------------------------------
+    # MODE — occupancy: interaction occupancy over trajectory frames
+    # ------------------------------------------------------------------------------
+    elif args.mode == "occupancy":
+        if not args.trajectory:
+            logger.error("occupancy mode requires --trajectory")
+            return
+
+        os.makedirs(args.work_dir, exist_ok=True)
+        start = time.time()
+        template, result, n_frames = trajectory.run(args.trajectory, topology_path=args.topology)
+        trajectory.save_occupancy(template, result, n_frames, args.work_dir)
+        logger.info(f"Occupancy of {n_frames} frames finished in {int(time.time() - start)} seconds.")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,125 @@
+"""
+# ------------------------------------------------------------------------------
+# Author:    Dou Zhixin
+# Email:     bj600800@gmail.com
+# DATE:      2025/04/10
+
+# Description: Equivalence check and benchmark of the disulfide bond search.
+The batched `disulfide_bond.run` is compared with the original per-pair
+implementation (kept below as `reference_pairs`) on the test structures and
+on a synthetic cysteine-rich structure, with the default and the extended
+tolerance. Exits non-zero if any bond list differs.
+
+    python test/benchmark_disulfide.py [structure.pdb ...]
+# ------------------------------------------------------------------------------
+"""
+import os
+import sys
+import time
+
+import numpy as np
+import biotite.structure as struc
+import biotite.structure.io as strucio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from qprotein.feature import disulfide_bond  # noqa: E402
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def reference_pairs(structure, distance=2.05, distance_tol=0.05, dihedral=90, dihedral_tol=15, extended_tol=False):
+    """Bond list of the original implementation: CellList query and CB rescans per SG atom."""
+    if extended_tol:
+        distance_tol = 3.0
+    disulfide_bonds = []
+    sulfide_mask = (structure.res_name == "CYS") & (structure.atom_name == "SG")
+    cell_list = struc.CellList(structure, cell_size=distance + distance_tol, selection=sulfide_mask)
+    for i in np.where(sulfide_mask)[0]:
+        for j in cell_list.get_atoms(coord=structure.coord[i], radius=distance + distance_tol):
+            if i == j:
+                continue
+            sg1 = structure[i]
+            sg2 = structure[j]
+            cb1 = structure[(structure.chain_id == sg1.chain_id) & (structure.res_id == sg1.res_id) &
+                            (structure.atom_name == "CB")]
+            cb2 = structure[(structure.chain_id == sg2.chain_id) & (structure.res_id == sg2.res_id) &
+                            (structure.atom_name == "CB")]
+            if len(cb1) == 0 or len(cb2) == 0:
+                continue
+            bond_dist = struc.distance(sg1, sg2)
+            bond_dihed = abs(np.rad2deg(struc.dihedral(cb1, sg1, sg2, cb2)))
+            cond_dist = (distance - distance_tol) < bond_dist < (distance + distance_tol)
+            cond_dihed = (dihedral - dihedral_tol) < bond_dihed < (dihedral + dihedral_tol)
+            if cond_dist and cond_dihed:
+                bond_tuple = tuple(sorted([(int(i) + 1, int(sg1.res_id)), (int(j) + 1, int(sg2.res_id))]))
+                if bond_tuple not in disulfide_bonds:
+                    disulfide_bonds.append(bond_tuple)
+    return disulfide_bonds
+
+
+def cysteine_rich_structure(n_pairs=200, n_filler=1032, spacing=4.5, seed=0):
+    """
+    Cysteine pairs on a grid with disulfide geometry around the ideal values
+    (distance 2.05 +- 0.12 A, dihedral 90 +- 25 deg), so that some pairs fail
+    the default criteria and grid neighbours are candidates of the extended
+    tolerance, plus alanine filler residues.
+    """
+    rng = np.random.default_rng(seed)
+    atoms = []
+    res_id = 0
+    side = int(np.ceil(np.sqrt(n_pairs)))
+    for k in range(n_pairs):
+        origin = np.array([k % side, k // side, 0.0]) * spacing
+        bond = 2.05 + rng.uniform(-0.12, 0.12)
+        phi = np.deg2rad(90 + rng.uniform(-25, 25))
+        sg1 = origin
+        sg2 = origin + [bond, 0, 0]
+        cb1 = sg1 + [-0.6, 1.7, 0]
+        cb2 = sg2 + [0.6, 1.7 * np.cos(phi), 1.7 * np.sin(phi)]
+        for cb, sg in ((cb1, sg1), (cb2, sg2)):
+            res_id += 1
+            atoms += [struc.Atom(cb + [0, 1.5, 0], chain_id="A", res_id=res_id, res_name="CYS", atom_name="CA",
+                                 element="C"),
+                      struc.Atom(cb, chain_id="A", res_id=res_id, res_name="CYS", atom_name="CB", element="C"),
+                      struc.Atom(sg, chain_id="A", res_id=res_id, res_name="CYS", atom_name="SG", element="S")]
+    for k in range(n_filler):
+        res_id += 1
+        position = np.array([k % 40, k // 40, 30.0]) * 3.8
+        atoms += [struc.Atom(position, chain_id="A", res_id=res_id, res_name="ALA", atom_name="CA", element="C"),
+                  struc.Atom(position + [0, 1.5, 0], chain_id="A", res_id=res_id, res_name="ALA", atom_name="CB",
+                             element="C")]
+    return struc.array(atoms)
+
+
+def _timed(func, *args, repeat=3, **kwargs):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def main(paths):
+    structures = [(os.path.basename(path), strucio.load_structure(path)) for path in paths]
+    structures.append(("synthetic cysteine-rich", cysteine_rich_structure()))
+    print(f"{'structure':<28}{'SG':>5}{'tolerance':>11}{'bonds':>7}{'before ms':>11}{'after ms':>10}  same")
+    all_same = True
+    for name, structure in structures:
+        n_sg = int(((structure.res_name == "CYS") & (structure.atom_name == "SG")).sum())
+        for extended_tol in (False, True):
+            before, before_time = _timed(reference_pairs, structure, extended_tol=extended_tol)
+            after, after_time = _timed(disulfide_bond.run, structure, "pairs", extended_tol=extended_tol)
+            same = sorted(before) == sorted(after)
+            all_same &= same
+            print(f"{name:<28}{n_sg:>5}{'extended' if extended_tol else 'default':>11}{len(after):>7}"
+                  f"{before_time * 1000:>11.1f}{after_time * 1000:>10.1f}  {same}")
+    return 0 if all_same else 1
+
+
+if __name__ == '__main__':
+    paths = sys.argv[1:] or sorted(os.path.join(TEST_DIR, "structure", file)
+                                   for file in os.listdir(os.path.join(TEST_DIR, "structure"))
+                                   if file.endswith(".pdb"))
+    sys.exit(main(paths))
@@ -0,0 +1,84 @@
+"""
+# ------------------------------------------------------------------------------
+# Author:    Dou Zhixin
+# Email:     bj600800@gmail.com
+# DATE:      2025/04/10
+
+# Description: Equivalence check and benchmark of the protonation backends.
+Hydrogen bond frequency and wall time of every backend of `hbond.run`
+against the original path (`reference_frequency`: pdb2pqr command line
+writing a protonated PDB to a temporary file that is parsed back). The
+cache is disabled so every backend really protonates. Exits non-zero if
+the cli or api backend differs from the original; builtin places hydrogens
+geometrically and is only reported.
+
+    python test/benchmark_protonation.py [structure.pdb ...]
+# ------------------------------------------------------------------------------
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import biotite.structure as struc
+import biotite.structure.io as strucio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from qprotein.feature import hbond, protonation  # noqa: E402
+from qprotein.utilities import cache  # noqa: E402
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def reference_frequency(structure_path, pdb2pqr_bin="pdb2pqr"):
+    """H-bond frequency of the original implementation, protonated through temporary files."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pqr_path = os.path.join(tmp_dir, "out.pqr")
+        pdb_out_path = os.path.join(tmp_dir, "out.pdb")
+        subprocess.run([pdb2pqr_bin, *protonation.pdb2pqr_options(), "--pdb-output", pdb_out_path,
+                        str(structure_path), pqr_path], check=True)
+        structure = strucio.load_structure(str(structure_path))
+        structure_h = strucio.load_structure(pdb_out_path)
+    length = len(struc.get_residues(structure)[0])
+    return len(struc.hbond(structure_h)) / length
+
+
+def _timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def main(paths):
+    cache.configure(enabled=False)
+    rows = []
+    for path in paths:
+        rows.append((os.path.basename(path), "original", *_timed(reference_frequency, path)))
+        for backend in protonation.BACKENDS:
+            (frequency, _), elapsed = _timed(hbond.run, path, "frequency", backend=backend)
+            rows.append((os.path.basename(path), backend, frequency, elapsed))
+
+    print(f"{'structure':<20}{'backend':>10}{'frequency':>11}{'time s':>9}  same as original")
+    totals = {}
+    all_same = True
+    original = {}
+    for name, backend, frequency, elapsed in rows:
+        totals[backend] = totals.get(backend, 0) + elapsed
+        if backend == "original":
+            original[name] = frequency
+            same = ""
+        else:
+            same = abs(frequency - original[name]) < 1e-12
+            if backend != "builtin":
+                all_same &= same
+        print(f"{name:<20}{backend:>10}{frequency:>11.4f}{elapsed:>9.2f}  {same}")
+    print("total wall time: " + ", ".join(f"{backend} {seconds:.2f} s" for backend, seconds in totals.items()))
+    return 0 if all_same else 1
+
+
+if __name__ == '__main__':
+    paths = sys.argv[1:] or sorted(os.path.join(TEST_DIR, "structure", file)
+                                   for file in os.listdir(os.path.join(TEST_DIR, "structure"))
+                                   if file.endswith(".pdb"))
+    sys.exit(main(paths))
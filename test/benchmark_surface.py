@@ -0,0 +1,71 @@
+"""
+# ------------------------------------------------------------------------------
+# Author:    Dou Zhixin
+# Email:     bj600800@gmail.com
+# DATE:      2025/04/10
+
+# Description: Agreement of the native surface backend with DSSP.
+Surface charged residues and percentages of `compute_surface.get_native_dat`
+at several SASA sphere point numbers against the DSSP results stored in
+test/surface.xlsx. If mkdssp is installed, `compute_surface.compare_backends`
+also runs on the test structures. Exits non-zero if the default
+`SASA_POINTS` differs from the DSSP reference.
+
+    python test/benchmark_surface.py [mkdssp]
+# ------------------------------------------------------------------------------
+"""
+import os
+import shutil
+import sys
+import time
+
+import openpyxl
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from qprotein.feature import compute_surface  # noqa: E402
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+POINT_NUMBERS = (100, 200, 300, 500, 1000)
+
+
+def dssp_reference(xlsx_file):
+    """Percentages and surface charged residues per structure from a surface mode workbook."""
+    workbook = openpyxl.load_workbook(xlsx_file, read_only=True)
+    statistics = {row[0]: {"negative": row[1], "positive": row[2]}
+                  for row in list(workbook["Statistics"].iter_rows(values_only=True))[1:]}
+    details = list(workbook["Details"].iter_rows(values_only=True))
+    reference = {}
+    for id_row, name_row in zip(details[::2], details[1::2]):
+        name = id_row[0].rsplit("_chain", 1)[0]
+        residues = {(res_id, res_name) for res_id, res_name in zip(id_row[1:], name_row[1:]) if res_id is not None}
+        reference[name] = (statistics[name], residues)
+    return reference
+
+
+def main(dssp_bin=None):
+    reference = dssp_reference(os.path.join(TEST_DIR, "surface.xlsx"))
+    print(f"{'structure':<10}{'points':>7}{'negative':>10}{'positive':>10}{'ms':>7}  only native / only DSSP")
+    default_same = True
+    for name, (percent, residues) in reference.items():
+        print(f"{name:<10}{'DSSP':>7}{percent['negative']:>10}{percent['positive']:>10}")
+        for point_number in POINT_NUMBERS:
+            start = time.perf_counter()
+            native_dat = compute_surface.get_native_dat(os.path.join(TEST_DIR, "structure", name + ".pdb"),
+                                                        point_number=point_number)
+            elapsed = time.perf_counter() - start
+            native_percent, charge_position = compute_surface.get_aa_charge(native_dat)
+            native = {(int(res_id), res_name) for res_id, res_name, _ in charge_position}
+            same = native == residues and native_percent == percent
+            if point_number == compute_surface.SASA_POINTS:
+                default_same &= same
+            print(f"{name:<10}{point_number:>7}{native_percent['negative']:>10}{native_percent['positive']:>10}"
+                  f"{elapsed * 1000:>7.0f}  {sorted(native - residues)} / {sorted(residues - native)}")
+
+    if dssp_bin:
+        for row in compute_surface.compare_backends(os.path.join(TEST_DIR, "structure"), dssp_bin):
+            print(row)
+    return 0 if default_same else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1] if len(sys.argv) > 1 else shutil.which("mkdssp")))